@@ -0,0 +1,154 @@
+"""Bytes and encode time per tile for every tile encoder.
+
+Run from the repository root:
+
+  python -m benchmarks.encoding_benchmark [--netcdf PATH] [--tiles-per-zoom N]
+
+Without --netcdf a smooth synthetic field on an HRRR-like grid is used for
+each variable; with it the fields come from read_weather on a real file.
+"""
+import argparse
+import asyncio
+import json
+import time
+import numpy as np
+
+from color_maps import COLOR_SCALES
+from generate_tiles import TILE_ENCODINGS, encode_tile, prepare_tile_source
+from tile_index import get_tile_resampling, resample_tile
+from utils import get_tile_ranges_for_zoom
+
+ZOOMS = [6, 8, 10]
+
+def synthetic_grid(resolution=0.15):
+  lats = np.arange(21.0, 53.0, resolution)
+  lons = np.arange(-134.0, -60.0, resolution)
+  return lats, lons
+
+def synthetic_field(variable, lats, lons, seed=0):
+  rng = np.random.default_rng(seed)
+  scale = COLOR_SCALES[variable]
+
+  if scale['type'] == 'steps':
+    low, high = scale['breakpoints'][0], scale['breakpoints'][-2] * 1.1
+  else:
+    low, high = 0, scale['max_value']
+
+  lat_grid, lon_grid = np.meshgrid(np.radians(lats), np.radians(lons), indexing='ij')
+  field = np.zeros(lat_grid.shape)
+
+  for _ in range(6):
+    frequency = rng.uniform(2, 20, size=2)
+    phase = rng.uniform(0, 2 * np.pi, size=2)
+    field += np.sin(frequency[0] * lat_grid + phase[0]) * np.cos(frequency[1] * lon_grid + phase[1])
+
+  field = (field - field.min()) / (field.max() - field.min())
+  return (low + field * (high - low)).astype(np.float32)
+
+def load_synthetic_source(variables):
+  import xarray as xr
+
+  lats, lons = synthetic_grid()
+  ds = xr.Dataset(
+    {variable: (('lat', 'lon'), synthetic_field(variable, lats, lons, seed)) for seed, variable in enumerate(variables)},
+    coords={'lat': lats, 'lon': lons}
+  )
+  return prepare_tile_source(ds, variables, ZOOMS)
+
+def load_netcdf_source(path, variables):
+  from read_net_cdf import read_weather
+
+  ds = asyncio.run(read_weather(path))
+  return prepare_tile_source(ds, variables, ZOOMS)
+
+def sample_tiles(zoom, count, seed=0):
+  rng = np.random.default_rng(seed + zoom)
+  tile_ranges = get_tile_ranges_for_zoom(zoom)
+  xs = rng.integers(tile_ranges['x_min'], tile_ranges['x_max'] + 1, size=count)
+  ys = rng.integers(tile_ranges['y_min'], tile_ranges['y_max'] + 1, size=count)
+  return list(zip(xs.tolist(), ys.tolist()))
+
+def run_benchmark(source, variables, tiles_per_zoom, formats):
+  results = []
+
+  for zoom in ZOOMS:
+    tiles = []
+    for x, y in sample_tiles(zoom, tiles_per_zoom):
+      resampling = get_tile_resampling(source['index'], zoom, x, y)
+      if resampling is not None:
+        tiles.append(resampling)
+
+    for variable in variables:
+      arrays = [resample_tile(source['values'][variable], resampling) for resampling in tiles]
+      arrays = [arr for arr in arrays if not np.isnan(arr).all()]
+
+      if not arrays:
+        continue
+
+      for tile_format in formats:
+        encoded_bytes = 0
+        start = time.perf_counter()
+
+        for arr in arrays:
+          encoded_bytes += len(encode_tile(arr, variable, tile_format))
+
+        elapsed = time.perf_counter() - start
+        results.append({
+          'variable': variable,
+          'zoom': zoom,
+          'format': tile_format,
+          'tiles': len(arrays),
+          'bytes_per_tile': encoded_bytes / len(arrays),
+          'encode_ms_per_tile': elapsed * 1000 / len(arrays)
+        })
+
+  return results
+
+def print_results(results, formats):
+  print(f"{'variable':<8} {'zoom':>4} " + ' '.join(f"{tile_format + ' KB':>10} {tile_format + ' ms':>10}" for tile_format in formats))
+
+  rows = {}
+  for result in results:
+    rows.setdefault((result['variable'], result['zoom']), {})[result['format']] = result
+
+  for (variable, zoom), by_format in rows.items():
+    cells = ' '.join(
+      f"{by_format[tile_format]['bytes_per_tile'] / 1024:>10.1f} {by_format[tile_format]['encode_ms_per_tile']:>10.2f}"
+      for tile_format in formats
+    )
+    print(f"{variable:<8} {zoom:>4} {cells}")
+
+  print()
+  for tile_format in formats:
+    matching = [result for result in results if result['format'] == tile_format]
+    tiles = sum(result['tiles'] for result in matching)
+    total_bytes = sum(result['bytes_per_tile'] * result['tiles'] for result in matching)
+    total_ms = sum(result['encode_ms_per_tile'] * result['tiles'] for result in matching)
+    print(f"{tile_format:<5} {total_bytes / tiles / 1024:8.1f} KB/tile {total_ms / tiles:8.2f} ms/tile")
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--netcdf', help='HRRR NetCDF file to sample instead of synthetic fields')
+  parser.add_argument('--tiles-per-zoom', type=int, default=20)
+  parser.add_argument('--variables', default=','.join(COLOR_SCALES))
+  parser.add_argument('--formats', default=','.join(TILE_ENCODINGS))
+  parser.add_argument('--json', help='Also write the raw results to this file')
+  args = parser.parse_args()
+
+  variables = args.variables.split(',')
+  formats = args.formats.split(',')
+
+  if args.netcdf:
+    source = load_netcdf_source(args.netcdf, variables)
+  else:
+    source = load_synthetic_source(variables)
+
+  results = run_benchmark(source, variables, args.tiles_per_zoom, formats)
+  print_results(results, formats)
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+  main()
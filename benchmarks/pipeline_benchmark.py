@@ -0,0 +1,420 @@
+"""Tiles per second, time per stage, peak memory and bytes out for the whole pipeline, without AWS.
+
+Run from the repository root:
+
+  python -m benchmarks.pipeline_benchmark [--netcdf PATH] [--variables wspd,tmp]
+      [--time-budget 900] [--put-latency-ms 20] [--put-capacity 16]
+      [--env TILE_BUILD_MODE=pyramid]
+
+Without --netcdf a synthetic HRRR-shaped file (time, lat and lon dims, all 15
+variables, no data outside a CONUS-like outline) is written first. S3 and the
+tileStatus/tile_progress collections are in-process stand-ins and the Lambda
+context counts down from --time-budget seconds, so the run goes through
+download, read, render, upload and checkpointing as process_all_variables
+does in Lambda. --put-capacity answers puts beyond that many in flight with
+SlowDown, as a saturated S3 prefix would. --env sets the pipeline's
+configuration variables before it is imported.
+
+Stage times come from the pipeline's own metrics and are summed over the
+render threads, so with several workers they add up to more than the
+wall-clock time. The startup section imports the Lambda entry points in a
+fresh interpreter with -X importtime to show what a cold start pays for.
+--cost-model writes the measured seconds per tile for
+shard_planner's SHARD_COST_MODEL.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+VARIABLES = ['wspd', 'tmp', 'rh', 'MC1', 'MC10', 'MC100', 'MC1000', 'MCWOOD', 'MCHERB', 'KBDI', 'IC', 'ERC', 'BI', 'SC', 'GSI']
+TIMESTAMP = '2026/10/17/00'
+
+# Entry points whose cold import is profiled: the handler the control-plane
+# actions load, and what a processing action adds on top of it
+STARTUP_MODULES = ['lambda_function', 'tile_processor']
+
+# Stages in pipeline order for the report; clip is slicing the tile's rows
+# and columns out of the resampling index, reproject is resampling onto them
+STAGE_ORDER = [
+  'download', 'open', 'sample', 'index', 'clip', 'reproject', 'reduce', 'colorize', 'encode',
+  'encode_values', 'upload_backpressure', 'upload_wait', 'put', 'zoom', 'pyramid'
+]
+
+def write_synthetic_netcdf(path, variables=VARIABLES, resolution=0.03):
+  """A NetCDF file shaped like the HRRR output: (time, lat, lon) fields on a regular grid"""
+  import xarray as xr
+  from benchmarks.encoding_benchmark import synthetic_field
+
+  lats = np.arange(21.0, 53.0, resolution)
+  lons = np.arange(-134.0, -60.0, resolution)
+
+  lat_grid, lon_grid = np.meshgrid(lats, lons, indexing='ij')
+  inside = (lon_grid > -125 + 3 * np.sin(lat_grid)) & (lon_grid < -67) & (lat_grid > 24) & (lat_grid < 50)
+
+  ds = xr.Dataset(
+    {
+      variable: (('time', 'lat', 'lon'), np.where(inside, synthetic_field(variable, lats, lons, seed), np.nan)[None].astype(np.float32))
+      for seed, variable in enumerate(variables)
+    },
+    coords={'time': [0], 'lat': lats, 'lon': lons}
+  )
+  ds.to_netcdf(path)
+
+  return path
+
+class MemoryS3:
+  """The S3 calls the pipeline makes, against a dict. Every .nc key downloads netcdf_path."""
+
+  def __init__(self, netcdf_path, put_latency=0.0, put_capacity=0):
+    self.netcdf_path = netcdf_path
+    self.put_latency = put_latency
+    self.put_capacity = put_capacity
+    self.puts_in_flight = 0
+    self.objects = {}
+    self.uploads = {}
+    self.lock = threading.Lock()
+
+  def put_object(self, Bucket, Key, Body, **kwargs):
+    with self.lock:
+      if self.put_capacity and self.puts_in_flight >= self.put_capacity:
+        raise self.slow_down('PutObject')
+      self.puts_in_flight += 1
+
+    try:
+      if self.put_latency:
+        time.sleep(self.put_latency)
+    finally:
+      with self.lock:
+        self.puts_in_flight -= 1
+
+    with self.lock:
+      self.objects[Key] = bytes(Body)
+
+  def get_object(self, Bucket, Key, **kwargs):
+    if Key not in self.objects:
+      raise self.missing('GetObject')
+    return {'Body': io.BytesIO(self.objects[Key])}
+
+  def head_object(self, Bucket, Key):
+    if Key not in self.objects and not Key.endswith('.nc'):
+      raise self.missing('HeadObject', '404')
+    return {}
+
+  def copy_object(self, Bucket, Key, CopySource, **kwargs):
+    self.put_object(Bucket, Key, self.objects[CopySource['Key']])
+
+  def download_file(self, Bucket, Key, Filename):
+    shutil.copyfile(self.netcdf_path, Filename)
+
+  def create_multipart_upload(self, Bucket, Key, **kwargs):
+    self.uploads[Key] = {}
+    return {'UploadId': Key}
+
+  def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+    self.put_object(Bucket, f"{Key}#part{PartNumber}", Body)
+    self.uploads[Key][PartNumber] = self.objects.pop(f"{Key}#part{PartNumber}")
+    return {'ETag': f"part{PartNumber}"}
+
+  def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+    parts = self.uploads.pop(Key)
+    self.objects[Key] = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+
+  def abort_multipart_upload(self, Bucket, Key, UploadId):
+    self.uploads.pop(Key, None)
+
+  @staticmethod
+  def missing(operation, code='NoSuchKey'):
+    from botocore.exceptions import ClientError
+    return ClientError({'Error': {'Code': code}}, operation)
+
+  @staticmethod
+  def slow_down(operation):
+    from botocore.exceptions import ClientError
+    return ClientError({'Error': {'Code': 'SlowDown'}, 'ResponseMetadata': {'HTTPStatusCode': 503}}, operation)
+
+class MemoryCollection:
+  """find_one, insert_one and update_one ($set, $unset, upsert) on equality queries"""
+
+  def __init__(self):
+    self.documents = []
+    self.updates = 0
+
+  def find_one(self, query, *args, **kwargs):
+    for document in self.documents:
+      if self.matches(document, query):
+        return dict(document)
+    return None
+
+  def insert_one(self, document):
+    self.documents.append(dict(document))
+
+  def update_one(self, query, update, upsert=False):
+    self.updates += 1
+
+    for document in self.documents:
+      if self.matches(document, query):
+        break
+    else:
+      if not upsert:
+        return
+      document = dict(query)
+      self.documents.append(document)
+
+    document.update(update.get('$set', {}))
+    for field in update.get('$unset', {}):
+      document.pop(field, None)
+
+  @staticmethod
+  def matches(document, query):
+    return all(document.get(field) == value for field, value in query.items())
+
+class MemoryDatabase:
+  def __init__(self):
+    self.collections = defaultdict(MemoryCollection)
+
+  def __getattr__(self, name):
+    if name.startswith('__'):
+      raise AttributeError(name)
+    return self.collections[name]
+
+  def __getitem__(self, name):
+    return self.collections[name]
+
+class BenchmarkContext:
+  """Lambda context whose remaining time counts down from the budget"""
+
+  def __init__(self, seconds):
+    self.deadline = time.monotonic() + seconds
+
+  def get_remaining_time_in_millis(self):
+    return int((self.deadline - time.monotonic()) * 1000)
+
+def install_services(s3, database):
+  from s3_and_database_access import use_clients
+
+  use_clients(s3_client=s3, db=database)
+
+def profile_startup(module, top=12):
+  """Cold import of module in a fresh interpreter, with the slowest modules it pulled in"""
+  start = time.perf_counter()
+  completed = subprocess.run(
+    [sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+    capture_output=True, text=True, check=True
+  )
+  seconds = time.perf_counter() - start
+
+  # import time: self [us] | cumulative | imported package, nested by indentation
+  imports = []
+  for line in completed.stderr.splitlines():
+    if not line.startswith('import time:') or 'imported package' in line:
+      continue
+
+    self_us, cumulative_us, name = line[len('import time:'):].split('|')
+    if '.' not in name.strip():
+      imports.append({
+        'module': name.strip(),
+        'depth': (len(name) - len(name.lstrip()) - 1) // 2,
+        'self_ms': int(self_us) / 1000,
+        'cumulative_ms': int(cumulative_us) / 1000
+      })
+
+  # Children are printed before their parent, so the module's imports are the
+  # lines since the previous top-level one (the interpreter's own site imports)
+  end = next(index for index, entry in enumerate(imports) if entry['module'] == module and entry['depth'] == 0)
+  begin = max((index + 1 for index in range(end) if imports[index]['depth'] == 0), default=0)
+
+  return {
+    'process_seconds': seconds,
+    'import_ms': imports[end]['cumulative_ms'],
+    'modules': sorted(imports[begin:end], key=lambda entry: entry['cumulative_ms'], reverse=True)[:top]
+  }
+
+def parse_tile_key(key):
+  """(zoom, kind) of an uploaded tile key, or None for other objects"""
+  parts = key.split('/')
+  name = parts[-1]
+
+  if name.count('_') != 2 or not name[0].isdigit():
+    return None
+
+  zoom = int(name.split('_')[0])
+  kind = 'values' if parts[-3] == 'values' else 'stack' if '/stack_' in key else 'tiles'
+
+  return zoom, kind
+
+def summarize_outputs(objects):
+  per_zoom = defaultdict(lambda: {'objects': 0, 'bytes': 0})
+  other = {'objects': 0, 'bytes': 0}
+
+  for key, body in objects.items():
+    parsed = parse_tile_key(key)
+    entry = per_zoom[parsed] if parsed else other
+    entry['objects'] += 1
+    entry['bytes'] += len(body)
+
+  return per_zoom, other
+
+def stage_position(stage):
+  return STAGE_ORDER.index(stage) if stage in STAGE_ORDER else len(STAGE_ORDER)
+
+def run_pipeline(args, netcdf_path):
+  import tile_processor
+  from tile_generator import upload_limiter
+  from metrics import reset_metrics, collect_metrics, read_peak_rss
+
+  s3 = MemoryS3(netcdf_path, args.put_latency_ms / 1000, args.put_capacity)
+  database = MemoryDatabase()
+  install_services(s3, database)
+
+  variables = args.variables.split(',')
+  context = BenchmarkContext(args.time_budget)
+
+  rss_before = read_peak_rss()
+  reset_metrics()
+  start = time.perf_counter()
+  result = asyncio.run(tile_processor.process_all_variables(
+    variables, args.forecast_hour, context, override=TIMESTAMP
+  ))
+  elapsed = time.perf_counter() - start
+  metrics = collect_metrics()
+
+  zoom_seconds = {
+    entry['zoom']: entry['total_ms'] / 1000 for entry in metrics['stages_by_label'] if entry['stage'] == 'zoom'
+  }
+  per_zoom, other = summarize_outputs(s3.objects)
+  tiles_generated = result.get('tiles_generated', 0)
+
+  return {
+    'status': result.get('status'),
+    'variables': variables,
+    'seconds': elapsed,
+    'tiles_generated': tiles_generated,
+    'tiles_per_second': tiles_generated / elapsed if elapsed else 0.0,
+    'failed_uploads': result.get('failed_uploads', 0),
+    'progress_writes': database.tile_progress.updates,
+    'upload_concurrency': upload_limiter['limit'],
+    'peak_rss_bytes': metrics['memory']['peak_rss_bytes'],
+    'rss_before_bytes': rss_before,
+    'stages': {
+      stage: metrics['stages'][stage]
+      for stage in sorted(metrics['stages'], key=lambda stage: (stage_position(stage), stage))
+    },
+    'counters': metrics['counters'],
+    'zooms': {
+      f"{zoom}/{kind}": {
+        **outputs,
+        'seconds': zoom_seconds.get(zoom, 0.0),
+        'peak_rss_bytes': metrics['memory']['windows'].get(str(zoom), 0)
+      }
+      for (zoom, kind), outputs in sorted(per_zoom.items())
+    },
+    'other_objects': other,
+    'metrics': metrics
+  }
+
+def print_report(report):
+  print(f"status {report['status']}: {report['tiles_generated']} tiles in {report['seconds']:.1f}s, "
+        f"{report['tiles_per_second']:.1f} tiles/s, {report['failed_uploads']} failed uploads, "
+        f"{report['progress_writes']} progress writes, upload concurrency {report['upload_concurrency']:.1f}")
+  print(f"peak RSS {report['peak_rss_bytes'] / 2**20:.0f} MB (before run {report['rss_before_bytes'] / 2**20:.0f} MB)")
+
+  print()
+  print(f"{'stage':<20} {'calls':>8} {'total s':>9} {'mean ms':>9} {'p95 ms':>9} {'max ms':>9}")
+  for stage, timing in report['stages'].items():
+    print(f"{stage:<20} {timing['count']:>8} {timing['total_ms'] / 1000:>9.2f} {timing['mean_ms']:>9.3f} "
+          f"{timing['p95_ms']:>9} {timing['max_ms']:>9.1f}")
+
+  print()
+  print(' '.join(f"{name} {amount}" for name, amount in report['counters'].items()) or 'no counters')
+
+  print()
+  print(f"{'zoom':<10} {'objects':>8} {'MB out':>9} {'KB/obj':>9} {'seconds':>9} {'obj/s':>9} {'peak MB':>9}")
+  for label, zoom in report['zooms'].items():
+    rate = zoom['objects'] / zoom['seconds'] if zoom['seconds'] else 0.0
+    print(f"{label:<10} {zoom['objects']:>8} {zoom['bytes'] / 2**20:>9.2f} {zoom['bytes'] / max(zoom['objects'], 1) / 1024:>9.1f} "
+          f"{zoom['seconds']:>9.1f} {rate:>9.1f} {zoom['peak_rss_bytes'] / 2**20:>9.0f}")
+
+  other = report['other_objects']
+  print(f"{'other':<10} {other['objects']:>8} {other['bytes'] / 2**20:>9.2f}")
+
+  for module, startup in report.get('startup', {}).items():
+    print()
+    print(f"import {module}: {startup['import_ms']:.0f} ms ({startup['process_seconds']:.2f}s with interpreter start)")
+    print(f"  {'module':<24} {'depth':>6} {'cumulative ms':>14} {'self ms':>9}")
+    for entry in startup['modules']:
+      print(f"  {entry['module']:<24} {entry['depth']:>6} {entry['cumulative_ms']:>14.1f} {entry['self_ms']:>9.1f}")
+
+def build_cost_model(report):
+  """Measured seconds per tile and per shard in shard_planner's cost model format"""
+  zoom_seconds = {}
+  for label, zoom in report['zooms'].items():
+    zoom_level, kind = label.split('/')
+    if kind == 'tiles' and zoom['seconds'] and zoom['objects']:
+      zoom_seconds[zoom_level] = zoom['seconds'] / zoom['objects']
+
+  overall = report['seconds'] / max(report['tiles_generated'], 1)
+  render_seconds = sum(zoom['seconds'] for zoom in report['zooms'].values() if zoom['seconds'])
+
+  return {
+    'tile_seconds': {'default': {'default': overall, **zoom_seconds} if zoom_seconds else overall},
+    'shard_seconds': max(report['seconds'] - render_seconds, 0.0)
+  }
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--netcdf', help='HRRR NetCDF file to render instead of a synthetic one')
+  parser.add_argument('--resolution', type=float, default=0.03, help='Grid spacing of the synthetic file, degrees')
+  parser.add_argument('--variables', default=','.join(VARIABLES))
+  parser.add_argument('--forecast-hour', default='01')
+  parser.add_argument('--time-budget', type=float, default=900, help='Seconds on the fake Lambda context')
+  parser.add_argument('--put-latency-ms', type=float, default=0, help='Added to every S3 put')
+  parser.add_argument('--put-capacity', type=int, default=0, help='Puts in flight beyond which S3 answers SlowDown')
+  parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='Pipeline configuration')
+  parser.add_argument('--json', help='Also write the report to this file')
+  parser.add_argument('--cost-model', help='Write a shard_planner cost model to this file')
+  parser.add_argument('--no-startup', action='store_true', help='Skip the cold import profile')
+  args = parser.parse_args()
+
+  # Configuration is read when the pipeline modules are imported
+  os.environ.setdefault('RENDER_EXECUTOR', 'thread')
+  for setting in args.env:
+    name, _, value = setting.partition('=')
+    os.environ[name] = value
+
+  with tempfile.TemporaryDirectory(prefix='pipeline_benchmark_') as scratch:
+    os.environ.setdefault('TILE_INDEX_DIR', os.path.join(scratch, 'tile_index'))
+    netcdf_path = args.netcdf
+
+    if not netcdf_path:
+      start = time.perf_counter()
+      netcdf_path = write_synthetic_netcdf(os.path.join(scratch, 'synthetic.nc'), resolution=args.resolution)
+      print(f"Wrote synthetic NetCDF in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    report = run_pipeline(args, netcdf_path)
+
+  if not args.no_startup:
+    report['startup'] = {module: profile_startup(module) for module in STARTUP_MODULES}
+
+  print_report(report)
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(report, f, indent=2)
+
+  if args.cost_model:
+    with open(args.cost_model, 'w') as f:
+      json.dump(build_cost_model(report), f, indent=2)
+
+if __name__ == '__main__':
+  main()
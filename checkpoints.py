@@ -0,0 +1,116 @@
+import asyncio
+import copy
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from s3_and_database_access import get_db
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CHECKPOINT_INTERVAL = float(os.getenv('CHECKPOINT_INTERVAL', '5'))
+
+# The tile_progress fields that say how far generation got
+PROGRESS_FIELDS = ('completed_zooms', 'current_zoom', 'last_x', 'last_y', 'last_block')
+
+def create_checkpointer(progress):
+  """Advance progress only past render jobs whose uploads are all confirmed.
+
+  Jobs are tracked in submission order. A job's checkpoint is applied once
+  it and every earlier job are done, and progress is written to Mongo at
+  most every CHECKPOINT_INTERVAL seconds. A failed render or upload holds
+  progress at the job before it, so the next invocation redoes those tiles.
+  Writes run on a thread, one at a time, so the upload loop never waits on
+  Mongo; flush_checkpoint waits for the last one.
+  """
+  return {
+    'progress': progress, 'jobs': deque(), 'failed': False, 'dirty': False,
+    'saved_at': time.monotonic(), 'writing': None
+  }
+
+def track_job(checkpointer, checkpoint):
+  job = {'checkpoint': checkpoint, 'uploads': 0, 'sealed': False, 'failed': False}
+  checkpointer['jobs'].append(job)
+  return job
+
+def seal_job(checkpointer, job):
+  """Every upload of the job has been queued"""
+  job['sealed'] = True
+  advance_checkpoints(checkpointer)
+
+def fail_job(checkpointer, job):
+  """The job's tiles were not all produced: hold progress before it and report the run incomplete"""
+  job['failed'] = checkpointer['failed'] = True
+
+def finish_job_upload(checkpointer, job, succeeded):
+  job['uploads'] -= 1
+
+  if not succeeded:
+    fail_job(checkpointer, job)
+
+  advance_checkpoints(checkpointer)
+
+def advance_checkpoints(checkpointer):
+  jobs = checkpointer['jobs']
+
+  while jobs and jobs[0]['sealed'] and not jobs[0]['uploads'] and not jobs[0]['failed']:
+    checkpointer['progress'].update(jobs.popleft()['checkpoint'])
+    checkpointer['dirty'] = True
+
+  save_checkpoint(checkpointer)
+
+def save_checkpoint(checkpointer):
+  """Start writing progress in the background if it changed, the interval has passed
+  and the previous write is done"""
+  if not checkpointer['dirty'] or checkpointer['writing']:
+    return
+
+  if time.monotonic() - checkpointer['saved_at'] < CHECKPOINT_INTERVAL:
+    return
+
+  start_checkpoint_write(checkpointer)
+
+def start_checkpoint_write(checkpointer):
+  # A copy, since the loop keeps advancing progress while the thread writes it
+  snapshot = copy.deepcopy(checkpointer['progress'])
+  checkpointer['dirty'] = False
+  checkpointer['saved_at'] = time.monotonic()
+
+  writing = checkpointer['writing'] = asyncio.get_running_loop().run_in_executor(None, save_progress, snapshot)
+  writing.add_done_callback(lambda future: finish_checkpoint_write(checkpointer, future))
+
+def finish_checkpoint_write(checkpointer, future):
+  checkpointer['writing'] = None
+
+  if future.exception():
+    logger.warning(f"Could not save progress checkpoint: {future.exception()}")
+    checkpointer['dirty'] = True
+
+async def flush_checkpoint(checkpointer):
+  """Wait for the write in progress, then write whatever changed since"""
+  if checkpointer['writing']:
+    await asyncio.wait([checkpointer['writing']])
+
+  if checkpointer['dirty']:
+    start_checkpoint_write(checkpointer)
+    await asyncio.wait([checkpointer['writing']])
+
+async def write_progress(progress):
+  """save_progress on a thread, off the event loop"""
+  await asyncio.get_running_loop().run_in_executor(None, save_progress, progress)
+
+def save_progress(progress):
+  fields = {field: progress[field] for field in PROGRESS_FIELDS if field in progress}
+  cleared = {field: '' for field in PROGRESS_FIELDS if field not in progress}
+
+  update = {'$set': {**fields, 'updated_at': datetime.now(timezone.utc)}}
+  if cleared:
+    update['$unset'] = cleared
+
+  get_db().tile_progress.update_one(
+    {'timestamp': progress['timestamp'], 'variable': progress['variable'], 'forecast_hour': progress.get('forecast_hour')},
+    update
+  )
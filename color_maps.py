@@ -1,17 +1,22 @@
 import numpy as np
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-        
-def apply_wind_colors(arr):
-  rgba = np.zeros((*arr.shape, 4), dtype=np.uint8)
-  breakpoints = np.array([0, 0.5, 1, 2, 3, 4.5, 6, 7.5, 9, 10.5, 12, 13.5, 15, 17.5, 20, 999])
-  colors = np.array([
+
+LUT_SIZE = 65536
+
+# Stepped scales: a value gets the color of the last breakpoint it reaches.
+# Ramp scales: red rises and green falls linearly from 0 to max_value.
+WIND_SCALE = {
+  'type': 'steps',
+  'breakpoints': [0, 0.5, 1, 2, 3, 4.5, 6, 7.5, 9, 10.5, 12, 13.5, 15, 17.5, 20, 999],
+  'colors': [
     [0, 0, 0, 0],           # 0
     [37, 72, 113, 90],      # 0.5
     [74, 144, 226, 180],    # 1
-    [77, 172, 173, 190],    # 2  
+    [77, 172, 173, 190],    # 2
     [80, 200, 120, 200],    # 3
     [167, 217, 89, 210],    # 4.5
     [255, 235, 59, 220],    # 6
@@ -24,24 +29,13 @@ def apply_wind_colors(arr):
     [94, 36, 104, 255],     # 17.5
     [33, 33, 33, 255],      # 20
     [33, 33, 33, 255]       # 999
-  ])
-  
-  indices = np.digitize(arr, breakpoints) - 1
-  indices = np.clip(indices, 0, len(colors) - 1)
-  
-  rgba[:,:,0] = colors[indices, 0]
-  rgba[:,:,1] = colors[indices, 1]
-  rgba[:,:,2] = colors[indices, 2]
-  rgba[:,:,3] = colors[indices, 3]
-  
-  return rgba
+  ]
+}
 
-def apply_temperature_colors(arr):
-  rgba = np.zeros((*arr.shape, 4), dtype=np.uint8)
-  
-  breakpoints = np.array([0, 20, 32, 40, 50, 55, 60, 65, 70, 75, 80, 82, 85, 88, 90, 95, 100, 110, 999])
-  
-  colors = np.array([
+TEMPERATURE_SCALE = {
+  'type': 'steps',
+  'breakpoints': [0, 20, 32, 40, 50, 55, 60, 65, 70, 75, 80, 82, 85, 88, 90, 95, 100, 110, 999],
+  'colors': [
     [4, 26, 64, 255],      # < 20°F: Deepest blue (arctic)
     [8, 48, 107, 255],     # 20-32°F: Very dark blue (bitter cold)
     [25, 57, 138, 255],    # 32-40°F: Dark blue (freezing)
@@ -61,26 +55,13 @@ def apply_temperature_colors(arr):
     [244, 109, 67, 255],   # 100-110°F: Red-orange (dangerous)
     [215, 48, 39, 255],    # 110°F+: Red (extreme danger)
     [165, 0, 38, 255]      # Fallback: Dark red
-  ])
-  
-  indices = np.digitize(arr, breakpoints) - 1
-  indices = np.clip(indices, 0, len(colors) - 1)
-
-  rgba[:,:,0] = colors[indices, 0]
-  rgba[:,:,1] = colors[indices, 1]
-  rgba[:,:,2] = colors[indices, 2]
-  rgba[:,:,3] = colors[indices, 3]
-  
-  return rgba
+  ]
+}
 
-def apply_humidity_colors(arr):
-  rgba = np.zeros((*arr.shape, 4), dtype=np.uint8)
-  
-  arr_clean = np.where(np.isnan(arr), 0, arr)
-  
-  breakpoints = np.array([0, 5, 10, 15, 20, 25, 30, 40, 50, 55, 60, 65, 70, 75, 80, 85, 90, 95, 100])
-  
-  colors = np.array([
+HUMIDITY_SCALE = {
+  'type': 'steps',
+  'breakpoints': [0, 5, 10, 15, 20, 25, 30, 40, 50, 55, 60, 65, 70, 75, 80, 85, 90, 95, 100],
+  'colors': [
     [101, 37, 6, 255],     # 0-5%: Deep brown (desert dry)
     [140, 81, 10, 255],    # 5-10%: Brown (very dry)
     [166, 108, 27, 250],   # 10-15%: Dark tan (dry)
@@ -100,109 +81,238 @@ def apply_humidity_colors(arr):
     [25, 120, 115, 250],   # 90-95%: Deep teal (extremely humid)
     [1, 102, 94, 255],     # 95-100%: Very dark teal (saturated)
     [0, 60, 48, 255]       # 100%: Darkest teal (max humidity)
-  ])
-  
-  indices = np.digitize(arr_clean, breakpoints) - 1
-  indices = np.clip(indices, 0, len(colors) - 1)
-
-  rgba[:,:,0] = colors[indices, 0]
-  rgba[:,:,1] = colors[indices, 1]
-  rgba[:,:,2] = colors[indices, 2]
-  rgba[:,:,3] = colors[indices, 3]
-  
-  return rgba
+  ]
+}
+
+GSI_SCALE = {
+  'type': 'steps',
+  # Breakpoints are applied to the value divided by 6, as they always have been
+  'breakpoints': [0 * 6, 0.2 * 6, 0.4 * 6, 0.6 * 6, 0.8 * 6, 0.9 * 6, 1 * 6],
+  'colors': [
+    [139, 69, 19, 255],
+    [205, 133, 63, 240],
+    [245, 222, 179, 220],
+    [255, 250, 205, 200],
+    [173, 255, 47, 220],
+    [50, 205, 50, 240],
+    [0, 100, 0, 255]
+  ]
+}
+
+def ramp_scale(max_value):
+  return {'type': 'ramp', 'max_value': max_value}
+
+def grayscale_scale(max_value):
+  return {'type': 'grayscale', 'max_value': max_value}
+
+COLOR_SCALES = {
+  'wspd': WIND_SCALE,
+  'tmp': TEMPERATURE_SCALE,
+  'rh': HUMIDITY_SCALE,
+  'MC1': ramp_scale(40),
+  'MC10': ramp_scale(40),
+  'MC100': ramp_scale(40),
+  'MC1000': ramp_scale(40),
+  'MCWOOD': ramp_scale(200),
+  'MCHERB': ramp_scale(250),
+  'KBDI': ramp_scale(700),
+  'IC': ramp_scale(100),
+  'ERC': ramp_scale(100),
+  'BI': ramp_scale(200),
+  'SC': ramp_scale(100),
+  'GSI': GSI_SCALE
+}
+
+DEFAULT_SCALE = grayscale_scale(100)
+
+_compiled_colormaps = {}
+_buffers = threading.local()
+
+def pack_rgba(colors):
+  colors = np.asarray(colors, dtype=np.uint32)
+  return (colors[:, 0] | colors[:, 1] << 8 | colors[:, 2] << 16 | colors[:, 3] << 24).astype('<u4')
+
+def compile_color_scale(scale):
+  """Precompute a quantized value -> palette index LUT and a packed RGBA palette"""
+  if scale['type'] == 'steps':
+    breakpoints = np.asarray(scale['breakpoints'], dtype=np.float64)
+    colors = np.asarray(scale['colors'], dtype=np.uint8)
+    low = breakpoints[0]
+    bins_per_unit = find_breakpoint_resolution(breakpoints)
+    divisor = None
+  else:
+    low = 0.0
+    levels = np.arange(256, dtype=np.uint8)
+    # One bin per output level, and the ratio is rounded as it was per pixel,
+    # so floor(ratio * 255) is reproduced exactly
+    bins_per_unit = 255
+    divisor = scale['max_value']
+    if scale['type'] == 'ramp':
+      colors = compile_ramp_colors()
+    else:
+      colors = np.stack([levels, levels, levels, np.full(256, 255, np.uint8)], axis=1)
+
+  if scale['type'] == 'steps':
+    breakpoint_bins = (breakpoints - low) * bins_per_unit
+    if float(bins_per_unit).is_integer():
+      breakpoint_bins = np.round(breakpoint_bins)
+
+    lut_size = int(np.ceil(breakpoint_bins[-1])) + 1
+    lut = np.clip(np.digitize(np.arange(lut_size), breakpoint_bins) - 1, 0, len(colors) - 1)
+  else:
+    lut = np.arange(256)
+
+  return {
+    'low': low,
+    'divisor': divisor,
+    'scale': bins_per_unit,
+    'max_bin': len(lut) - 1,
+    # Missing values have always been drawn as if they were 0
+    'nan_bin': float(np.clip((0 - low) * bins_per_unit, 0, len(lut) - 1)),
+    'lut': lut.astype(np.uint8),
+    'palette': pack_rgba(colors),
+    'colors': colors
+  }
+
+def compile_ramp_colors():
+  """The old per-pixel ramp formulas, evaluated once per bin
+
+  Green is floor((1 - ratio) * 255), one below 255 - red everywhere in a bin
+  but its lower edge, so each bin takes its colour from a ratio inside it.
+  The end bins use 0, where missing values land, and 1, where values at or
+  above the maximum are clamped.
+  """
+  ratio = ((np.arange(256) + 0.5) / 255).astype(np.float32)
+  ratio[0], ratio[-1] = 0, 1
+
+  colors = np.zeros((256, 4), dtype=np.uint8)
+  colors[:, 0] = (ratio * 255).astype(np.uint8)
+  colors[:, 1] = ((1 - ratio) * 255).astype(np.uint8)
+  colors[:, 3] = 255
+
+  return colors
+
+def find_breakpoint_resolution(breakpoints):
+  """Bins per unit that put every breakpoint exactly on a bin edge, if the LUT stays small"""
+  offsets = breakpoints - breakpoints[0]
+  span = offsets[-1]
+
+  for bins_per_unit in range(1, 1001):
+    if span * bins_per_unit >= LUT_SIZE:
+      break
+
+    scaled = offsets * bins_per_unit
+    if np.allclose(scaled, np.round(scaled), atol=1e-6):
+      return bins_per_unit
+
+  return (LUT_SIZE - 1) / span
+
+def get_colormap(variable):
+  colormap = _compiled_colormaps.get(variable)
+
+  if colormap is None:
+    colormap = compile_color_scale(COLOR_SCALES.get(variable, DEFAULT_SCALE))
+    _compiled_colormaps[variable] = colormap
+
+  return colormap
+
+def get_colorize_buffers(shape):
+  buffers = getattr(_buffers, 'by_shape', None)
+  if buffers is None:
+    buffers = _buffers.by_shape = {}
+
+  if shape not in buffers:
+    buffers[shape] = {
+      'work': np.empty(shape, dtype=np.float32),
+      'quantized': np.empty(shape, dtype=np.uint16),
+      'index': np.empty(shape, dtype=np.uint8),
+      'rgba': np.empty(shape, dtype='<u4')
+    }
+
+  return buffers[shape]
+
+def colorize_indexed(arr, variable):
+  """Palette indices for a tile, written into a per-thread buffer reused for every tile"""
+  colormap = get_colormap(variable)
+  buffers = get_colorize_buffers(arr.shape)
+  work = buffers['work']
+
+  np.subtract(arr, colormap['low'], out=work, casting='unsafe')
+  if colormap['divisor'] is not None:
+    np.divide(work, colormap['divisor'], out=work)
+  np.multiply(work, colormap['scale'], out=work)
+  np.nan_to_num(work, copy=False, nan=colormap['nan_bin'])
+  np.clip(work, 0, colormap['max_bin'], out=work)
+  np.copyto(buffers['quantized'], work, casting='unsafe')
+  np.take(colormap['lut'], buffers['quantized'], out=buffers['index'], mode='clip')
+
+  return buffers['index'], colormap
+
+def colorize(arr, variable):
+  """RGBA tile as a view of a per-thread buffer, valid until the next call on this thread"""
+  index, colormap = colorize_indexed(arr, variable)
+  return index_to_rgba(index, colormap)
+
+def index_to_rgba(index, colormap):
+  rgba = get_colorize_buffers(index.shape)['rgba']
+
+  np.take(colormap['palette'], index, out=rgba, mode='clip')
+
+  return rgba.view(np.uint8).reshape(*index.shape, 4)
+
+def apply_color_scale(arr, scale_key, scale):
+  if scale_key not in _compiled_colormaps:
+    _compiled_colormaps[scale_key] = compile_color_scale(scale)
+
+  return colorize(arr, scale_key).copy()
+
+def apply_wind_colors(arr):
+  return colorize(arr, 'wspd').copy()
+
+def apply_temperature_colors(arr):
+  return colorize(arr, 'tmp').copy()
+
+def apply_humidity_colors(arr):
+  return colorize(arr, 'rh').copy()
 
 def apply_fuel_moisture_colors(arr, max_moisture=30):
-  rgba = np.zeros((*arr.shape, 4), dtype=np.uint8)
-  
-  arr_clean = np.where(np.isnan(arr), 0, arr)
-  ratio = np.clip(arr_clean / max_moisture, 0, 1)
-  
-  rgba[:,:,0] = (ratio * 255).astype(np.uint8)  # Red channel
-  rgba[:,:,1] = ((1 - ratio) * 255).astype(np.uint8)  # Green channel
-  rgba[:,:,2] = (0 * np.ones_like(ratio)).astype(np.uint8)  # Blue channel
-  rgba[:,:,3] = 255  # Alpha channel
-  
-  return rgba
+  return apply_color_scale(arr, ('ramp', max_moisture), ramp_scale(max_moisture))
 
 def apply_mc1_colors(arr):
-  return apply_fuel_moisture_colors(arr, max_moisture=40)
+  return colorize(arr, 'MC1').copy()
 
 def apply_mc10_colors(arr):
-  return apply_fuel_moisture_colors(arr, max_moisture=40)
+  return colorize(arr, 'MC10').copy()
 
 def apply_mc100_colors(arr):
-  return apply_fuel_moisture_colors(arr, max_moisture=40)
+  return colorize(arr, 'MC100').copy()
 
 def apply_mc1000_colors(arr):
-  return apply_fuel_moisture_colors(arr, max_moisture=40)
+  return colorize(arr, 'MC1000').copy()
 
 def apply_mc_wood_colors(arr):
-  return apply_fuel_moisture_colors(arr, max_moisture=200)
+  return colorize(arr, 'MCWOOD').copy()
 
 def apply_mc_herb_colors(arr):
-  return apply_fuel_moisture_colors(arr, max_moisture=250)
+  return colorize(arr, 'MCHERB').copy()
 
 def apply_fire_danger_colors(arr, max_value=100):
-  rgba = np.zeros((*arr.shape, 4), dtype=np.uint8)
-  
-  arr_clean = np.where(np.isnan(arr), 0, arr)
-  ratio = np.clip(arr_clean / max_value, 0, 1)
-  
-  rgba[:,:,0] = (ratio * 255).astype(np.uint8)  # Red channel
-  rgba[:,:,1] = ((1 - ratio) * 255).astype(np.uint8)  # Green channel
-  rgba[:,:,2] = (0 * np.ones_like(ratio)).astype(np.uint8)  # Blue channel
-  rgba[:,:,3] = 255  # Alpha channel
-  
-  return rgba
+  return apply_color_scale(arr, ('ramp', max_value), ramp_scale(max_value))
 
 def apply_ic_colors(arr):
-  return apply_fire_danger_colors(arr, max_value=100)
+  return colorize(arr, 'IC').copy()
 
 def apply_erc_colors(arr):
-  return apply_fire_danger_colors(arr, max_value=100)
+  return colorize(arr, 'ERC').copy()
 
 def apply_bi_colors(arr):
-  return apply_fire_danger_colors(arr, max_value=200)
+  return colorize(arr, 'BI').copy()
 
 def apply_sc_colors(arr):
-  return apply_fire_danger_colors(arr, max_value=100)
+  return colorize(arr, 'SC').copy()
 
 def apply_kbdi_colors(arr):
-  rgba = np.zeros((*arr.shape, 4), dtype=np.uint8)
-  
-  arr_clean = np.where(np.isnan(arr), 0, arr)
-  ratio = np.clip(arr_clean / 700.0, 0, 1)
-  
-  rgba[:,:,0] = (ratio * 255).astype(np.uint8)  # Red channel
-  rgba[:,:,1] = ((1 - ratio) * 255).astype(np.uint8)  # Green channel
-  rgba[:,:,2] = (0 * np.ones_like(ratio)).astype(np.uint8)  # Blue channel
-  rgba[:,:,3] = 255  # Alpha channel
-  
-  return rgba
+  return colorize(arr, 'KBDI').copy()
 
 def apply_gsi_colors(arr):
-  rgba = np.zeros((*arr.shape, 4), dtype=np.uint8)
-  
-  arr_clean = np.where(np.isnan(arr), 0, arr)
-  
-  breakpoints = np.array([0, 0.2, 0.4, 0.6, 0.8, 0.9, 1])
-  colors = np.array([
-    [139, 69, 19, 255],
-    [205, 133, 63, 240],
-    [245, 222, 179, 220],
-    [255, 250, 205, 200],
-    [173, 255, 47, 220],
-    [50, 205, 50, 240],
-    [0, 100, 0, 255]
-  ])
-  
-  indicies = np.digitize(arr_clean / (len(breakpoints) - 1), breakpoints) - 1
-  indicies = np.clip(indicies, 0, len(colors) - 1)
-  
-  rgba[:,:,0] = colors[indicies, 0]
-  rgba[:,:,1] = colors[indicies, 1]
-  rgba[:,:,2] = colors[indicies, 2]
-  rgba[:,:,3] = colors[indicies, 3]
-  
-  return rgba
\ No newline at end of file
+  return colorize(arr, 'GSI').copy()
@@ -0,0 +1,270 @@
+"""Adaptive limits on the number of S3 requests in flight.
+
+A limiter admits up to its limit of requests at once and moves the limit by
+AIMD: each success adds 1/limit, about one more slot per round of requests,
+and a throttling response (SlowDown, 503, timeouts) or a latency beyond
+LATENCY_TOLERANCE times the fastest recently seen multiplies it by
+DECREASE_FACTOR. Decreases come at most once per round trip, since the
+requests already in flight saw the same congestion, and the limit only grows
+from requests sent at it while others were queueing. A Retry-After on a
+throttled response holds every new request until it passes.
+
+  async with limited(limiter) as slot:
+    result = await ...
+    record_success(limiter, slot)
+
+A failed request is reported with record_failure, which returns the wait its
+Retry-After asked for. What a limiter has learned (its limit, latencies and
+any pause) lives for the life of the container, so a warm invocation starts
+at the limit the last one settled on. The requests in flight and waiting are
+counted per event loop: each invocation runs its own loop, and futures and
+timers die with theirs.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from metrics import count
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# adaptive: start at MAX_CONCURRENT_* and move between 1 and *_CONCURRENCY_LIMIT with AIMD
+# fixed: hold MAX_CONCURRENT_* requests in flight
+CONCURRENCY_CONTROL = os.getenv('CONCURRENCY_CONTROL', 'adaptive')
+MAX_CONCURRENT_UPLOADS = int(os.getenv('MAX_CONCURRENT_UPLOADS', '10'))
+UPLOAD_CONCURRENCY_LIMIT = int(os.getenv('UPLOAD_CONCURRENCY_LIMIT', '64'))
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv('MAX_CONCURRENT_DOWNLOADS', '2'))
+DOWNLOAD_CONCURRENCY_LIMIT = int(os.getenv('DOWNLOAD_CONCURRENCY_LIMIT', '8'))
+DECREASE_FACTOR = float(os.getenv('CONCURRENCY_DECREASE_FACTOR', '0.7'))
+LATENCY_TOLERANCE = float(os.getenv('CONCURRENCY_LATENCY_TOLERANCE', '2'))
+
+# Weight of each new latency sample in the average, and how far per second
+# the fastest-seen baseline may rise toward it. Latencies under
+# MIN_BASELINE are scheduling noise rather than S3, and never count as slow.
+LATENCY_SMOOTHING = 0.2
+BASELINE_DRIFT = 0.01
+MIN_BASELINE = 0.025
+MAX_RETRY_AFTER = 30
+
+RETRYABLE_ERROR_CODES = {
+  'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'RequestTimeout',
+  'RequestTimeTooSkewed', 'InternalError', 'ServiceUnavailable', '500', '503'
+}
+THROTTLE_ERROR_CODES = {
+  'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+  'RequestTimeout', 'ServiceUnavailable', '503'
+}
+# botocore errors raised without a response, matched by class name so that
+# importing this module doesn't import botocore. Timeouts also count as
+# throttling; any other exception without a response is not retried.
+THROTTLE_EXCEPTIONS = {'ReadTimeoutError', 'ConnectTimeoutError', 'ConnectionClosedError'}
+CONNECTION_EXCEPTIONS = THROTTLE_EXCEPTIONS | {'EndpointConnectionError', 'ConnectionError'}
+
+_limiters = {}
+
+def max_in_flight(initial, ceiling):
+  return max(initial, ceiling) if CONCURRENCY_CONTROL == 'adaptive' else initial
+
+def get_limiter(name, initial, ceiling, watch_latency=True):
+  """The named limiter, created on first use.
+
+  Without watch_latency only throttling lowers the limit, for requests like
+  whole-file downloads whose latency follows their size.
+  """
+  limiter = _limiters.get(name)
+
+  if limiter is None:
+    limiter = _limiters[name] = {
+      'name': name,
+      'limit': float(initial),
+      'ceiling': max_in_flight(initial, ceiling),
+      'adaptive': CONCURRENCY_CONTROL == 'adaptive',
+      'watch_latency': watch_latency,
+      'loops': {},
+      'paused_until': 0.0,
+      'last_decrease': 0.0,
+      'latency': None,
+      'baseline': None,
+      'baseline_at': 0.0
+    }
+
+  return limiter
+
+def get_slots(limiter):
+  return max(int(limiter['limit']), 1)
+
+def get_queue(limiter):
+  """The requests in flight and waiting in the running loop"""
+  loop = asyncio.get_running_loop()
+  queue = limiter['loops'].get(loop)
+
+  if queue is None:
+    # Whatever an earlier invocation left waiting or in flight went with its loop
+    for closed in [other for other in limiter['loops'] if other.is_closed()]:
+      del limiter['loops'][closed]
+
+    queue = limiter['loops'][loop] = {'loop': loop, 'in_flight': 0, 'waiters': deque()}
+
+  return queue
+
+@asynccontextmanager
+async def limited(limiter):
+  queue = await acquire(limiter)
+  slot = {'start': time.monotonic(), 'saturated': queue['in_flight'] >= get_slots(limiter)}
+
+  try:
+    yield slot
+  finally:
+    release(limiter, queue)
+
+async def acquire(limiter):
+  while (pause := limiter['paused_until'] - time.monotonic()) > 0:
+    await asyncio.sleep(pause)
+
+  queue = get_queue(limiter)
+
+  if queue['in_flight'] < get_slots(limiter) and not queue['waiters']:
+    queue['in_flight'] += 1
+    return queue
+
+  # Queue in arrival order; wake_waiters takes the slot on our behalf
+  waiter = asyncio.get_running_loop().create_future()
+  queue['waiters'].append(waiter)
+
+  try:
+    await waiter
+  except asyncio.CancelledError:
+    if waiter.done() and not waiter.cancelled():
+      release(limiter, queue)
+    elif waiter in queue['waiters']:
+      queue['waiters'].remove(waiter)
+    raise
+
+  return queue
+
+def release(limiter, queue):
+  queue['in_flight'] -= 1
+  wake_waiters(limiter, queue)
+
+def wake_waiters(limiter, queue):
+  if time.monotonic() < limiter['paused_until'] or queue['loop'].is_closed():
+    return
+
+  while queue['waiters'] and queue['in_flight'] < get_slots(limiter):
+    waiter = queue['waiters'].popleft()
+
+    if not waiter.done():
+      queue['in_flight'] += 1
+      waiter.set_result(None)
+
+def record_success(limiter, slot):
+  latency = time.monotonic() - slot['start']
+  previous = limiter['latency']
+  smoothed = limiter['latency'] = latency if previous is None else previous + LATENCY_SMOOTHING * (latency - previous)
+
+  if not limiter['adaptive']:
+    return
+
+  if limiter['watch_latency']:
+    now = time.monotonic()
+    baseline = limiter['baseline']
+
+    if baseline is None:
+      baseline = smoothed
+    else:
+      baseline = min(baseline * (1 + BASELINE_DRIFT) ** (now - limiter['baseline_at']), smoothed)
+
+    limiter['baseline'], limiter['baseline_at'] = baseline, now
+
+    if smoothed > LATENCY_TOLERANCE * max(baseline, MIN_BASELINE):
+      decrease_limit(limiter)
+      return
+
+  # Requests sent before the last decrease say nothing about the lowered limit
+  if slot['saturated'] and slot['start'] > limiter['last_decrease'] and limiter['limit'] < limiter['ceiling']:
+    limiter['limit'] = min(limiter['limit'] + 1 / limiter['limit'], limiter['ceiling'])
+    wake_waiters(limiter, get_queue(limiter))
+
+def record_failure(limiter, error):
+  """Lower the limit if error is throttling, and return the seconds its Retry-After asks for, if any"""
+  retry_after = get_retry_after(error)
+
+  if is_throttle_error(error):
+    count(f"{limiter['name']}_throttled")
+
+    if limiter['adaptive']:
+      decrease_limit(limiter)
+
+  if retry_after:
+    limiter['paused_until'] = max(limiter['paused_until'], time.monotonic() + retry_after)
+    asyncio.get_running_loop().call_later(retry_after, wake_waiters, limiter, get_queue(limiter))
+
+  return retry_after
+
+def decrease_limit(limiter):
+  now = time.monotonic()
+
+  if now - limiter['last_decrease'] < (limiter['latency'] or 1.0):
+    return
+
+  limiter['last_decrease'] = now
+  limiter['limit'] = max(limiter['limit'] * DECREASE_FACTOR, 1.0)
+  count(f"{limiter['name']}_concurrency_decreases")
+  logger.info(f"Lowered {limiter['name']} concurrency to {limiter['limit']:.1f}")
+
+def get_error_code(error):
+  """(code, HTTP status) of a botocore ClientError, or (None, 0)"""
+  response = getattr(error, 'response', None)
+
+  if not isinstance(response, dict):
+    return None, 0
+
+  return (
+    str(response.get('Error', {}).get('Code', '')),
+    response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+  )
+
+def is_error_type(error, names):
+  return any(cls.__name__ in names for cls in type(error).__mro__)
+
+def is_retryable_error(error):
+  error_code, status_code = get_error_code(error)
+
+  if error_code is None:
+    return is_error_type(error, CONNECTION_EXCEPTIONS)
+
+  return error_code in RETRYABLE_ERROR_CODES or status_code >= 500
+
+def is_throttle_error(error):
+  error_code, status_code = get_error_code(error)
+
+  if error_code is None:
+    return is_error_type(error, THROTTLE_EXCEPTIONS)
+
+  return error_code in THROTTLE_ERROR_CODES or status_code == 503
+
+def get_retry_after(error):
+  """Seconds from a Retry-After header given as seconds or an HTTP date, capped at MAX_RETRY_AFTER"""
+  response = getattr(error, 'response', None)
+  if not isinstance(response, dict):
+    return None
+
+  value = response.get('ResponseMetadata', {}).get('HTTPHeaders', {}).get('retry-after')
+  if not value:
+    return None
+
+  try:
+    seconds = float(value)
+  except ValueError:
+    try:
+      seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+    except (TypeError, ValueError):
+      return None
+
+  return min(max(seconds, 0.0), MAX_RETRY_AFTER)
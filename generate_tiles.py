@@ -1,104 +1,315 @@
 import numpy as np
-import mercantile
 import logging
 import io
+import os
+import hashlib
+import threading
 from PIL import Image
-from color_maps import (apply_wind_colors,
-  apply_temperature_colors, apply_humidity_colors, apply_mc1_colors, apply_mc10_colors,
-  apply_mc100_colors, apply_mc1000_colors, apply_mc_wood_colors, apply_mc_herb_colors,
-  apply_kbdi_colors, apply_ic_colors, apply_erc_colors, apply_bi_colors, apply_sc_colors,
-  apply_gsi_colors
-)
+from color_maps import colorize, colorize_indexed, index_to_rgba
+from tile_index import get_tile_index, get_tile_occupancy, get_tile_resampling, resample_tile
+from tile_store import read_store_tile
+from metrics import timed, count
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 TILE_SIZE = 256
 
+TILE_ENCODINGS = {
+  'png': {'extension': 'png', 'content_type': 'image/png'},
+  'png8': {'extension': 'png', 'content_type': 'image/png'},
+  'webp': {'extension': 'webp', 'content_type': 'image/webp'}
+}
+
+TILE_FORMAT = os.getenv('TILE_FORMAT', 'png')
+WEBP_METHOD = int(os.getenv('WEBP_METHOD', '4'))
+
+# upload: encode and upload uniform tiles like any other
+# shared: upload one content-addressed object per color, referenced from the manifest
+# manifest: only record the tile's color in the manifest
+UNIFORM_TILE_MODE = os.getenv('UNIFORM_TILE_MODE', 'upload')
+
+# off: always encode and upload
+# copy: server-side copy tiles unchanged since the previous run to this run's key
+# pointer: skip unchanged tiles; the manifest points at the run that holds them
+INCREMENTAL_MODE = os.getenv('INCREMENTAL_MODE', 'off')
+
+# When several forecast hours are rendered together:
+# hours: one tile per forecast hour, as for a single hour
+# stack: one image per z/x/y with each hour's tile stacked top to bottom
+# both: write both
+FORECAST_STACK_MODE = os.getenv('FORECAST_STACK_MODE', 'hours')
+
+# off: colored tiles only
+# both: a quantized value tile (see value_tiles.py) alongside each colored tile
+# only: value tiles instead of colored tiles
+VALUE_TILE_MODE = os.getenv('VALUE_TILE_MODE', 'off')
+
+def parse_tile_formats(overrides):
+  """Per-variable encoder overrides such as "wspd:webp,tmp:png8" """
+  formats = {}
+
+  for entry in filter(None, overrides.split(',')):
+    variable, tile_format = entry.split(':')
+    formats[variable.strip()] = tile_format.strip()
+
+  return formats
+
+VARIABLE_TILE_FORMATS = parse_tile_formats(os.getenv('TILE_FORMATS', ''))
+
+def get_tile_format(variable):
+  return VARIABLE_TILE_FORMATS.get(variable, TILE_FORMAT)
+
+def get_tile_encoding(variable):
+  return TILE_ENCODINGS[get_tile_format(variable)]
+
+# generate_tile renders a single tile per call, so the source it renders from
+# is kept for the next call on the same dataset and variables: (ds, variables, source)
+_tile_source = None
+_tile_source_lock = threading.Lock()
+
 def generate_tile(x, y, zoom, variable, ds):
-  try:
-    bounds = mercantile.bounds(x, y, zoom)
-    
+  return generate_tiles_for_variables(x, y, zoom, [variable], ds).get(variable)
+
+def generate_tiles_for_variables(x, y, zoom, variables, ds):
+  return render_tiles(get_tile_source(ds, variables, zoom), x, y, zoom, variables)
+
+def get_tile_source(ds, variables, zoom):
+  """The prepared source of the last call if it was for ds and variables, extended to zoom if need be"""
+  global _tile_source
+
+  with _tile_source_lock:
+    cached_ds, cached_variables, source = _tile_source or (None, None, None)
+
+    if cached_ds is not ds or cached_variables != tuple(variables):
+      source = prepare_tile_source(ds, variables, [zoom])
+
+    elif zoom not in source['occupancy']:
+      with timed('index'):
+        source['index'] = get_tile_index(ds['lat'].values, ds['lon'].values, [zoom])
+        source['occupancy'].update(get_source_occupancy(source['index'], source['values'], [zoom]))
+
+    _tile_source = (ds, tuple(variables), source)
+    return source
+
+def generate_store_tile(x, y, zoom, variable, store, forecast_hour):
+  """Render one tile from only the tile store chunks it overlaps"""
+  arr = read_store_tile(store, forecast_hour, variable, zoom, x, y)
+
+  if arr is None:
+    logger.warning(f"Variable {variable} not found in tile store {store['location']}")
+    return None
+
+  return encode_tile_values(arr, variable, f"{zoom}/{x}/{y}")
+
+def prepare_tile_source(ds, variables, zooms):
+  """Load each variable's grid once and attach the cached resampling index and tile occupancy"""
+  values = {}
+  
+  for variable in variables:
     if variable not in ds.data_vars:
       logger.warning(f"Variable {variable} not found in dataset")
-      return None
-    
-    var_data = ds[variable].rio.set_spatial_dims(x_dim="lon", y_dim="lat")
-    
-    tile_ds = var_data.rio.clip_box(
-			bounds.west, bounds.south,
-			bounds.east, bounds.north,
-      allow_one_dimensional_raster=True
-		)
-    
-    if tile_ds.size == 0:
-      logger.debug(f"No data in tile bouds for {zoom}/{x}/{y}")
-      return None
+      continue
     
-    tile_ds = tile_ds.rio.reproject(
-			var_data.rio.crs,
-			shape=(TILE_SIZE, TILE_SIZE),
-			resampling=3
-		)
-    
-    arr = tile_ds.values
+    with timed('sample', variable=variable):
+      values[variable] = ds[variable].transpose('lat', 'lon').values.astype(np.float32, copy=False)
+  
+  with timed('index'):
+    tile_index = get_tile_index(ds['lat'].values, ds['lon'].values, zooms)
+    occupancy = get_source_occupancy(tile_index, values, zooms)
+  
+  return {'values': values, 'index': tile_index, 'occupancy': occupancy}
+
+def prepare_stacked_tile_source(datasets, variables, zooms):
+  """Stack each variable's grid over forecast hours so one resampling serves every hour.
+
+  datasets maps forecast hour to dataset, in frame order. The hours must share
+  a grid; a variable missing from any of them is skipped.
+  """
+  forecast_hours = list(datasets)
+  first = datasets[forecast_hours[0]]
+  
+  for forecast_hour in forecast_hours[1:]:
+    dataset = datasets[forecast_hour]
+    if not (np.array_equal(dataset['lat'].values, first['lat'].values) and
+            np.array_equal(dataset['lon'].values, first['lon'].values)):
+      raise ValueError(f"Forecast hour {forecast_hour} is on a different grid from {forecast_hours[0]}")
+  
+  values = {}
+  
+  for variable in variables:
+    missing = [forecast_hour for forecast_hour in forecast_hours if variable not in datasets[forecast_hour].data_vars]
+    if missing:
+      logger.warning(f"Variable {variable} not found in forecast hours {missing}")
+      continue
     
-    if np.isnan(arr).all():
-      logger.debug(f"All NaN values in tile {zoom}/{x}/{y}")
-      return None
+    with timed('sample', variable=variable):
+      stack = np.empty((len(forecast_hours),) + first[variable].transpose('lat', 'lon').shape, dtype=np.float32)
+      for frame, forecast_hour in enumerate(forecast_hours):
+        stack[frame] = datasets[forecast_hour][variable].transpose('lat', 'lon').values
+    values[variable] = stack
+  
+  with timed('index'):
+    tile_index = get_tile_index(first['lat'].values, first['lon'].values, zooms)
+    occupancy = get_source_occupancy(tile_index, values, zooms)
+  
+  return {
+    'values': values,
+    'index': tile_index,
+    'occupancy': occupancy,
+    'forecast_hours': forecast_hours
+  }
+
+def get_source_occupancy(tile_index, values, zooms):
+  """Occupancy of the cells where any variable (in any forecast hour) has data"""
+  valid_mask = None
+  
+  for arr in values.values():
+    arr_valid = ~np.isnan(arr)
+    if arr_valid.ndim == 3:
+      arr_valid = arr_valid.any(axis=0)
+    valid_mask = arr_valid if valid_mask is None else valid_mask | arr_valid
+  
+  if valid_mask is None:
+    return {zoom: {'x0': 0, 'y0': 0, 'tiles': np.zeros((0, 0), dtype=bool)} for zoom in zooms}
+  
+  return get_tile_occupancy(tile_index, valid_mask, zooms)
+
+def render_tiles(source, x, y, zoom, variables):
+  tiles = {}
+  
+  for variable, arr in resample_tiles(source, x, y, zoom, variables):
+    try:
+      tile_data = encode_tile_values(arr, variable, f"{zoom}/{x}/{y}")
+      
+      if tile_data:
+        tiles[variable] = tile_data
     
-    img_arr = apply_vectorized_colors(arr, variable)
+    except Exception as e:
+      logger.warning(f"failed to generate tile {zoom}/{x}/{y} for {variable}: {e}")
+  
+  return tiles
+
+def resample_tiles(source, x, y, zoom, variables):
+  try:
+    with timed('clip', zoom=zoom):
+      resampling = get_tile_resampling(source['index'], zoom, x, y)
+  except Exception as e:
+    logger.warning(f"failed to generate tile {zoom}/{x}/{y}: {type(e).__name__}: {e}")
+    count('render_errors', len(variables), zoom=zoom)
+    return
+  
+  if resampling is None:
+    logger.debug(f"No data in tile bouds for {zoom}/{x}/{y}")
+    count('tiles_skipped', len(variables), zoom=zoom)
+    return
+  
+  for variable in variables:
+    if variable not in source['values']:
+      continue
     
-    image = Image.fromarray(img_arr)
+    try:
+      with timed('reproject', variable=variable, zoom=zoom):
+        arr = resample_tile(source['values'][variable], resampling)
+    except Exception as e:
+      logger.warning(f"failed to generate tile {zoom}/{x}/{y} for {variable}: {type(e).__name__}: {e}")
+      count('render_errors', variable=variable, zoom=zoom)
+      continue
     
-    buffer = io.BytesIO()
-    image.save(buffer, format="PNG", optimize=True, compress_level=1)
-    return buffer.getvalue()
+    yield variable, arr
+
+def encode_tile_values(arr, variable, tile_label):
+  if np.isnan(arr).all():
+    logger.debug(f"All NaN values in tile {tile_label} for {variable}")
+    return None
   
-  except Exception as e:
-    logger.warning(f"failed to generate tile {zoom}/{x}/{y}: {e}")
+  return encode_tile(arr, variable)
+
+def encode_tile_for_upload(arr, variable, tile_label, previous_hashes=None):
+  """Encode a tile unless it is uniform or unchanged since the previous run.
+
+  Returns None for a tile with no data, otherwise a dict with 'data' (the
+  encoded bytes), 'color' (a uniform tile's RGBA color, not encoded) or
+  'unchanged' set, plus the content 'hash' when incremental mode is on.
+  """
+  if np.isnan(arr).all():
+    logger.debug(f"All NaN values in tile {tile_label} for {variable}")
     return None
   
-def apply_vectorized_colors(arr, variable):
-  rgba = np.zeros((*arr.shape, 4), dtype=np.uint8)
-  
-  arr_clean = np.where(np.isnan(arr), 0, arr)
-  
-  match variable:
-    case 'wspd' | None:
-      return apply_wind_colors(arr_clean)
-    case 'tmp':
-      return apply_temperature_colors(arr_clean)
-    case 'rh':
-      return apply_humidity_colors(arr_clean)
-    case 'MC1':
-      return apply_mc1_colors(arr_clean)
-    case 'MC10':
-      return apply_mc10_colors(arr_clean)
-    case 'MC100':
-      return apply_mc100_colors(arr_clean)
-    case 'MC1000':
-      return apply_mc1000_colors(arr_clean)
-    case 'MCWOOD':
-      return apply_mc_wood_colors(arr_clean)
-    case 'MCHERB':
-      return apply_mc_herb_colors(arr_clean)
-    case 'KBDI':
-      return apply_kbdi_colors(arr_clean)
-    case 'IC':
-      return apply_ic_colors(arr_clean)
-    case 'ERC':
-      return apply_erc_colors(arr_clean)
-    case 'BI':
-      return apply_bi_colors(arr_clean)
-    case 'SC':
-      return apply_sc_colors(arr_clean)
-    case 'GSI':
-      return apply_gsi_colors(arr_clean)
+  with timed('colorize'):
+    index, colormap = colorize_indexed(arr, variable)
+  tile_format = get_tile_format(variable)
+  
+  if UNIFORM_TILE_MODE != 'upload':
+    first = index.flat[0]
+    if index.min() == first == index.max():
+      return {'color': tuple(int(channel) for channel in colormap['colors'][first])}
+  
+  if INCREMENTAL_MODE == 'off':
+    with timed('encode'):
+      return {'data': encode_indexed_tile(index, colormap, tile_format)}
+  
+  content_hash = hash_tile_content(index, colormap, tile_format)
+  previous = (previous_hashes or {}).get(tile_label)
+  
+  if previous and previous[0] == content_hash:
+    return {'hash': content_hash, 'unchanged': True}
+  
+  with timed('encode'):
+    return {'hash': content_hash, 'data': encode_indexed_tile(index, colormap, tile_format)}
+
+def encode_stacked_tile(stack, variable, tile_label):
+  """One image of a (hours, rows, cols) stack, each hour's tile below the previous one"""
+  if np.isnan(stack).all():
+    logger.debug(f"All NaN values in tile stack {tile_label} for {variable}")
+    return None
+  
+  with timed('colorize'):
+    index, colormap = colorize_indexed(stack.reshape(-1, stack.shape[-1]), variable)
+  
+  with timed('encode'):
+    return encode_indexed_tile(index, colormap, get_tile_format(variable))
+
+def hash_tile_content(index, colormap, tile_format):
+  """Hash of the quantized tile as drawn: palette indices, palette and format"""
+  digest = hashlib.blake2b(digest_size=16)
+  digest.update(tile_format.encode())
+  digest.update(colormap['palette'].tobytes())
+  digest.update(np.ascontiguousarray(index).tobytes())
+  
+  return digest.hexdigest()
+
+def encode_tile(arr, variable, tile_format=None):
+  index, colormap = colorize_indexed(arr, variable)
+  return encode_indexed_tile(index, colormap, tile_format or get_tile_format(variable))
+
+def encode_indexed_tile(index, colormap, tile_format):
+  buffer = io.BytesIO()
+  
+  match tile_format:
+    case 'png8':
+      # Every colormap has at most 256 colors, so the palette indices are the image
+      image = Image.fromarray(index, mode='L')
+      image.putpalette(colormap['colors'][:, :3].tobytes())
+      image.save(
+        buffer, format="PNG", optimize=True, compress_level=1,
+        transparency=colormap['colors'][:, 3].tobytes()
+      )
+    case 'webp':
+      image = Image.fromarray(index_to_rgba(index, colormap))
+      image.save(buffer, format="WEBP", lossless=True, method=WEBP_METHOD)
     case _:
-      normalized = np.clip(arr_clean / 100.0, 0, 1)
-      rgba[:, :, 0] = (normalized * 255).astype(np.uint8)
-      rgba[:, :, 1] = (normalized * 255).astype(np.uint8)
-      rgba[:, :, 2] = (normalized * 255).astype(np.uint8)
-      rgba[:, :, 3] = 255
-      return rgba
\ No newline at end of file
+      image = Image.fromarray(index_to_rgba(index, colormap))
+      image.save(buffer, format="PNG", optimize=True, compress_level=1)
+  
+  return buffer.getvalue()
+
+def encode_uniform_tile(color, tile_format):
+  index = np.zeros((TILE_SIZE, TILE_SIZE), dtype=np.uint8)
+  colors = np.array([color], dtype=np.uint8)
+  colormap = {'colors': colors, 'palette': colors.view('<u4').ravel()}
+  
+  return encode_indexed_tile(index, colormap, tile_format)
+  
+def apply_vectorized_colors(arr, variable):
+  return colorize(arr, variable)
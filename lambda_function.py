@@ -1,26 +1,33 @@
-import json
 import asyncio
 import logging
-import boto3
-import os
-from datetime import datetime, timezone
 
+# The render modules (xarray, rioxarray, Pillow, mercantile...) are imported by the
+# actions that use them, so the control-plane checks start without them
 from s3_and_database_access import (
   check_for_current_weather_files, look_for_current_tiles, 
-  mark_tiles_complete, db
+  mark_tiles_complete, get_db
 )
-from tile_processor import process_single_variable
+from metrics import reset_metrics, collect_metrics, emit_metrics, has_metrics
 from utils import build_most_recent_file_stamp
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-lambda_client = boto3.client('lambda', region_name=os.getenv('AWS_REGION', 'us-east-1'))
-
 VARIABLES = ['wspd', 'tmp', 'rh', 'MC1', 'MC10', 'MC100', 'MC1000', 'MCWOOD', 'MCHERB', 'KBDI', 'IC', 'ERC', 'BI', 'SC', 'GSI']
 
 def lambda_handler(event, context):
-  return asyncio.run(handle_step_functions_action(event, context))
+  reset_metrics()
+  
+  try:
+    return asyncio.run(handle_step_functions_action(event, context))
+  
+  finally:
+    if has_metrics():
+      emit_metrics({
+        'action': event.get('action'),
+        'variable': event.get('variable'),
+        'request_id': getattr(context, 'aws_request_id', None)
+      })
     
     
 async def handle_step_functions_action(event, context):
@@ -29,7 +36,7 @@ async def handle_step_functions_action(event, context):
   
   match action:
     case 'check_kill_switch':
-      kill_switch = db.lambdaControl.find_one({'action': 'stop'})
+      kill_switch = get_db().lambdaControl.find_one({'action': 'stop'})
       
       return {
         'kill_switch_active': bool(kill_switch)
@@ -50,6 +57,8 @@ async def handle_step_functions_action(event, context):
       }
       
     case 'process_variable':
+      from tile_processor import process_single_variable
+      
       variable = event.get('variable', 'wspd')
       forecast_hour = event.get('forecast_hour', '03')
       result = await process_single_variable(variable, forecast_hour, context)
@@ -57,7 +66,86 @@ async def handle_step_functions_action(event, context):
       return {
         'variable': variable,
         'tiles_generated': result.get('tiles_generated', 0),
-        'status': 'success'
+        'failed_uploads': result.get('failed_uploads', 0),
+        'status': result.get('status', 'success'),
+        'metrics': collect_metrics()
+      }
+      
+    case 'process_all_variables':
+      from tile_processor import process_all_variables
+      
+      variables = event.get('variables') or VARIABLES
+      forecast_hour = event.get('forecast_hour', '03')
+      result = await process_all_variables(
+        variables, forecast_hour, context, override=override_timestamp
+      )
+      
+      return {
+        'variables': result.get('variables', []),
+        'tiles_generated': result.get('tiles_generated', 0),
+        'failed_uploads': result.get('failed_uploads', 0),
+        'status': result.get('status', 'success'),
+        'metrics': collect_metrics()
+      }
+      
+    case 'process_forecast_hours':
+      from tile_processor import process_forecast_hours
+      
+      variables = event.get('variables') or VARIABLES
+      forecast_hours = event.get('forecast_hours') or [event.get('forecast_hour', '03')]
+      result = await process_forecast_hours(
+        variables, forecast_hours, context, override=override_timestamp
+      )
+      
+      return {
+        'forecast_hours': result.get('forecast_hours', []),
+        'tiles_generated': result.get('tiles_generated', 0),
+        'failed_uploads': result.get('failed_uploads', 0),
+        'status': result.get('status', 'success'),
+        'metrics': collect_metrics()
+      }
+      
+    case 'plan_shards':
+      from shard_planner import plan_shards, summarize_plan
+      
+      variables = event.get('variables') or VARIABLES
+      forecast_hours = event.get('forecast_hours') or [event.get('forecast_hour', '03')]
+      plan = summarize_plan(plan_shards(variables, forecast_hours))
+      
+      logger.info(f"Planned {plan['shard_count']} shards, estimated {plan['estimated_seconds']}s")
+      return plan
+      
+    case 'process_shard':
+      from tile_processor import process_shard
+      
+      shard = event['shard']
+      result = await process_shard(shard, context, override=override_timestamp)
+      
+      return {
+        'shard': shard['id'],
+        'tiles_generated': result.get('tiles_generated', 0),
+        'failed_uploads': result.get('failed_uploads', 0),
+        'status': result.get('status', 'success'),
+        'metrics': collect_metrics()
+      }
+      
+    case 'finish_shards':
+      from tile_processor import finish_shards
+      
+      return finish_shards(event.get('shards', []), event.get('results', []), override=override_timestamp)
+      
+    case 'ingest_model_run':
+      from tile_processor import ingest_model_run
+      
+      variables = event.get('variables') or VARIABLES
+      forecast_hours = event.get('forecast_hours') or [event.get('forecast_hour', '03')]
+      result = await ingest_model_run(
+        variables=variables, forecast_hours=forecast_hours, context=context, override=override_timestamp
+      )
+      
+      return {
+        'forecast_hours': result.get('forecast_hours', []),
+        'status': result.get('status', 'success')
       }
       
     case 'mark_tiles_complete':
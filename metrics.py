@@ -0,0 +1,231 @@
+"""Per-invocation stage timings, tile counters and memory high-water marks.
+
+Stages are timed into histograms labelled with the variable and zoom they
+worked on:
+
+  with timed('encode'):
+    ...
+
+Labels passed to timed or count win over those a render job set for its
+thread with metric_labels. Everything accumulates in this process until
+reset_metrics at the start of the next invocation. collect_metrics returns
+the JSON-ready summary, and emit_metrics logs it as one structured log
+line. Process pool workers hand theirs back with drain_metrics and
+merge_metrics.
+"""
+import json
+import logging
+import resource
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Upper bounds of the histogram buckets in milliseconds, plus one for anything longer
+BUCKET_BOUNDS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+_lock = threading.Lock()
+_thread_labels = threading.local()
+
+# {(stage, variable, zoom): histogram} and {(name, variable, zoom): count}
+_histograms = {}
+_counters = {}
+
+# Peak RSS in bytes of each window between mark_memory calls, by label
+_memory = {}
+
+def reset_metrics():
+  with _lock:
+    _histograms.clear()
+    _counters.clear()
+    _memory.clear()
+
+  reset_peak_rss()
+
+@contextmanager
+def metric_labels(variable=None, zoom=None):
+  previous = getattr(_thread_labels, 'labels', (None, None))
+  _thread_labels.labels = (variable, zoom)
+
+  try:
+    yield
+  finally:
+    _thread_labels.labels = previous
+
+def resolve_labels(variable, zoom):
+  thread_variable, thread_zoom = getattr(_thread_labels, 'labels', (None, None))
+
+  return (
+    variable if variable is not None else thread_variable,
+    zoom if zoom is not None else thread_zoom
+  )
+
+@contextmanager
+def timed(stage, variable=None, zoom=None):
+  start = time.perf_counter()
+
+  try:
+    yield
+  finally:
+    observe(stage, (time.perf_counter() - start) * 1000, variable, zoom)
+
+def observe(stage, duration_ms, variable=None, zoom=None):
+  key = (stage, *resolve_labels(variable, zoom))
+  bucket = bisect_left(BUCKET_BOUNDS_MS, duration_ms)
+
+  with _lock:
+    histogram = _histograms.get(key)
+    if histogram is None:
+      histogram = _histograms[key] = new_histogram()
+
+    histogram['count'] += 1
+    histogram['total_ms'] += duration_ms
+    histogram['max_ms'] = max(histogram['max_ms'], duration_ms)
+    histogram['buckets'][bucket] += 1
+
+def count(name, amount=1, variable=None, zoom=None):
+  if not amount:
+    return
+
+  key = (name, *resolve_labels(variable, zoom))
+
+  with _lock:
+    _counters[key] = _counters.get(key, 0) + amount
+
+def new_histogram():
+  return {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'buckets': [0] * (len(BUCKET_BOUNDS_MS) + 1)}
+
+def mark_memory(label):
+  """Record the peak RSS since the previous mark under label, and start a new window"""
+  peak = read_peak_rss()
+
+  with _lock:
+    _memory[label] = max(_memory.get(label, 0), peak)
+
+  reset_peak_rss()
+
+def reset_peak_rss():
+  """Start a new high-water mark where Linux allows it"""
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+  except OSError:
+    pass
+
+def read_peak_rss():
+  """Peak resident memory in bytes since the last reset_peak_rss"""
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def drain_metrics():
+  """This process's histograms and counters, which are then cleared"""
+  with _lock:
+    drained = {'histograms': dict(_histograms), 'counters': dict(_counters)}
+    _histograms.clear()
+    _counters.clear()
+
+  return drained
+
+def merge_metrics(drained):
+  with _lock:
+    for key, other in drained['histograms'].items():
+      histogram = _histograms.get(key)
+      if histogram is None:
+        histogram = _histograms[key] = new_histogram()
+
+      histogram['count'] += other['count']
+      histogram['total_ms'] += other['total_ms']
+      histogram['max_ms'] = max(histogram['max_ms'], other['max_ms'])
+      histogram['buckets'] = [ours + theirs for ours, theirs in zip(histogram['buckets'], other['buckets'])]
+
+    for key, amount in drained['counters'].items():
+      _counters[key] = _counters.get(key, 0) + amount
+
+def collect_metrics():
+  """Totals per stage and counter, the same split by variable and zoom, and peak memory"""
+  with _lock:
+    histograms = {key: {**histogram, 'buckets': list(histogram['buckets'])} for key, histogram in _histograms.items()}
+    counters = dict(_counters)
+    memory = dict(_memory)
+
+  stages = {}
+  for (stage, _, _), histogram in histograms.items():
+    total = stages.setdefault(stage, new_histogram())
+    total['count'] += histogram['count']
+    total['total_ms'] += histogram['total_ms']
+    total['max_ms'] = max(total['max_ms'], histogram['max_ms'])
+    total['buckets'] = [ours + theirs for ours, theirs in zip(total['buckets'], histogram['buckets'])]
+
+  counter_totals = {}
+  for (name, _, _), amount in counters.items():
+    counter_totals[name] = counter_totals.get(name, 0) + amount
+
+  return {
+    'stages': {stage: summarize_histogram(histogram) for stage, histogram in sorted(stages.items())},
+    'stages_by_label': [
+      {'stage': stage, 'variable': variable, 'zoom': zoom, **summarize_histogram(histogram, buckets=False)}
+      for (stage, variable, zoom), histogram in sorted(histograms.items(), key=sort_key)
+    ],
+    'counters': dict(sorted(counter_totals.items())),
+    'counters_by_label': [
+      {'counter': name, 'variable': variable, 'zoom': zoom, 'count': amount}
+      for (name, variable, zoom), amount in sorted(counters.items(), key=sort_key)
+    ],
+    'memory': {
+      'peak_rss_bytes': max([read_peak_rss(), *memory.values()]),
+      'windows': {str(label): peak for label, peak in memory.items()}
+    }
+  }
+
+def sort_key(item):
+  (name, variable, zoom), _ = item
+  return name, variable or '', -1 if zoom is None else zoom
+
+def summarize_histogram(histogram, buckets=True):
+  summary = {
+    'count': histogram['count'],
+    'total_ms': round(histogram['total_ms'], 3),
+    'mean_ms': round(histogram['total_ms'] / histogram['count'], 3) if histogram['count'] else 0.0,
+    'p50_ms': bucket_quantile(histogram, 0.5),
+    'p95_ms': bucket_quantile(histogram, 0.95),
+    'max_ms': round(histogram['max_ms'], 3)
+  }
+
+  if buckets:
+    summary['buckets'] = {
+      (f"<={bound}" if index < len(BUCKET_BOUNDS_MS) else f">{BUCKET_BOUNDS_MS[-1]}"): bucket_count
+      for index, (bound, bucket_count) in enumerate(zip((*BUCKET_BOUNDS_MS, None), histogram['buckets']))
+      if bucket_count
+    }
+
+  return summary
+
+def bucket_quantile(histogram, quantile):
+  """Upper bound of the bucket holding the quantile, or the maximum for the last bucket"""
+  target = quantile * histogram['count']
+  seen = 0
+
+  for index, bucket_count in enumerate(histogram['buckets']):
+    seen += bucket_count
+    if bucket_count and seen >= target:
+      return BUCKET_BOUNDS_MS[index] if index < len(BUCKET_BOUNDS_MS) else round(histogram['max_ms'], 3)
+
+  return 0.0
+
+def has_metrics():
+  with _lock:
+    return bool(_histograms or _counters)
+
+def emit_metrics(fields):
+  """Log the invocation's metrics as one JSON line, which CloudWatch Logs Insights can query"""
+  logger.info(json.dumps({'metrics': 'tile_pipeline', **fields, **collect_metrics()}, default=str))
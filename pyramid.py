@@ -0,0 +1,109 @@
+import logging
+import os
+import warnings
+import numpy as np
+
+from tile_index import TILE_SIZE, get_tile_resampling, resample_tile, get_occupied_tiles, is_tile_occupied
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Memory the pyramid blocks being rendered at once may take together.
+# Resampling a block's mosaic goes through float64 passes, which with the
+# float32 mosaic and its reductions come to about MOSAIC_BYTES_PER_PIXEL per
+# pixel of the top zoom, per forecast hour.
+PYRAMID_MEMORY_MB = float(os.getenv('PYRAMID_MEMORY_MB', '256'))
+MOSAIC_BYTES_PER_PIXEL = 20
+
+def get_max_pyramid_depth(workers, frames=1):
+  """How many zooms above its lowest a pyramid can reach with workers rendering blocks at once"""
+  budget = PYRAMID_MEMORY_MB * 2**20 / max(workers, 1)
+  depth = 0
+
+  while (2 ** (depth + 1) * TILE_SIZE) ** 2 * MOSAIC_BYTES_PER_PIXEL * frames <= budget:
+    depth += 1
+
+  return depth
+
+def split_pyramid_zooms(zooms, max_depth):
+  """Zooms grouped into pyramids spanning at most max_depth zooms, lowest first.
+
+  The highest zooms go together, so only the lower zooms a deep pyramid
+  can't reach are resampled on their own.
+  """
+  pyramids = []
+
+  for zoom in sorted(zooms, reverse=True):
+    if pyramids and pyramids[-1][0] - zoom <= max_depth:
+      pyramids[-1].append(zoom)
+    else:
+      pyramids.append([zoom])
+
+  return [sorted(pyramid) for pyramid in reversed(pyramids)]
+
+def get_pyramid_blocks(zooms, occupancy):
+  """Tiles at the lowest zoom whose footprint holds an occupied tile at any zoom"""
+  base_zoom = min(zooms)
+  blocks = set()
+
+  for zoom in zooms:
+    shift = zoom - base_zoom
+    blocks.update((x >> shift, y >> shift) for x, y in get_occupied_tiles(occupancy[zoom]))
+
+  return sorted(blocks)
+
+def build_pyramid_block(source, variable, zooms, base_x, base_y):
+  """Render one mosaic at the highest zoom and block-reduce it for the lower zooms.
+
+  Yields (zoom, x, y, values) for every configured tile inside the footprint
+  of the lowest-zoom tile base_x, base_y.
+  """
+  base_zoom, top_zoom = min(zooms), max(zooms)
+  span = 2 ** (top_zoom - base_zoom)
+
+  with timed('clip', variable=variable, zoom=top_zoom):
+    resampling = get_tile_resampling(
+      source['index'], top_zoom, base_x * span, base_y * span, span=span
+    )
+  if resampling is None:
+    return
+
+  with timed('reproject', variable=variable, zoom=top_zoom):
+    mosaic = resample_tile(source['values'][variable], resampling)
+
+  for zoom in range(top_zoom, base_zoom - 1, -1):
+    if zoom < top_zoom:
+      with timed('reduce', variable=variable, zoom=zoom):
+        mosaic = reduce_by_two(mosaic)
+
+    if zoom not in zooms:
+      continue
+
+    yield from split_mosaic(mosaic, zoom, base_x, base_y, base_zoom, source['occupancy'][zoom])
+
+def reduce_by_two(mosaic):
+  *leading, height, width = mosaic.shape
+  blocks = mosaic.reshape(*leading, height // 2, 2, width // 2, 2)
+
+  # All-NaN blocks (outside the grid) are expected and stay NaN
+  with warnings.catch_warnings():
+    warnings.simplefilter('ignore', category=RuntimeWarning)
+    return np.nanmean(blocks, axis=(-3, -1))
+
+def split_mosaic(mosaic, zoom, base_x, base_y, base_zoom, zoom_occupancy):
+  span = 2 ** (zoom - base_zoom)
+
+  for row in range(span):
+    y = base_y * span + row
+
+    for col in range(span):
+      x = base_x * span + col
+      if not is_tile_occupied(zoom_occupancy, x, y):
+        continue
+
+      yield zoom, x, y, mosaic[
+        ...,
+        row * TILE_SIZE:(row + 1) * TILE_SIZE,
+        col * TILE_SIZE:(col + 1) * TILE_SIZE
+      ]
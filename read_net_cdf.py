@@ -1,16 +1,37 @@
 import logging
+import math
+import os
+import numpy as np
 import xarray as xr
+import rioxarray  # registers the .rio accessor used below
+
+from tile_index import TILE_SIZE
+from tile_store import read_store_level
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 TARGET_ZOOM_LEVELS = [6, 8, 10]
 
-async def read_weather(local_netcdf_path):
+# auto: thin the grid to suit the highest target zoom
+# zoom: open the full grid and render each zoom from a view thinned for it (get_zoom_stride)
+# or a fixed stride, where 1 reads the grid at full resolution (see SOURCE_LOADING=bands)
+NETCDF_SAMPLING = os.getenv('NETCDF_SAMPLING', 'auto')
+
+async def read_weather(local_netcdf_path, variables=None, sampling=None):
+  """Open a local NetCDF path, or a byte-range URL from build_netcdf_range_url.
+
+  Reads are lazy, so with variables set only those arrays are ever fetched.
+  Without sampling the stride is NETCDF_SAMPLING, by default thinned to suit
+  the highest target zoom.
+  """
   try:
-    logger.info(f"Reading NetCDF file: {local_netcdf_path}")
+    logger.info(f"Reading NetCDF file: {local_netcdf_path.split('?')[0]}")
     
-    ds = xr.open_dataset(local_netcdf_path)
+    ds = xr.open_dataset(local_netcdf_path, engine='netcdf4')
+
+    if variables:
+      ds = ds[[variable for variable in variables if variable in ds.data_vars]]
 
     lats = ds['lat'].values
     lngs = ds['lon'].values
@@ -19,14 +40,19 @@ async def read_weather(local_netcdf_path):
     logger.info(f"Longitude range: {lngs.min():.3f} to {lngs.max():.3f}")
 
     max_zoom = max(TARGET_ZOOM_LEVELS)
-    if max_zoom >= 10:
-      sampling = 5
-    elif max_zoom >= 8:
-      sampling = 10  
-    elif max_zoom >= 6:
-      sampling = 20
-    else:
-      sampling = 50
+    if sampling is None and NETCDF_SAMPLING == 'zoom':
+      sampling = 1
+    elif sampling is None and NETCDF_SAMPLING != 'auto':
+      sampling = int(NETCDF_SAMPLING)
+    if sampling is None:
+      if max_zoom >= 10:
+        sampling = 5
+      elif max_zoom >= 8:
+        sampling = 10
+      elif max_zoom >= 6:
+        sampling = 20
+      else:
+        sampling = 50
 
     logger.info(f"Using sampling rate: {sampling} for max zoom {max_zoom}")
 
@@ -46,4 +72,61 @@ async def read_weather(local_netcdf_path):
 
   except Exception as error:
     logger.error(f"Error reading NetCDF file: {error}")
-    raise
\ No newline at end of file
+    raise
+
+def get_zoom_stride(ds, zoom):
+  """(lat, lon) strides leaving about one grid cell per tile pixel at zoom.
+
+  A pixel spans 360 / 2**zoom / TILE_SIZE degrees of longitude, and that
+  times cos(latitude) degrees of latitude, narrowest at the grid's poleward
+  edge. A grid finer than the pixels is thinned to them; a coarser one is
+  read whole.
+  """
+  lats, lons = ds['lat'].values, ds['lon'].values
+  pixel_degrees = 360 / 2 ** zoom / TILE_SIZE
+  poleward = min(float(np.abs(lats).max()), 85.0511)
+
+  lat_pixel = pixel_degrees * math.cos(math.radians(poleward))
+  lat_spacing = float(np.abs(np.diff(lats)).max()) if len(lats) > 1 else lat_pixel
+  lon_spacing = float(np.abs(np.diff(lons)).max()) if len(lons) > 1 else pixel_degrees
+
+  return max(int(lat_pixel / lat_spacing), 1), max(int(pixel_degrees / lon_spacing), 1)
+
+def group_zooms_by_stride(ds, zooms):
+  """[(stride, zooms)] so that zooms read at the same stride share one view"""
+  groups = {}
+
+  for zoom in sorted(zooms):
+    groups.setdefault(get_zoom_stride(ds, zoom), []).append(zoom)
+
+  return list(groups.items())
+
+def thin_dataset(ds, stride):
+  """A lazy view of every stride[0]th latitude and stride[1]th longitude"""
+  lat_stride, lon_stride = stride
+
+  if lat_stride == lon_stride == 1:
+    return ds
+
+  return ds.isel(lat=slice(None, None, lat_stride), lon=slice(None, None, lon_stride))
+
+async def read_store_weather(store, forecast_hour, variables, level=0):
+  """The same (lat, lon) dataset as read_weather, from an ingested tile store level"""
+  try:
+    logger.info(f"Reading tile store {store['location']} forecast hour {forecast_hour} level {level}")
+
+    values, lats, lons = read_store_level(store, forecast_hour, variables, level)
+
+    ds = xr.Dataset(
+      {variable: (('lat', 'lon'), arr) for variable, arr in values.items()},
+      coords={'lat': lats, 'lon': lons}
+    )
+    ds.rio.write_crs("EPSG:4326", inplace=True)
+    ds = ds.rio.set_spatial_dims(x_dim="lon", y_dim="lat")
+
+    logger.info(f"Store grid: {ds.dims}")
+    return ds
+
+  except Exception as error:
+    logger.error(f"Error reading tile store: {error}")
+    raise
@@ -0,0 +1,300 @@
+import logging
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from generate_tiles import (
+  resample_tiles, encode_tile_for_upload, encode_stacked_tile, FORECAST_STACK_MODE,
+  VALUE_TILE_MODE
+)
+from value_tiles import encode_value_tile
+from pyramid import build_pyramid_block
+from source_bands import load_band, get_band_source
+from metrics import metric_labels, timed, count, drain_metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+def get_available_cpus():
+  try:
+    return len(os.sched_getaffinity(0))
+  except AttributeError:
+    return os.cpu_count() or 1
+
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', str(get_available_cpus())))
+RENDER_EXECUTOR = os.getenv('RENDER_EXECUTOR', 'thread')
+
+# The source visible to render jobs in this process: set directly for the
+# thread pool, attached from shared memory by each process pool worker.
+_source = None
+_attached_memory = []
+
+# A worker process's banded source, whose buffers are the pool's shared band
+# buffers, and the band of it the worker last rendered from
+_banded_source = None
+_band_control = None
+_band_generation = 0
+
+def create_render_pool(source, band_rows=0):
+  """Thread pool by default: the gather, colormap and zlib all release the GIL.
+
+  RENDER_EXECUTOR=process shares the sampled arrays with worker processes
+  through shared memory instead, or for a banded source the band buffers,
+  sized for band_rows grid rows if that is more than its budget allows.
+  Lambda has no /dev/shm, so there it falls back to threads.
+  """
+  global _source
+
+  if RENDER_EXECUTOR == 'process':
+    try:
+      shared_values, shared_blocks = share_source_values(source)
+      shared_bands = band_control = None
+      source_fields = {field: value for field, value in source.items() if field != 'values'}
+
+      if 'bands' in source:
+        shared_bands, band_blocks, band_control = share_band_buffers(source, band_rows)
+        shared_blocks += band_blocks
+        source_fields['bands'] = {
+          field: value for field, value in source['bands'].items() if field not in ('datasets', 'buffers')
+        }
+
+      executor = ProcessPoolExecutor(
+        max_workers=RENDER_WORKERS,
+        initializer=attach_shared_source,
+        initargs=(shared_values, source_fields, shared_bands)
+      )
+      logger.info(f"Rendering with {RENDER_WORKERS} worker processes")
+      return {
+        'executor': executor,
+        'shared_memory': shared_blocks,
+        'band_buffers': source['bands']['buffers'] if shared_bands else None,
+        'band_rows': shared_bands['rows'] if shared_bands else 0,
+        'band_control': band_control
+      }
+
+    except OSError as e:
+      logger.warning(f"Shared memory unavailable, rendering with threads: {e}")
+
+  _source = source
+  executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix='render')
+  logger.info(f"Rendering with {RENDER_WORKERS} worker threads")
+
+  return {'executor': executor, 'shared_memory': [], 'band_buffers': None, 'band_rows': 0, 'band_control': None}
+
+def close_render_pool(pool):
+  global _source
+
+  pool['executor'].shutdown(wait=True)
+  _source = None
+
+  # Shared memory can't close while arrays still view it
+  if pool['band_buffers'] is not None:
+    pool['band_buffers'].clear()
+  pool['band_control'] = None
+
+  for block in pool['shared_memory']:
+    block.close()
+    block.unlink()
+
+def replace_render_source(pool, source):
+  """Render later jobs from source. No job may still be running on the pool.
+
+  Worker processes attach their shared memory as they start, so a process
+  pool is started again around the new source.
+  """
+  global _source
+
+  if isinstance(pool['executor'], ThreadPoolExecutor):
+    _source = source
+    return
+
+  close_render_pool(pool)
+  pool.update(create_render_pool(source))
+
+def load_render_band(pool, source, zoom, rows):
+  """Load grid rows [start, stop) of a banded source for later jobs. No job may still be running on the pool.
+
+  A process pool's workers share the band buffers, so the band is read
+  straight into them and the workers are told which rows they now hold.
+  Only a band larger than the shared buffers starts the pool again.
+  """
+  global _source
+  start, stop = rows
+
+  if pool['band_control'] is not None and stop - start > pool['band_rows']:
+    close_render_pool(pool)
+    pool.update(create_render_pool(source, band_rows=stop - start))
+
+  band_source = load_band(source, zoom, rows)
+
+  if pool['band_control'] is None:
+    _source = band_source
+    return
+
+  control = pool['band_control']
+  control[1:] = zoom, start, stop
+  control[0] += 1
+
+def share_source_values(source):
+  shared_values = {}
+  shared_blocks = []
+
+  try:
+    for variable, values in source['values'].items():
+      block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+      shared_blocks.append(block)
+      np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+      shared_values[variable] = (block.name, values.shape, values.dtype.str)
+
+  except OSError:
+    for block in shared_blocks:
+      block.close()
+      block.unlink()
+    raise
+
+  return shared_values, shared_blocks
+
+def share_band_buffers(source, band_rows=0):
+  """Move a banded source's band buffers into shared memory, with a control array naming the band they hold"""
+  bands = source['bands']
+  rows = max(bands['max_rows'], band_rows)
+  frames = len(source['forecast_hours']) if bands['stacked'] else 1
+  size = frames * rows * bands['grid_shape'][1]
+  shared_bands = {'rows': rows, 'buffers': {}}
+  shared_blocks = []
+
+  try:
+    for variable in bands['variables']:
+      block = shared_memory.SharedMemory(create=True, size=max(size * np.dtype(np.float32).itemsize, 1))
+      shared_blocks.append(block)
+      bands['buffers'][variable] = np.ndarray(size, dtype=np.float32, buffer=block.buf)
+      shared_bands['buffers'][variable] = (block.name, size)
+
+    # generation, zoom, start row, stop row
+    block = shared_memory.SharedMemory(create=True, size=4 * np.dtype(np.int64).itemsize)
+    shared_blocks.append(block)
+    shared_bands['control'] = block.name
+    control = np.ndarray(4, dtype=np.int64, buffer=block.buf)
+    control[:] = 0
+
+  except OSError:
+    bands['buffers'].clear()
+    for block in shared_blocks:
+      block.close()
+      block.unlink()
+    raise
+
+  return shared_bands, shared_blocks, control
+
+def attach_shared_block(name):
+  block = shared_memory.SharedMemory(name=name)
+  _attached_memory.append(block)
+  return block.buf
+
+def attach_shared_source(shared_values, source_fields, shared_bands=None):
+  global _source, _banded_source, _band_control
+  values = {}
+
+  # A forked worker starts with a copy of the parent's metrics
+  drain_metrics()
+
+  for variable, (name, shape, dtype) in shared_values.items():
+    values[variable] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=attach_shared_block(name))
+
+  _source = {**source_fields, 'values': values}
+
+  if shared_bands:
+    buffers = {
+      variable: np.ndarray(size, dtype=np.float32, buffer=attach_shared_block(name))
+      for variable, (name, size) in shared_bands['buffers'].items()
+    }
+    _banded_source = {**_source, 'bands': {**source_fields['bands'], 'buffers': buffers}}
+    _band_control = np.ndarray(4, dtype=np.int64, buffer=attach_shared_block(shared_bands['control']))
+
+def follow_band():
+  """In a worker process, render from the band last loaded into the shared band buffers"""
+  global _source, _band_generation
+
+  if _band_control is None or int(_band_control[0]) == _band_generation:
+    return
+
+  generation, zoom, start, stop = (int(value) for value in _band_control)
+  _source = get_band_source(_banded_source, zoom, (start, stop))
+  _band_generation = generation
+
+def render_tile_job(x, y, zoom, variables):
+  follow_band()
+  rendered = []
+
+  for variable, arr in resample_tiles(_source, x, y, zoom, variables):
+    with metric_labels(variable, zoom):
+      try:
+        append_rendered_values(rendered, variable, zoom, x, y, arr)
+      except Exception as e:
+        logger.warning(f"failed to generate tile {zoom}/{x}/{y} for {variable}: {type(e).__name__}: {e}")
+        count('render_errors')
+
+  return finish_render_job(rendered)
+
+def render_pyramid_job(base_x, base_y, zooms, variables):
+  follow_band()
+  rendered = []
+
+  for variable in variables:
+    if variable not in _source['values']:
+      continue
+
+    try:
+      for zoom, x, y, arr in build_pyramid_block(_source, variable, zooms, base_x, base_y):
+        with metric_labels(variable, zoom):
+          append_rendered_values(rendered, variable, zoom, x, y, arr)
+
+    except Exception as e:
+      logger.warning(f"Failed to generate pyramid block {min(zooms)}/{base_x}/{base_y} for {variable}: {type(e).__name__}: {e}")
+      count('render_errors', variable=variable, zoom=min(zooms))
+
+  return finish_render_job(rendered)
+
+def finish_render_job(rendered):
+  """In a worker process, hand the job's metrics back with its tiles"""
+  if _attached_memory:
+    rendered.append({'metrics': drain_metrics()})
+
+  return rendered
+
+def append_rendered_values(rendered, variable, zoom, x, y, arr):
+  """Encode a (rows, cols) tile, or a (hours, rows, cols) stack from a stacked source"""
+  if arr.ndim == 2:
+    append_rendered_tile(rendered, variable, zoom, x, y, arr, _source['forecast_hours'][0])
+    return
+
+  if FORECAST_STACK_MODE != 'stack':
+    for forecast_hour, hour_arr in zip(_source['forecast_hours'], arr):
+      append_rendered_tile(rendered, variable, zoom, x, y, hour_arr, forecast_hour)
+
+  if FORECAST_STACK_MODE != 'hours':
+    tile_data = encode_stacked_tile(arr, variable, f"{zoom}/{x}/{y}")
+    if tile_data:
+      rendered.append({'data': tile_data, 'stacked': True, 'variable': variable, 'zoom': zoom, 'x': x, 'y': y})
+
+def append_rendered_tile(rendered, variable, zoom, x, y, arr, forecast_hour):
+  tile = {'variable': variable, 'forecast_hour': forecast_hour, 'zoom': zoom, 'x': x, 'y': y}
+
+  if VALUE_TILE_MODE != 'only':
+    previous_hashes = _source.get('previous_hashes', {}).get((forecast_hour, variable))
+    result = encode_tile_for_upload(arr, variable, f"{zoom}/{x}/{y}", previous_hashes)
+
+    if result:
+      rendered.append({**result, **tile})
+    else:
+      count('tiles_empty')
+
+  if VALUE_TILE_MODE != 'off':
+    with timed('encode_values'):
+      value_data = encode_value_tile(arr, variable, f"{zoom}/{x}/{y}")
+
+    if value_data:
+      rendered.append({'values': value_data, **tile})
+    elif VALUE_TILE_MODE == 'only':
+      count('tiles_empty')
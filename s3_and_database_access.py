@@ -1,32 +1,104 @@
 from datetime import datetime, timezone
-from utils import build_most_recent_file_stamp, build_s3_filename
-from pymongo import MongoClient
+from utils import build_most_recent_file_stamp, build_s3_filename, build_tile_store_prefix
+from metrics import timed, count
+from concurrency import (
+  get_limiter, limited, record_success, record_failure, is_retryable_error,
+  max_in_flight, MAX_CONCURRENT_UPLOADS, UPLOAD_CONCURRENCY_LIMIT,
+  MAX_CONCURRENT_DOWNLOADS, DOWNLOAD_CONCURRENCY_LIMIT
+)
 import asyncio
+import random
+import threading
 
 import logging
-import boto3
 import os
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-s3_client = boto3.client(
-  's3',
-  region_name=os.getenv('AWS_REGION', 'us-east-1')
-)
+# Built on first use and shared by every module for the life of the container, so
+# control-plane actions that never touch S3 or Mongo don't pay for the connections
+_s3_client = None
+_single_attempt_s3_client = None
+_db = None
+_client_lock = threading.Lock()
 
-mongo_client = MongoClient(
-  os.getenv('ATLAS_URI'),
-  tls=True,
-  tlsAllowInvalidCertificates=True
-)
-db = mongo_client.paladin
+DOWNLOAD_MAX_ATTEMPTS = int(os.getenv('DOWNLOAD_MAX_ATTEMPTS', '3'))
+
+# A NetCDF download's latency follows the file's size, so only throttling moves this limit
+download_limiter = get_limiter('download', MAX_CONCURRENT_DOWNLOADS, DOWNLOAD_CONCURRENCY_LIMIT, watch_latency=False)
+
+def get_s3_client():
+  """The shared S3 client, which retries failed calls itself"""
+  global _s3_client
+
+  if _s3_client is None:
+    with _client_lock:
+      if _s3_client is None:
+        import boto3
+
+        _s3_client = boto3.client(
+          's3',
+          region_name=os.getenv('AWS_REGION', 'us-east-1')
+        )
+
+  return _s3_client
+
+def get_single_attempt_s3_client():
+  """The S3 client for tile writes and NetCDF downloads. Its pool is sized to the most
+  uploads the upload limiter allows, and it makes a single attempt per call because
+  those callers retry with backoff and the limiter needs to see every throttled response"""
+  global _single_attempt_s3_client
+
+  if _single_attempt_s3_client is None:
+    with _client_lock:
+      if _single_attempt_s3_client is None:
+        import boto3
+        from botocore.config import Config
+
+        _single_attempt_s3_client = boto3.client(
+          's3',
+          region_name=os.getenv('AWS_REGION', 'us-east-1'),
+          config=Config(
+            max_pool_connections=max_in_flight(MAX_CONCURRENT_UPLOADS, UPLOAD_CONCURRENCY_LIMIT),
+            retries={'max_attempts': 1, 'mode': 'standard'}
+          )
+        )
+
+  return _single_attempt_s3_client
+
+def get_db():
+  global _db
+
+  if _db is None:
+    with _client_lock:
+      if _db is None:
+        from pymongo import MongoClient
+
+        mongo_client = MongoClient(
+          os.getenv('ATLAS_URI'),
+          tls=True,
+          tlsAllowInvalidCertificates=True
+        )
+        _db = mongo_client.paladin
+
+  return _db
+
+def use_clients(s3_client=None, db=None):
+  """Replace the shared clients, e.g. with local stand-ins"""
+  global _s3_client, _single_attempt_s3_client, _db
+
+  with _client_lock:
+    if s3_client is not None:
+      _s3_client = _single_attempt_s3_client = s3_client
+    if db is not None:
+      _db = db
 
 async def look_for_current_tiles(override=None):
   try:
     current_timestamp = build_most_recent_file_stamp(override=override)
 
-    tile_status = db.tileStatus.find_one({
+    tile_status = get_db().tileStatus.find_one({
         'modelRun': current_timestamp
     })
     
@@ -52,7 +124,7 @@ async def check_for_current_weather_files(override=None):
     
     logger.info(f"Checking for weather file: {test_file}")
     
-    s3_client.head_object(
+    get_s3_client().head_object(
         Bucket=os.getenv('S3_WEATHER_BUCKET', 'paladinoutputs'),
         Key=test_file
     )
@@ -72,11 +144,26 @@ async def check_for_current_weather_files(override=None):
     logger.error(f"Error checking for weather files: {error}")
     raise
 
-async def download_multiple_netcdf_files(download_tasks):
-  max_concurrent_downloads = int(os.getenv('MAX_CONCURRENT_DOWNLOADS', 2))
-  semaphore = asyncio.Semaphore(max_concurrent_downloads)
+def build_netcdf_range_url(s3_key):
+  """Presigned URL that netCDF4 reads with HTTP range requests instead of a download"""
+  url = get_s3_client().generate_presigned_url(
+    'get_object',
+    Params={'Bucket': os.getenv('S3_WEATHER_BUCKET', 'paladinoutputs'), 'Key': s3_key},
+    ExpiresIn=int(os.getenv('NETCDF_URL_EXPIRY', '3600'))
+  )
+  return f"{url}#mode=bytes"
+
+def open_run_store(timestamp):
+  from tile_store import open_s3_store
 
-  tasks = [download_netcdf_file(s3_key, local_path, forecast_hour, semaphore) 
+  return open_s3_store(
+    get_s3_client(),
+    os.getenv('TILE_STORE_BUCKET', os.getenv('S3_TILES_BUCKET', 'custom-tiles')),
+    build_tile_store_prefix(timestamp)
+  )
+
+async def download_multiple_netcdf_files(download_tasks):
+  tasks = [download_netcdf_file(s3_key, local_path, forecast_hour) 
     for s3_key, local_path, forecast_hour in download_tasks]
   
   # Wait for all downloads to complete
@@ -85,46 +172,59 @@ async def download_multiple_netcdf_files(download_tasks):
   # Return only successful downloads
   return [result for result in results if result is not None]
 
-async def download_netcdf_file(s3_key, local_path, forecast_hour, semaphore):
-  async with semaphore:
-    # Ensure directory exists
-    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+async def download_netcdf_file(s3_key, local_path, forecast_hour):
+  # Ensure directory exists
+  os.makedirs(os.path.dirname(local_path), exist_ok=True)
 
-    if os.path.exists(local_path):
-      logger.info(f"File already exists: {local_path}")
-      success = True
-    else:
-      try:
-        logger.info(f"Downloading: {s3_key} -> {local_path}")
-        
-        # Run the sync S3 download in thread pool to avoid blocking
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-          None,
-          s3_client.download_file,
-          os.getenv('S3_WEATHER_BUCKET', 'paladinoutputs'),
-          s3_key,
-          local_path
-        )
-        
-        logger.info(f"Downloaded: {s3_key}")
-        success = True
-          
-      except Exception as error:
-        logger.error(f"Failed to download {s3_key}: {error}")
-        success = False
+  if os.path.exists(local_path):
+    logger.info(f"File already exists: {local_path}")
+    success = True
+  else:
+    success = await fetch_netcdf_file(s3_key, local_path)
 
   if forecast_hour is not None:
     return (local_path, forecast_hour) if success else None
   else:
     return success
+
+async def fetch_netcdf_file(s3_key, local_path):
+  loop = asyncio.get_running_loop()
+
+  for attempt in range(1, DOWNLOAD_MAX_ATTEMPTS + 1):
+    try:
+      async with limited(download_limiter) as slot:
+        logger.info(f"Downloading: {s3_key} -> {local_path}")
+
+        # Run the sync S3 download in thread pool to avoid blocking
+        with timed('download'):
+          await loop.run_in_executor(
+            None,
+            get_single_attempt_s3_client().download_file,
+            os.getenv('S3_WEATHER_BUCKET', 'paladinoutputs'),
+            s3_key,
+            local_path
+          )
+        record_success(download_limiter, slot)
+
+      logger.info(f"Downloaded: {s3_key}")
+      return True
+
+    except Exception as error:
+      retry_after = record_failure(download_limiter, error)
+
+      if attempt == DOWNLOAD_MAX_ATTEMPTS or not is_retryable_error(error):
+        logger.error(f"Failed to download {s3_key}: {error}")
+        return False
+
+      delay = retry_after or random.uniform(0, 2 ** attempt)
+      logger.warning(f"Retrying download of {s3_key} in {delay:.2f}s: {error}")
+      count('download_retries')
+      await asyncio.sleep(delay)
   
   
 async def mark_tiles_complete(timestamp):
-  from s3_and_database_access import db
-  
   try:
-    db.tileStatus.update_one(
+    get_db().tileStatus.update_one(
       {'modelRun': timestamp},
       {
         '$set': {
@@ -0,0 +1,436 @@
+"""Split a model run's tile generation into balanced shards for a Step Functions Map state.
+
+A shard is one variable and forecast hour over one or more zooms, cut into
+stripes of tile columns when its tiles would take longer than
+SHARD_TARGET_SECONDS to render:
+
+  {'id': 'wspd-03-z10-x156-197', 'variables': ['wspd'], 'forecast_hour': '03',
+   'zooms': [10], 'x_range': [156, 197], 'seconds': 212.4}
+
+x_range is in tile columns of the shard's lowest zoom and takes in the
+columns under them at its higher zooms; None is every column. The estimated
+seconds come from a per-tile cost model, so a run takes about as long as its
+largest shard instead of its slowest variable.
+
+  python shard_planner.py > StepFunctionGenerator.json
+
+writes the state machine that plans the shards and renders them in a Map state.
+"""
+import heapq
+import json
+import logging
+import math
+import os
+
+from tile_config import TARGET_ZOOM_LEVELS, TILE_BUILD_MODE, TILE_OUTPUT
+from utils import get_tile_ranges_for_zoom
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SHARD_TARGET_SECONDS = float(os.getenv('SHARD_TARGET_SECONDS', '240'))
+SHARD_MAX_CONCURRENCY = int(os.getenv('SHARD_MAX_CONCURRENCY', '40'))
+SHARD_MAX_ATTEMPTS = int(os.getenv('SHARD_MAX_ATTEMPTS', '3'))
+SHARD_COST_MODEL = os.getenv('SHARD_COST_MODEL', '')
+FUNCTION_NAME = os.getenv('TILE_FUNCTION_NAME', 'custom-tile-generator')
+
+# Seconds to render and upload one tile, by variable (or by variable and
+# zoom, as {'default': seconds, '<zoom>': seconds}), and the fixed cost of a
+# shard: download, open and resampling index. SHARD_COST_MODEL names a JSON
+# file of measured values to use instead, such as the one written by
+# python -m benchmarks.pipeline_benchmark --cost-model PATH
+DEFAULT_COST_MODEL = {
+  'tile_seconds': {'default': 0.012},
+  'shard_seconds': 20
+}
+
+def load_cost_model(path=SHARD_COST_MODEL):
+  if not path:
+    return DEFAULT_COST_MODEL
+
+  with open(path) as f:
+    measured = json.load(f)
+
+  return {
+    'tile_seconds': {**DEFAULT_COST_MODEL['tile_seconds'], **measured.get('tile_seconds', {})},
+    'shard_seconds': measured.get('shard_seconds', DEFAULT_COST_MODEL['shard_seconds'])
+  }
+
+def get_tile_seconds(cost_model, variable, zoom):
+  tile_seconds = cost_model['tile_seconds']
+  seconds = tile_seconds.get(variable, tile_seconds['default'])
+
+  if isinstance(seconds, dict):
+    seconds = seconds.get(str(zoom), seconds['default'])
+
+  return seconds
+
+def plan_shards(variables, forecast_hours, zooms=None, cost_model=None, target_seconds=SHARD_TARGET_SECONDS):
+  """Shards covering every variable, forecast hour and zoom, the most costly first.
+
+  A Map state starts its items in order, so the largest shards start before
+  the small ones that fill in around them.
+  """
+  zooms = sorted(zooms or TARGET_ZOOM_LEVELS)
+  cost_model = cost_model or load_cost_model()
+  shards = []
+
+  for forecast_hour in forecast_hours:
+    for variable in variables:
+      for zoom_group in group_zooms(variable, zooms, cost_model, target_seconds):
+        column_costs = get_column_costs(variable, zoom_group, cost_model)
+        cost = sum(column_costs.values())
+
+        # An archive is one multipart upload, which a shard cannot share
+        stripes = 1 if TILE_OUTPUT == 'archive' else math.ceil(cost / target_seconds)
+
+        if stripes <= 1:
+          shards.append(build_shard(variable, forecast_hour, zoom_group, None, cost + cost_model['shard_seconds']))
+          continue
+
+        column_groups = split_columns(column_costs, stripes)
+
+        for stripe, columns in enumerate(column_groups):
+          # The tile ranges are estimates, so the outer stripes run to the
+          # edge of the world to take in any data beyond them
+          x_min = 0 if stripe == 0 else columns[0]
+          x_max = 2 ** min(zoom_group) - 1 if stripe == len(column_groups) - 1 else columns[-1]
+
+          stripe_cost = sum(column_costs[x] for x in columns)
+          shards.append(build_shard(
+            variable, forecast_hour, zoom_group, [x_min, x_max], stripe_cost + cost_model['shard_seconds']
+          ))
+
+  shards.sort(key=lambda shard: shard['seconds'], reverse=True)
+
+  return shards
+
+def group_zooms(variable, zooms, cost_model, target_seconds):
+  """Zooms rendered together: all of them for pyramids and archives, else whole zooms up to the target"""
+  if TILE_BUILD_MODE == 'pyramid' or TILE_OUTPUT == 'archive':
+    return [zooms]
+
+  groups = [[]]
+  group_cost = 0
+
+  for zoom in zooms:
+    zoom_cost = sum(get_column_costs(variable, [zoom], cost_model).values())
+
+    if groups[-1] and group_cost + zoom_cost > target_seconds:
+      groups.append([])
+      group_cost = 0
+
+    groups[-1].append(zoom)
+    group_cost += zoom_cost
+
+  return groups
+
+def get_column_costs(variable, zooms, cost_model):
+  """{x: seconds} for each tile column of the lowest zoom, with every zoom's tiles beneath it"""
+  base_zoom = min(zooms)
+  base_range = get_tile_ranges_for_zoom(base_zoom)
+  column_costs = {x: 0.0 for x in range(base_range['x_min'], base_range['x_max'] + 1)}
+
+  for zoom in zooms:
+    tile_range = get_tile_ranges_for_zoom(zoom)
+    column_tiles = tile_range['y_max'] - tile_range['y_min'] + 1
+    tile_seconds = get_tile_seconds(cost_model, variable, zoom)
+
+    for x in range(tile_range['x_min'], tile_range['x_max'] + 1):
+      base_x = x >> (zoom - base_zoom)
+      if base_x in column_costs:
+        column_costs[base_x] += column_tiles * tile_seconds
+
+  return column_costs
+
+def split_columns(column_costs, stripes):
+  """Contiguous runs of columns with close to equal cost"""
+  columns = sorted(column_costs)
+  stripes = min(stripes, len(columns))
+  total = sum(column_costs.values())
+
+  groups = [[]]
+  spent = 0.0
+
+  for x in columns:
+    groups[-1].append(x)
+    spent += column_costs[x]
+
+    if len(groups) < stripes and spent >= total * len(groups) / stripes:
+      groups.append([])
+
+  return [group for group in groups if group]
+
+def build_shard(variable, forecast_hour, zooms, x_range, seconds):
+  shard_id = f"{variable}-{forecast_hour}-z{'.'.join(str(zoom) for zoom in zooms)}"
+  if x_range:
+    shard_id += f"-x{x_range[0]}-{x_range[1]}"
+
+  return {
+    'id': shard_id,
+    'variables': [variable],
+    'forecast_hour': forecast_hour,
+    'zooms': zooms,
+    'x_range': x_range,
+    'seconds': round(seconds, 1)
+  }
+
+def estimate_run_seconds(shards, max_concurrency=SHARD_MAX_CONCURRENCY):
+  """Wall-clock seconds for the Map state to work through the shards in order"""
+  running = [0.0] * min(max_concurrency, len(shards))
+
+  for shard in shards:
+    heapq.heappush(running, heapq.heappop(running) + shard['seconds'])
+
+  return max(running, default=0.0)
+
+def summarize_plan(shards, max_concurrency=SHARD_MAX_CONCURRENCY):
+  return {
+    'shards': shards,
+    'shard_count': len(shards),
+    'largest_shard_seconds': max((shard['seconds'] for shard in shards), default=0.0),
+    'estimated_seconds': round(estimate_run_seconds(shards, max_concurrency), 1)
+  }
+
+def lambda_task(payload, **fields):
+  return {
+    'Type': 'Task',
+    'Resource': 'arn:aws:states:::lambda:invoke',
+    'Parameters': {'FunctionName': FUNCTION_NAME, 'Payload': payload},
+    **fields
+  }
+
+def build_state_machine(variables, forecast_hours, max_concurrency=SHARD_MAX_CONCURRENCY):
+  """The Step Functions definition: checks, plan_shards, a Map over process_shard, then finish_shards.
+
+  Each Map iteration reruns a 'partial' shard, which resumes from its
+  checkpoint, up to SHARD_MAX_ATTEMPTS times. A shard that errors is recorded
+  and the others carry on; the run is only marked complete once every shard
+  has succeeded.
+  """
+  lambda_retry = [{
+    'ErrorEquals': [
+      'Lambda.ServiceException', 'Lambda.AWSLambdaException',
+      'Lambda.SdkClientException', 'Lambda.TooManyRequestsException'
+    ],
+    'IntervalSeconds': 2,
+    'MaxAttempts': 6,
+    'BackoffRate': 2
+  }]
+
+  shard_states = {
+    'ProcessShard': lambda_task(
+      {'action': 'process_shard', 'shard.$': '$.shard', 'override_timestamp.$': '$.override_timestamp'},
+      ResultSelector={'tiles_generated.$': '$.Payload.tiles_generated', 'status.$': '$.Payload.status'},
+      ResultPath='$.result',
+      Retry=lambda_retry,
+      Catch=[{'ErrorEquals': ['States.ALL'], 'ResultPath': '$.error', 'Next': 'ShardFailed'}],
+      Next='CountShardTiles'
+    ),
+    'CountShardTiles': {
+      'Type': 'Pass',
+      'Parameters': {
+        'shard.$': '$.shard',
+        'override_timestamp.$': '$.override_timestamp',
+        'tiles_generated.$': 'States.MathAdd($.tiles_generated, $.result.tiles_generated)',
+        'attempts.$': 'States.MathAdd($.attempts, 1)',
+        'status.$': '$.result.status'
+      },
+      'Next': 'ShardPartial?'
+    },
+    'ShardPartial?': {
+      'Type': 'Choice',
+      'Choices': [{
+        'And': [
+          {'Variable': '$.status', 'StringEquals': 'partial'},
+          {'Variable': '$.attempts', 'NumericLessThan': SHARD_MAX_ATTEMPTS}
+        ],
+        'Next': 'ProcessShard'
+      }],
+      'Default': 'ShardDone'
+    },
+    'ShardDone': {
+      'Type': 'Pass',
+      'Parameters': {'shard.$': '$.shard.id', 'tiles_generated.$': '$.tiles_generated', 'status.$': '$.status'},
+      'End': True
+    },
+    'ShardFailed': {
+      'Type': 'Pass',
+      'Parameters': {'shard.$': '$.shard.id', 'tiles_generated.$': '$.tiles_generated', 'status': 'error'},
+      'End': True
+    }
+  }
+
+  states = {
+    'InitializeWorkflow': {
+      'Type': 'Pass',
+      'Result': {'variables': variables, 'forecast_hours': forecast_hours, 'override_timestamp': None},
+      'Comment': 'Set up initial workflow parameters',
+      'Next': 'CheckKillSwitch'
+    },
+    'CheckKillSwitch': lambda_task(
+      {'action': 'check_kill_switch'},
+      ResultPath='$.kill_switch_result',
+      Next='KillSwitchActive?'
+    ),
+    'KillSwitchActive?': {
+      'Type': 'Choice',
+      'Choices': [{
+        'Variable': '$.kill_switch_result.Payload.kill_switch_active',
+        'BooleanEquals': True,
+        'Next': 'WorkflowStopped'
+      }],
+      'Default': 'CheckExistingTiles'
+    },
+    'CheckExistingTiles': lambda_task(
+      {'action': 'check_existing_tiles', 'override_timestamp.$': '$.override_timestamp'},
+      ResultPath='$.tiles_check_result',
+      Next='TilesAlreadyExist?'
+    ),
+    'TilesAlreadyExist?': {
+      'Type': 'Choice',
+      'Choices': [{
+        'Variable': '$.tiles_check_result.Payload.tiles_exist',
+        'BooleanEquals': True,
+        'Next': 'TilesExistComplete'
+      }],
+      'Default': 'CheckWeatherFiles'
+    },
+    'CheckWeatherFiles': lambda_task(
+      {'action': 'check_weather_files', 'override_timestamp.$': '$.override_timestamp'},
+      ResultPath='$.weather_check_result',
+      Next='WeatherFilesExist?'
+    ),
+    'WeatherFilesExist?': {
+      'Type': 'Choice',
+      'Choices': [{
+        'Variable': '$.weather_check_result.Payload.files_exist',
+        'BooleanEquals': False,
+        'Next': 'NoWeatherFiles'
+      }],
+      'Default': 'PlanShards'
+    },
+    'PlanShards': lambda_task(
+      {
+        'action': 'plan_shards',
+        'variables.$': '$.variables',
+        'forecast_hours.$': '$.forecast_hours'
+      },
+      ResultSelector={'shards.$': '$.Payload.shards', 'estimated_seconds.$': '$.Payload.estimated_seconds'},
+      ResultPath='$.plan',
+      Next='ProcessShards'
+    ),
+    'ProcessShards': {
+      'Type': 'Map',
+      'Comment': 'Render the planned shards, largest first',
+      'ItemsPath': '$.plan.shards',
+      'ItemSelector': {
+        'shard.$': '$$.Map.Item.Value',
+        'override_timestamp.$': '$.override_timestamp',
+        'tiles_generated': 0,
+        'attempts': 0
+      },
+      'MaxConcurrency': max_concurrency,
+      'ItemProcessor': {
+        'ProcessorConfig': {'Mode': 'INLINE'},
+        'StartAt': 'ProcessShard',
+        'States': shard_states
+      },
+      'ResultPath': '$.shard_results',
+      'Next': 'FinishShards'
+    },
+    'FinishShards': lambda_task(
+      {
+        'action': 'finish_shards',
+        'shards.$': '$.plan.shards',
+        'results.$': '$.shard_results',
+        'override_timestamp.$': '$.override_timestamp'
+      },
+      ResultSelector={
+        'total_tiles_generated.$': '$.Payload.total_tiles_generated',
+        'incomplete_shards.$': '$.Payload.incomplete_shards'
+      },
+      ResultPath='$.finish',
+      Next='ShardsIncomplete?'
+    ),
+    'ShardsIncomplete?': {
+      'Type': 'Choice',
+      'Choices': [{
+        'Variable': '$.finish.incomplete_shards[0]',
+        'IsPresent': True,
+        'Next': 'ShardsIncomplete'
+      }],
+      'Default': 'MarkTilesComplete'
+    },
+    'MarkTilesComplete': lambda_task(
+      {
+        'action': 'mark_tiles_complete',
+        'total_tiles_generated.$': '$.finish.total_tiles_generated',
+        'override_timestamp.$': '$.override_timestamp'
+      },
+      ResultPath='$.mark_complete_result',
+      Next='WorkflowComplete'
+    ),
+    'WorkflowComplete': {
+      'Type': 'Pass',
+      'Parameters': {
+        'status': 'completed',
+        'message': 'All shards processed successfully',
+        'total_tiles_generated.$': '$.finish.total_tiles_generated',
+        'shards_processed.$': 'States.ArrayLength($.plan.shards)',
+        'completed_at.$': '$$.State.EnteredTime'
+      },
+      'End': True
+    },
+    'ShardsIncomplete': {
+      'Type': 'Pass',
+      'Parameters': {
+        'status': 'partial',
+        'message': 'Some shards did not finish; rerun to resume them',
+        'total_tiles_generated.$': '$.finish.total_tiles_generated',
+        'incomplete_shards.$': '$.finish.incomplete_shards'
+      },
+      'End': True
+    },
+    'TilesExistComplete': {
+      'Type': 'Pass',
+      'Result': {
+        'status': 'skipped',
+        'message': 'Tiles already exist for current timestamp',
+        'total_tiles_generated': 0,
+        'reason': 'tiles_already_exist'
+      },
+      'End': True
+    },
+    'NoWeatherFiles': {
+      'Type': 'Pass',
+      'Result': {
+        'status': 'skipped',
+        'message': 'No weather files available for processing',
+        'total_tiles_generated': 0,
+        'reason': 'no_weather_files'
+      },
+      'End': True
+    },
+    'WorkflowStopped': {
+      'Type': 'Pass',
+      'Result': {
+        'status': 'stopped',
+        'message': 'Workflow stopped by kill switch',
+        'total_tiles_generated': 0,
+        'reason': 'kill_switch_active'
+      },
+      'End': True
+    }
+  }
+
+  return {
+    'Comment': 'Weather tile generation workflow - sharded Map processing',
+    'StartAt': 'InitializeWorkflow',
+    'States': states
+  }
+
+if __name__ == '__main__':
+  from lambda_function import VARIABLES
+
+  print(json.dumps(build_state_machine(VARIABLES, ['01']), indent=2))
@@ -0,0 +1,185 @@
+"""Row-band source loading, for grids too large to hold in memory at once.
+
+With SOURCE_LOADING=bands the render source keeps the opened datasets instead
+of every variable's whole grid. Each zoom (or pyramid) is rendered one band
+of tile rows at a time: the grid rows the band's tiles read are loaded into
+buffers allocated once per source, its tiles are rendered, and the next band
+overwrites them. Only the valid-data mask, one byte per grid cell, covers the
+whole grid, so peak memory follows BAND_MEMORY_MB instead of the grid size or
+the zoom. The price is reading the grid once per zoom, plus once for the mask.
+Under RENDER_EXECUTOR=process the buffers are shared memory, which the
+worker processes render from in place.
+"""
+import logging
+import os
+import numpy as np
+
+from tile_index import get_tile_index, get_tile_occupancy, tile_read_spans
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# full: load every variable's whole grid before rendering
+# bands: load and render one band of tile rows at a time, within BAND_MEMORY_MB
+SOURCE_LOADING = os.getenv('SOURCE_LOADING', 'full')
+BAND_MEMORY_MB = float(os.getenv('BAND_MEMORY_MB', '256'))
+
+def prepare_banded_source(datasets, variables, zooms, stacked=False):
+  """The resampling index and tile occupancy of the datasets' grid, with the data left unread.
+
+  datasets maps forecast hour to dataset, in frame order, and must share a
+  grid. Stacked bands are (hours, rows, cols) as from
+  prepare_stacked_tile_source; otherwise there is one hour and bands are
+  (rows, cols).
+  """
+  forecast_hours = list(datasets)
+  first = datasets[forecast_hours[0]]
+  present = []
+
+  for variable in variables:
+    missing = [forecast_hour for forecast_hour in forecast_hours if variable not in datasets[forecast_hour].data_vars]
+    if missing:
+      logger.warning(f"Variable {variable} not found in forecast hours {missing}")
+      continue
+    present.append(variable)
+
+  lats, lons = first['lat'].values, first['lon'].values
+  grid_shape = (len(lats), len(lons))
+  frames = len(forecast_hours) if stacked else 1
+
+  # Every variable's band, plus the one being read into them
+  row_bytes = grid_shape[1] * np.dtype(np.float32).itemsize * (len(present) * frames + 1)
+  max_rows = max(int(BAND_MEMORY_MB * 2**20) // row_bytes, 1)
+
+  with timed('index'):
+    tile_index = get_tile_index(lats, lons, zooms)
+
+    if present:
+      occupancy = get_tile_occupancy(tile_index, read_valid_mask(datasets, present, grid_shape, max_rows), zooms)
+    else:
+      occupancy = {zoom: {'x0': 0, 'y0': 0, 'tiles': np.zeros((0, 0), dtype=bool)} for zoom in zooms}
+
+  logger.info(f"Loading {grid_shape[0]}x{grid_shape[1]} grid in bands of up to {max_rows} rows")
+
+  return {
+    'values': {},
+    'index': tile_index,
+    'occupancy': occupancy,
+    'forecast_hours': forecast_hours,
+    'bands': {
+      'datasets': datasets,
+      'variables': present,
+      'stacked': stacked,
+      'grid_shape': grid_shape,
+      'max_rows': max_rows,
+      'buffers': {}
+    }
+  }
+
+def get_source_variables(source):
+  return source['bands']['variables'] if 'bands' in source else list(source['values'])
+
+def read_rows(dataset, variable, start, stop):
+  return dataset[variable].isel(lat=slice(start, stop)).transpose('lat', 'lon').values
+
+def read_valid_mask(datasets, variables, grid_shape, max_rows):
+  """Cells where any variable has data in any forecast hour, read max_rows at a time"""
+  valid_mask = np.zeros(grid_shape, dtype=bool)
+
+  for start in range(0, grid_shape[0], max_rows):
+    stop = min(start + max_rows, grid_shape[0])
+
+    for variable in variables:
+      for dataset in datasets.values():
+        with timed('sample', variable=variable):
+          valid_mask[start:stop] |= ~np.isnan(read_rows(dataset, variable, start, stop))
+
+  return valid_mask
+
+def plan_bands(source, zoom, tile_rows, span=1):
+  """Group tile rows into bands whose grid rows fit the band buffers.
+
+  tile_rows are sorted rows of tiles at zoom or, with span > 1, rows of
+  blocks that are each span tile rows of zoom, as pyramid blocks are of the
+  top zoom. Returns ({tile_row: band}, [(row_start, row_stop)]); a band
+  outgrows the budget only when a single tile row reads more than it.
+  """
+  zoom_index = source['index']['zooms'][zoom]
+  max_rows = source['bands']['max_rows']
+  starts, stops = tile_read_spans(zoom_index['row_index'], source['bands']['grid_shape'][0])
+
+  band_of = {}
+  bands = []
+
+  for tile_row in tile_rows:
+    first = max(tile_row * span - zoom_index['y0'], 0)
+    last = max((tile_row + 1) * span - zoom_index['y0'], 0)
+    row_starts, row_stops = starts[first:last], stops[first:last]
+    reads = row_starts < row_stops
+
+    if reads.any():
+      start, stop = int(row_starts[reads].min()), int(row_stops[reads].max())
+
+      if not bands or bands[-1] is None:
+        bands[-1:] = [(start, stop)]
+      elif max(stop, bands[-1][1]) - min(start, bands[-1][0]) <= max_rows:
+        bands[-1] = (min(start, bands[-1][0]), max(stop, bands[-1][1]))
+      else:
+        bands.append((start, stop))
+
+    elif not bands:
+      # Rows that read no grid cells ride along with the next band
+      bands.append(None)
+
+    band_of[tile_row] = len(bands) - 1
+
+  return band_of, [band or (0, 0) for band in bands]
+
+def load_band(source, zoom, rows):
+  """A render source holding grid rows [start, stop) of every variable, with zoom's index shifted to match"""
+  bands = source['bands']
+  start, stop = rows
+  frames, shape = get_band_shape(source, rows)
+  size = int(np.prod(shape))
+
+  for variable in bands['variables']:
+    buffer = bands['buffers'].get(variable)
+    if buffer is None or buffer.size < size:
+      buffer = bands['buffers'][variable] = np.empty(max(size, frames * bands['max_rows'] * shape[-1]), dtype=np.float32)
+
+    band = buffer[:size].reshape(shape)
+
+    with timed('sample', variable=variable):
+      for frame, dataset in enumerate(bands['datasets'].values()):
+        band[frame if bands['stacked'] else ...] = read_rows(dataset, variable, start, stop)
+
+  return get_band_source(source, zoom, rows)
+
+def get_band_source(source, zoom, rows):
+  """The render source over grid rows [start, stop) as last loaded into the band buffers"""
+  bands = source['bands']
+  start, stop = rows
+  _, shape = get_band_shape(source, rows)
+  size = int(np.prod(shape))
+
+  # A prefix of the flat buffer, so the band is contiguous like a whole grid
+  values = {variable: bands['buffers'][variable][:size].reshape(shape) for variable in bands['variables']}
+
+  zoom_index = source['index']['zooms'][zoom]
+  row_index = np.where(zoom_index['row_index'] >= 0, zoom_index['row_index'] - start, -1).astype(np.int32)
+
+  return {
+    'values': values,
+    'index': {**source['index'], 'zooms': {zoom: {**zoom_index, 'row_index': row_index}}},
+    'occupancy': source['occupancy'],
+    'forecast_hours': source['forecast_hours'],
+    'previous_hashes': source.get('previous_hashes', {})
+  }
+
+def get_band_shape(source, rows):
+  """(frames, shape) of a band of grid rows [start, stop)"""
+  bands = source['bands']
+  frames = len(source['forecast_hours']) if bands['stacked'] else 1
+
+  return frames, ((frames,) if bands['stacked'] else ()) + (rows[1] - rows[0], bands['grid_shape'][1])
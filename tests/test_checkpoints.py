@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+import checkpoints
+from checkpoints import (
+  create_checkpointer, track_job, seal_job, fail_job, finish_job_upload, flush_checkpoint
+)
+
+@pytest.fixture
+def saved(monkeypatch):
+  """Progress as each checkpoint write would have stored it"""
+  writes = []
+  monkeypatch.setattr(checkpoints, 'CHECKPOINT_INTERVAL', 0)
+  monkeypatch.setattr(checkpoints, 'save_progress', lambda progress: writes.append(progress))
+  return writes
+
+def new_progress():
+  return {'timestamp': '2026/10/17/00', 'variable': 'wspd', 'forecast_hour': '01', 'completed_zooms': []}
+
+def start_job(checkpointer, last_x, uploads):
+  job = track_job(checkpointer, {'current_zoom': 8, 'last_x': last_x, 'last_y': 0})
+  job['uploads'] = uploads
+  return job
+
+def test_progress_waits_for_every_upload(saved):
+  async def run():
+    progress = new_progress()
+    checkpointer = create_checkpointer(progress)
+    first, second = start_job(checkpointer, 10, 2), start_job(checkpointer, 11, 1)
+    seal_job(checkpointer, first)
+    seal_job(checkpointer, second)
+
+    # The later job's upload finishing first doesn't move progress past the earlier job
+    finish_job_upload(checkpointer, second, True)
+    finish_job_upload(checkpointer, first, True)
+    assert 'last_x' not in progress
+
+    finish_job_upload(checkpointer, first, True)
+    assert progress['last_x'] == 11
+
+    await flush_checkpoint(checkpointer)
+    assert saved[-1]['last_x'] == 11 and not checkpointer['failed']
+
+  asyncio.run(run())
+
+def test_failed_upload_holds_progress(saved):
+  async def run():
+    progress = new_progress()
+    checkpointer = create_checkpointer(progress)
+    jobs = [start_job(checkpointer, last_x, 1) for last_x in (10, 11, 12)]
+    for job in jobs:
+      seal_job(checkpointer, job)
+
+    finish_job_upload(checkpointer, jobs[0], True)
+    finish_job_upload(checkpointer, jobs[1], False)
+    finish_job_upload(checkpointer, jobs[2], True)
+
+    await flush_checkpoint(checkpointer)
+    assert progress['last_x'] == 10
+    assert all(write['last_x'] == 10 for write in saved)
+    assert checkpointer['failed']
+
+  asyncio.run(run())
+
+def test_failed_render_holds_progress(saved):
+  async def run():
+    progress = new_progress()
+    checkpointer = create_checkpointer(progress)
+    first, failed, last = (start_job(checkpointer, last_x, 0) for last_x in (10, 11, 12))
+
+    seal_job(checkpointer, first)
+
+    # A job whose render raised is sealed with no uploads, but must not count as done
+    fail_job(checkpointer, failed)
+    seal_job(checkpointer, failed)
+    seal_job(checkpointer, last)
+
+    await flush_checkpoint(checkpointer)
+    assert progress['last_x'] == 10
+    assert saved[-1]['last_x'] == 10
+    assert checkpointer['failed']
+
+  asyncio.run(run())
+
+def test_failed_write_is_retried(monkeypatch):
+  writes = []
+
+  def save_progress(progress):
+    writes.append(progress)
+    if len(writes) == 1:
+      raise ConnectionError('Mongo unavailable')
+
+  monkeypatch.setattr(checkpoints, 'CHECKPOINT_INTERVAL', 0)
+  monkeypatch.setattr(checkpoints, 'save_progress', save_progress)
+
+  async def run():
+    checkpointer = create_checkpointer(new_progress())
+    job = start_job(checkpointer, 10, 0)
+    seal_job(checkpointer, job)
+
+    await flush_checkpoint(checkpointer)
+    assert len(writes) == 2 and writes[-1]['last_x'] == 10
+    assert not checkpointer['dirty']
+
+  asyncio.run(run())
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from color_maps import COLOR_SCALES, colorize
+
+RAMP_VARIABLES = [variable for variable, scale in COLOR_SCALES.items() if scale['type'] == 'ramp']
+
+def apply_baseline_ramp(arr, max_value):
+  """The per-pixel ramp the LUTs replaced"""
+  rgba = np.zeros((*arr.shape, 4), dtype=np.uint8)
+  ratio = np.clip(np.where(np.isnan(arr), 0, arr) / max_value, 0, 1)
+  rgba[:, :, 0] = (ratio * 255).astype(np.uint8)
+  rgba[:, :, 1] = ((1 - ratio) * 255).astype(np.uint8)
+  rgba[:, :, 3] = 255
+  return rgba
+
+@pytest.mark.parametrize('variable', RAMP_VARIABLES)
+def test_ramp_matches_baseline(variable):
+  max_value = COLOR_SCALES[variable]['max_value']
+  rng = np.random.default_rng(6)
+  values = rng.uniform(-0.1 * max_value, 1.2 * max_value, (200, 200)).astype(np.float32)
+  # A 256-colour palette has one green per red level; the first bin keeps the
+  # shade of 0, which missing values are drawn as
+  first_bin = (values > 0) & (values < max_value / 255)
+  values[first_bin] = 0
+  values[0, :4] = np.nan, 0, max_value, -1
+
+  np.testing.assert_array_equal(colorize(values, variable), apply_baseline_ramp(values, max_value))
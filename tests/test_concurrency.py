@@ -0,0 +1,173 @@
+import asyncio
+import time
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError, ReadTimeoutError
+
+import concurrency
+from concurrency import (
+  DECREASE_FACTOR, MAX_RETRY_AFTER, get_limiter, get_slots, get_queue, limited, record_success,
+  record_failure, get_retry_after, is_retryable_error, is_throttle_error
+)
+
+@pytest.fixture(autouse=True)
+def limiters(monkeypatch):
+  monkeypatch.setattr(concurrency, '_limiters', {})
+  monkeypatch.setattr(concurrency, 'CONCURRENCY_CONTROL', 'adaptive')
+
+def client_error(code, status=400, retry_after=None):
+  headers = {'retry-after': retry_after} if retry_after is not None else {}
+  return ClientError({
+    'Error': {'Code': code},
+    'ResponseMetadata': {'HTTPStatusCode': status, 'HTTPHeaders': headers}
+  }, 'PutObject')
+
+async def hold_slots(limiter, count):
+  """Take count slots, no more than the limit, at once and report each as a success"""
+  started = asyncio.Event()
+  slots = []
+
+  async def request():
+    async with limited(limiter) as slot:
+      slots.append(slot)
+      if len(slots) == count:
+        started.set()
+      await started.wait()
+      record_success(limiter, slot)
+
+  await asyncio.gather(*(request() for _ in range(count)))
+  return slots
+
+def test_limit_grows_only_when_saturated():
+  async def run():
+    limiter = get_limiter('grow', 4, 8)
+
+    await hold_slots(limiter, 1)
+    assert limiter['limit'] == 4
+
+    await hold_slots(limiter, 4)
+    assert 4 < limiter['limit'] < 5
+
+    for _ in range(100):
+      await hold_slots(limiter, get_slots(limiter))
+    assert limiter['limit'] == 8
+
+  asyncio.run(run())
+
+def test_throttling_decreases_once_per_round_trip():
+  async def run():
+    limiter = get_limiter('throttle', 10, 20)
+
+    assert record_failure(limiter, client_error('SlowDown', 503)) is None
+    assert limiter['limit'] == pytest.approx(10 * DECREASE_FACTOR)
+
+    # Requests already in flight saw the same congestion
+    record_failure(limiter, client_error('SlowDown', 503))
+    assert limiter['limit'] == pytest.approx(10 * DECREASE_FACTOR)
+
+    limiter['last_decrease'] -= 2
+    record_failure(limiter, ReadTimeoutError(endpoint_url='https://s3'))
+    assert limiter['limit'] == pytest.approx(10 * DECREASE_FACTOR ** 2)
+
+    record_failure(limiter, client_error('AccessDenied', 403))
+    assert limiter['limit'] == pytest.approx(10 * DECREASE_FACTOR ** 2)
+
+  asyncio.run(run())
+
+def test_limit_never_drops_below_one():
+  async def run():
+    limiter = get_limiter('floor', 1, 4)
+    limiter['last_decrease'] = -10
+    record_failure(limiter, client_error('SlowDown', 503))
+    assert limiter['limit'] == 1
+
+  asyncio.run(run())
+
+def test_fixed_control_holds_the_limit(monkeypatch):
+  monkeypatch.setattr(concurrency, 'CONCURRENCY_CONTROL', 'fixed')
+
+  async def run():
+    limiter = get_limiter('fixed', 3, 10)
+    assert limiter['ceiling'] == 3
+
+    await hold_slots(limiter, 3)
+    record_failure(limiter, client_error('SlowDown', 503))
+    assert limiter['limit'] == 3
+
+  asyncio.run(run())
+
+def test_waiters_are_admitted_in_order():
+  async def run():
+    limiter = get_limiter('order', 2, 2)
+    admitted = []
+
+    async def request(number):
+      async with limited(limiter):
+        admitted.append(number)
+        await asyncio.sleep(0.01)
+
+    await asyncio.gather(*(request(number) for number in range(6)))
+    assert admitted == list(range(6))
+    assert get_queue(limiter)['in_flight'] == 0
+
+  asyncio.run(run())
+
+def test_retry_after_pauses_new_requests():
+  async def run():
+    limiter = get_limiter('pause', 4, 8)
+
+    assert record_failure(limiter, client_error('SlowDown', 503, retry_after='0.2')) == pytest.approx(0.2)
+
+    start = time.monotonic()
+    async with limited(limiter):
+      pass
+    assert time.monotonic() - start >= 0.15
+
+  asyncio.run(run())
+
+def test_retry_after_values():
+  future = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=10), usegmt=True)
+
+  assert get_retry_after(client_error('SlowDown', 503, retry_after='3')) == 3
+  assert 8 <= get_retry_after(client_error('SlowDown', 503, retry_after=future)) <= 10
+  assert get_retry_after(client_error('SlowDown', 503, retry_after='3600')) == MAX_RETRY_AFTER
+  assert get_retry_after(client_error('SlowDown', 503, retry_after='soon')) is None
+  assert get_retry_after(client_error('SlowDown', 503)) is None
+  assert get_retry_after(OSError()) is None
+
+def test_limits_survive_event_loops():
+  limiter = get_limiter('loops', 4, 8)
+
+  async def saturate():
+    await hold_slots(limiter, 4)
+    return get_queue(limiter)
+
+  first_queue = asyncio.run(saturate())
+  limit = limiter['limit']
+  assert limit > 4
+
+  async def next_invocation():
+    queue = get_queue(limiter)
+    return queue, queue['in_flight'], limiter['limit']
+
+  queue, in_flight, next_limit = asyncio.run(next_invocation())
+  assert queue is not first_queue and in_flight == 0 and next_limit == limit
+  assert list(limiter['loops']) == [queue['loop']]
+
+def test_error_classification():
+  assert is_retryable_error(client_error('SlowDown', 503))
+  assert is_retryable_error(client_error('InternalError', 500))
+  assert is_retryable_error(client_error('RequestLimitExceeded', 400))
+  assert not is_retryable_error(client_error('AccessDenied', 403))
+  assert not is_retryable_error(client_error('NoSuchKey', 404))
+  assert is_retryable_error(EndpointConnectionError(endpoint_url='https://s3'))
+  assert is_retryable_error(ReadTimeoutError(endpoint_url='https://s3'))
+  assert not is_retryable_error(FileNotFoundError('/tmp/missing.nc'))
+  assert not is_retryable_error(KeyError('variable'))
+
+  assert is_throttle_error(client_error('SlowDown', 503))
+  assert is_throttle_error(ReadTimeoutError(endpoint_url='https://s3'))
+  assert not is_throttle_error(client_error('InternalError', 500))
+  assert not is_throttle_error(EndpointConnectionError(endpoint_url='https://s3'))
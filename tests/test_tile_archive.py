@@ -0,0 +1,64 @@
+import random
+
+from tile_archive import (
+  new_tile_archive, add_archive_tile, finish_tile_archive, read_archive_header, read_archive_tile,
+  iterate_archive_entries, zxy_to_tile_id, tile_id_to_zxy
+)
+
+def build_archive(tiles, part_size):
+  """The archive's bytes as its multipart upload would assemble them"""
+  archive = new_tile_archive('png', part_size)
+  parts = []
+
+  for (zoom, x, y), data in tiles:
+    chunk = add_archive_tile(archive, zoom, x, y, data)
+    if chunk:
+      parts.append(chunk)
+
+  first_part, last_part = finish_tile_archive(archive, {'name': 'test'}, (-130, 20, -60, 55))
+  return first_part + b''.join(parts) + (last_part or b'')
+
+def read_range_of(data):
+  return lambda offset, length: data[offset:offset + length]
+
+def test_tile_id_round_trip():
+  for zoom in range(0, 11, 2):
+    for x, y in [(0, 0), (2 ** zoom - 1, 0), (0, 2 ** zoom - 1), (2 ** zoom // 3, 2 ** zoom // 5)]:
+      assert tile_id_to_zxy(zxy_to_tile_id(zoom, x, y)) == (zoom, x, y)
+
+def test_archive_round_trip():
+  rng = random.Random(1)
+  tiles = {}
+
+  # Enough tiles for leaf directories, with repeated contents, added out of Hilbert order
+  for zoom in (8, 10):
+    for x in range(2 ** zoom // 4, 2 ** zoom // 4 + 100):
+      for y in range(2 ** zoom // 4, 2 ** zoom // 4 + 40):
+        tiles[zoom, x, y] = b'uniform' if (x + y) % 7 == 0 else rng.randbytes(rng.randint(10, 40))
+
+  data = build_archive(list(tiles.items()), part_size=64 * 1024)
+  read_range = read_range_of(data)
+  header = read_archive_header(read_range)
+
+  assert header['addressed_tiles'] == len(tiles)
+  assert (header['min_zoom'], header['max_zoom']) == (8, 10)
+  assert header['leaves_length'] > 0
+
+  read_back = {}
+  for tile_id, offset, length, run_length in iterate_archive_entries(read_range, header):
+    for run in range(run_length):
+      read_back[tile_id_to_zxy(tile_id + run)] = read_range(header['data_offset'] + offset, length)
+  assert read_back == tiles
+
+  for zoom, x, y in list(tiles)[::97]:
+    assert read_archive_tile(read_range, header, zoom, x, y) == tiles[zoom, x, y]
+  assert read_archive_tile(read_range, header, 10, 0, 0) is None
+
+def test_archive_in_one_part():
+  tiles = [((10, x, 300), bytes([x % 256]) * 50) for x in range(100, 120)]
+  data = build_archive(tiles, part_size=1024 * 1024)
+  read_range = read_range_of(data)
+  header = read_archive_header(read_range)
+
+  for (zoom, x, y), tile_data in tiles:
+    assert read_archive_tile(read_range, header, zoom, x, y) == tile_data
@@ -0,0 +1,143 @@
+import numpy as np
+import pytest
+
+import tile_index
+from tile_index import (
+  TILE_SIZE, get_tile_index, get_tile_occupancy, get_tile_resampling, resample_tile, is_tile_occupied,
+  get_occupied_tiles, mercator_latitudes, TILE_RESAMPLING, RESAMPLING_TAPS
+)
+
+ZOOMS = [4, 6, 8]
+
+@pytest.fixture(autouse=True)
+def tile_index_cache(tmp_path, monkeypatch):
+  monkeypatch.setattr(tile_index, 'TILE_INDEX_DIR', str(tmp_path))
+  monkeypatch.setattr(tile_index, '_tile_indexes', {})
+  monkeypatch.setattr(tile_index, '_tile_occupancy', {})
+
+def make_grid():
+  lats = np.linspace(50, 25, 150)
+  lons = np.linspace(-125, -70, 300)
+  rows, cols = np.meshgrid(np.arange(len(lats)), np.arange(len(lons)), indexing='ij')
+
+  # Two blobs of data, a lone valid cell and a hole
+  valid_mask = (rows - 40) ** 2 + (cols - 60) ** 2 < 20 ** 2
+  valid_mask |= (rows - 110) ** 2 / 4 + (cols - 220) ** 2 < 30 ** 2
+  valid_mask[5, 290] = True
+  valid_mask[105:115, 215:225] = False
+
+  return lats, lons, valid_mask
+
+def interior(index, n_cells):
+  """Tile pixels that sample between grid cells, away from the edges of the grid"""
+  return (index >= 1) & (index <= n_cells - 3)
+
+def test_tile_columns_follow_longitude():
+  lats, lons, _ = make_grid()
+  index = get_tile_index(lats, lons, ZOOMS)
+  values = np.broadcast_to(lons, (len(lats), len(lons))).astype(np.float32)
+
+  for zoom in ZOOMS:
+    zoom_index = index['zooms'][zoom]
+    cols = len(zoom_index['col_index']) // TILE_SIZE
+    pixels = np.arange(TILE_SIZE) + 0.5
+
+    for col in range(cols):
+      x = zoom_index['x0'] + col
+      resampling = get_tile_resampling(index, zoom, x, zoom_index['y0'])
+      if resampling is None:
+        continue
+
+      tile = resample_tile(values, resampling)
+      expected = (x * TILE_SIZE + pixels) / (TILE_SIZE * 2 ** zoom) * 360.0 - 180.0
+      inside = interior(resampling[2], len(lons))
+      row = np.flatnonzero(resampling[0] >= 0)[0]
+      np.testing.assert_allclose(tile[row, inside], expected[inside], atol=1e-3)
+      assert np.isnan(tile[:, resampling[2] < 0]).all()
+
+def test_tile_rows_follow_mercator():
+  lats, lons, _ = make_grid()
+  index = get_tile_index(lats, lons, ZOOMS)
+  values = np.broadcast_to(lats[:, None], (len(lats), len(lons))).astype(np.float32)
+
+  for zoom in ZOOMS:
+    zoom_index = index['zooms'][zoom]
+    rows = len(zoom_index['row_index']) // TILE_SIZE
+
+    for row in range(rows):
+      y = zoom_index['y0'] + row
+      resampling = get_tile_resampling(index, zoom, zoom_index['x0'], y)
+      if resampling is None:
+        continue
+
+      tile = resample_tile(values, resampling)
+      expected = mercator_latitudes(y + (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE, zoom)
+      inside = interior(resampling[0], len(lats))
+      column = np.flatnonzero(resampling[2] >= 0)[0]
+      np.testing.assert_allclose(tile[inside, column], expected[inside], atol=1e-3)
+
+def test_index_is_reloaded_from_disk():
+  lats, lons, _ = make_grid()
+  index = get_tile_index(lats, lons, ZOOMS[:2])
+
+  tile_index._tile_indexes.clear()
+  reloaded = get_tile_index(lats, lons, ZOOMS)
+  assert reloaded['hash'] == index['hash']
+  assert sorted(reloaded['zooms']) == ZOOMS
+
+  for zoom in ZOOMS[:2]:
+    for field, value in index['zooms'][zoom].items():
+      np.testing.assert_array_equal(reloaded['zooms'][zoom][field], value)
+
+  assert get_tile_index(lats[::2], lons, ZOOMS[:1])['hash'] != index['hash']
+
+def read_cells(index, tile, n_cells):
+  """The grid cells one tile's rows (or columns) read, from its resampling taps"""
+  tile_index = index[tile * TILE_SIZE:(tile + 1) * TILE_SIZE]
+  tile_index = tile_index[tile_index >= 0]
+  taps = tile_index[:, None] + np.array(RESAMPLING_TAPS[TILE_RESAMPLING])[None, :]
+
+  return np.unique(np.clip(taps, 0, n_cells - 1))
+
+def test_occupancy_matches_brute_force():
+  lats, lons, valid_mask = make_grid()
+  index = get_tile_index(lats, lons, ZOOMS)
+  occupancy = get_tile_occupancy(index, valid_mask, ZOOMS)
+  values = np.where(valid_mask, 1.0, np.nan).astype(np.float32)
+
+  for zoom in ZOOMS:
+    zoom_index, zoom_occupancy = index['zooms'][zoom], occupancy[zoom]
+    rows, cols = len(zoom_index['row_index']) // TILE_SIZE, len(zoom_index['col_index']) // TILE_SIZE
+    assert zoom_occupancy['tiles'].shape == (rows, cols)
+
+    for row in range(rows):
+      row_cells = read_cells(zoom_index['row_index'], row, len(lats))
+
+      for col in range(cols):
+        col_cells = read_cells(zoom_index['col_index'], col, len(lons))
+        x, y = zoom_index['x0'] + col, zoom_index['y0'] + row
+
+        # Occupied exactly when the cells between the first and last the tile reads hold data
+        reads_valid = len(row_cells) > 0 and len(col_cells) > 0 and valid_mask[
+          row_cells.min():row_cells.max() + 1, col_cells.min():col_cells.max() + 1
+        ].any()
+        assert is_tile_occupied(zoom_occupancy, x, y) == reads_valid, (zoom, x, y)
+
+        # And never skips a tile that renders any data
+        resampling = get_tile_resampling(index, zoom, x, y)
+        if resampling is not None and not np.isnan(resample_tile(values, resampling)).all():
+          assert is_tile_occupied(zoom_occupancy, x, y), (zoom, x, y)
+
+    assert len(get_occupied_tiles(zoom_occupancy)) == int(zoom_occupancy['tiles'].sum())
+
+def test_occupancy_is_cached_by_mask():
+  lats, lons, valid_mask = make_grid()
+  index = get_tile_index(lats, lons, ZOOMS)
+  occupancy = get_tile_occupancy(index, valid_mask, ZOOMS)
+
+  tile_index._tile_occupancy.clear()
+  cached = get_tile_occupancy(index, valid_mask, ZOOMS)
+  np.testing.assert_array_equal(cached[8]['tiles'], occupancy[8]['tiles'])
+
+  empty = get_tile_occupancy(index, np.zeros_like(valid_mask), ZOOMS)
+  assert not any(empty[zoom]['tiles'].any() for zoom in ZOOMS)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+import tile_index
+from tile_store import (
+  TILE_SIZE, STORE_ZOOM, open_local_store, write_store_array, write_store_variable,
+  read_store_array_metadata, read_store_chunk, read_store_window, read_store_tile
+)
+
+@pytest.fixture(autouse=True)
+def tile_index_cache(tmp_path, monkeypatch):
+  monkeypatch.setattr(tile_index, 'TILE_INDEX_DIR', str(tmp_path / 'tile_index'))
+  monkeypatch.setattr(tile_index, '_tile_indexes', {})
+  monkeypatch.setattr(tile_index, '_tile_occupancy', {})
+
+def make_values():
+  rng = np.random.default_rng(1)
+  values = rng.normal(20, 5, (2 * TILE_SIZE, 3 * TILE_SIZE)).astype(np.float32)
+  values[:TILE_SIZE, TILE_SIZE:2 * TILE_SIZE] = np.nan
+  values[TILE_SIZE + 10, 5] = np.nan
+  return values
+
+def test_chunk_round_trip(tmp_path):
+  store = open_local_store(str(tmp_path / 'store.zarr'))
+  values = make_values()
+  write_store_array(store, '03/wspd/0', values, {'zoom': 6, 'x0': 8, 'y0': 16})
+
+  metadata = read_store_array_metadata(store, '03/wspd/0')
+  assert metadata['shape'] == [2 * TILE_SIZE, 3 * TILE_SIZE]
+  assert (metadata['zoom'], metadata['x0'], metadata['y0']) == (6, 8, 16)
+
+  # The all-NaN chunk is left out and reads back as the fill value
+  assert not (tmp_path / 'store.zarr' / '03' / 'wspd' / '0' / '0.1').exists()
+  assert np.isnan(read_store_chunk(store, '03/wspd/0', 0, 1)).all()
+
+  chunk = read_store_chunk(store, '03/wspd/0', 1, 2)
+  np.testing.assert_array_equal(chunk, values[TILE_SIZE:, 2 * TILE_SIZE:])
+
+  whole = read_store_window(store, '03/wspd/0', metadata, 0, 2 * TILE_SIZE, 0, 3 * TILE_SIZE)
+  np.testing.assert_array_equal(whole, values)
+
+  # Windows crossing chunk edges and the array's bounds
+  window = read_store_window(store, '03/wspd/0', metadata, -5, 300, 200, 800)
+  assert np.isnan(window[:5]).all() and np.isnan(window[:, 568:]).all()
+  np.testing.assert_array_equal(window[5:, :568], values[:300, 200:])
+
+def test_store_is_zarr(tmp_path):
+  zarr = pytest.importorskip('zarr')
+  store = open_local_store(str(tmp_path / 'store.zarr'))
+  values = make_values()
+  write_store_array(store, '03/wspd/0', values, {'zoom': 6, 'x0': 8, 'y0': 16})
+
+  array = zarr.open(str(tmp_path / 'store.zarr' / '03' / 'wspd' / '0'), mode='r')
+  np.testing.assert_array_equal(array[:], values)
+
+def test_store_tiles_match_grid_tiles(tmp_path):
+  store = open_local_store(str(tmp_path / 'store.zarr'))
+  lats = np.linspace(25, 50, 120)
+  lons = np.linspace(-125, -70, 240)
+  values = (lats[:, None] + lons[None, :] / 3).astype(np.float32)
+  write_store_variable(store, '03', 'tmp', values, lats, lons)
+
+  index = tile_index.get_tile_index(lats, lons, [STORE_ZOOM])
+  zoom_index = index['zooms'][STORE_ZOOM]
+  x, y = zoom_index['x0'] + 1, zoom_index['y0'] + 1
+  expected = tile_index.resample_tile(values, tile_index.get_tile_resampling(index, STORE_ZOOM, x, y))
+
+  np.testing.assert_allclose(read_store_tile(store, '03', 'tmp', STORE_ZOOM, x, y), expected, rtol=1e-6)
+  assert read_store_tile(store, '03', 'wspd', STORE_ZOOM, x, y) is None
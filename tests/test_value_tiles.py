@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from value_tiles import VALUE_RANGES, encode_value_tile, decode_value_tile, get_value_encoding
+
+@pytest.mark.parametrize('variable', ['wspd', 'tmp', 'KBDI', 'not_a_variable'])
+def test_round_trip_within_quantization(variable):
+  minimum, maximum = VALUE_RANGES.get(variable, (-1000, 1000))
+  rng = np.random.default_rng(2)
+  values = rng.uniform(minimum, maximum, (256, 256)).astype(np.float32)
+  values[0, :3] = minimum, maximum, (minimum + maximum) / 2
+  values[10:20, 10:20] = np.nan
+
+  decoded = decode_value_tile(encode_value_tile(values, variable, '8/1/2'), variable)
+  scale = get_value_encoding(variable)['scale']
+
+  assert decoded.dtype == np.float32
+  np.testing.assert_array_equal(np.isnan(decoded), np.isnan(values))
+  valid = ~np.isnan(values)
+  assert np.abs(decoded[valid] - values[valid]).max() <= scale / 2 + np.abs(values[valid]).max() * 1e-6
+
+def test_values_outside_range_are_clamped():
+  minimum, maximum = VALUE_RANGES['rh']
+  values = np.array([[minimum - 50, maximum + 50, np.nan]], dtype=np.float32)
+
+  decoded = decode_value_tile(encode_value_tile(values, 'rh', '8/1/2'), 'rh')
+  np.testing.assert_allclose(decoded[0, :2], [minimum, maximum], atol=1e-3)
+  assert np.isnan(decoded[0, 2])
+
+def test_empty_tile_is_not_encoded():
+  assert encode_value_tile(np.full((256, 256), np.nan, dtype=np.float32), 'wspd', '8/1/2') is None
@@ -0,0 +1,415 @@
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import struct
+import sys
+from bisect import bisect_right
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# PMTiles v3: a 127 byte header, the root directory, JSON metadata, leaf
+# directories and the tile data, all addressable with HTTP range requests.
+# Directories and metadata are gzipped, tiles are stored as encoded.
+# Directories map Hilbert-ordered tile ids to (offset, length) in the tile
+# data; a run length covers consecutive tile ids that share the same bytes.
+HEADER_LENGTH = 127
+ROOT_DIRECTORY_MAX_LENGTH = 16384 - HEADER_LENGTH
+LEAF_DIRECTORY_SIZE = 4096
+MAX_DIRECTORY_DEPTH = 3
+
+COMPRESSION_NONE = 1
+COMPRESSION_GZIP = 2
+TILE_TYPES = {'png': 2, 'jpg': 3, 'webp': 4}
+TILE_EXTENSIONS = {tile_type: extension for extension, tile_type in TILE_TYPES.items()}
+
+HEADER_FORMAT = '<7sBQQQQQQQQQQQBBBBBBiiiiBii'
+
+def zxy_to_tile_id(zoom, x, y):
+  tile_id = ((1 << (zoom * 2)) - 1) // 3
+
+  for level in range(zoom - 1, -1, -1):
+    size = 1 << level
+    rx = 1 if x & size else 0
+    ry = 1 if y & size else 0
+    tile_id += size * size * ((3 * rx) ^ ry)
+    x, y = rotate_quadrant(size, x, y, rx, ry)
+
+  return tile_id
+
+def tile_id_to_zxy(tile_id):
+  zoom = 0
+  first_id = 0
+
+  while first_id + (1 << (zoom * 2)) <= tile_id:
+    first_id += 1 << (zoom * 2)
+    zoom += 1
+
+  position = tile_id - first_id
+  x = y = 0
+  size = 1
+
+  while size < (1 << zoom):
+    rx = 1 & (position // 2)
+    ry = 1 & (position ^ rx)
+    x, y = rotate_quadrant(size, x, y, rx, ry)
+    x += size * rx
+    y += size * ry
+    position //= 4
+    size *= 2
+
+  return zoom, x, y
+
+def rotate_quadrant(size, x, y, rx, ry):
+  if ry == 0:
+    if rx == 1:
+      x = size - 1 - x
+      y = size - 1 - y
+    return y, x
+
+  return x, y
+
+def new_tile_archive(extension, part_size):
+  """Streaming writer state for one archive.
+
+  Tile data is handed back in part_size chunks as it accumulates so it can be
+  uploaded as multipart parts while rendering continues. The first chunk is
+  held back: it becomes part 1 behind the header and directories, which are
+  only known once every tile has been added.
+  """
+  return {
+    'tile_type': TILE_TYPES[extension],
+    'part_size': part_size,
+    'entries': [],
+    'contents': {},
+    'data_length': 0,
+    'addressed_tiles': 0,
+    'clustered': True,
+    'first_chunk': None,
+    'buffer': bytearray(),
+    'zooms': set()
+  }
+
+def add_archive_tile(archive, zoom, x, y, data):
+  """Append a tile; returns a chunk of tile data ready to upload, or None"""
+  tile_id = zxy_to_tile_id(zoom, x, y)
+  digest = hashlib.blake2b(data, digest_size=16).digest()
+  entries = archive['entries']
+
+  if entries and tile_id <= entries[-1][0] + entries[-1][3] - 1:
+    archive['clustered'] = False
+
+  if digest in archive['contents']:
+    offset, length = archive['contents'][digest]
+  else:
+    offset, length = archive['data_length'], len(data)
+    archive['contents'][digest] = (offset, length)
+    archive['data_length'] += length
+    archive['buffer'] += data
+
+  archive['addressed_tiles'] += 1
+  archive['zooms'].add(zoom)
+
+  last = entries[-1] if entries else None
+  if last and last[0] + last[3] == tile_id and last[1] == offset:
+    entries[-1] = (last[0], offset, length, last[3] + 1)
+  else:
+    entries.append((tile_id, offset, length, 1))
+
+  if len(archive['buffer']) < archive['part_size']:
+    return None
+
+  chunk = bytes(archive['buffer'])
+  archive['buffer'] = bytearray()
+
+  if archive['first_chunk'] is None:
+    archive['first_chunk'] = chunk
+    return None
+
+  return chunk
+
+def finish_tile_archive(archive, metadata, bounds):
+  """Returns (first_part, last_part): the header, directories and first chunk
+  of tile data, then whatever tile data is still buffered. When no chunk was
+  ever filled the whole archive is first_part and last_part is None.
+  """
+  entries = archive['entries']
+  if not archive['clustered']:
+    entries.sort()
+
+  root, leaves = build_archive_directories(entries)
+  metadata_bytes = compress(json.dumps(metadata, separators=(',', ':')).encode())
+  zooms = archive['zooms'] or {0}
+  west, south, east, north = bounds
+
+  root_offset = HEADER_LENGTH
+  metadata_offset = root_offset + len(root)
+  leaves_offset = metadata_offset + len(metadata_bytes)
+  data_offset = leaves_offset + len(leaves)
+
+  header = struct.pack(
+    HEADER_FORMAT,
+    b'PMTiles', 3,
+    root_offset, len(root),
+    metadata_offset, len(metadata_bytes),
+    leaves_offset, len(leaves),
+    data_offset, archive['data_length'],
+    archive['addressed_tiles'], len(entries), len(archive['contents']),
+    1 if archive['clustered'] else 0,
+    COMPRESSION_GZIP, COMPRESSION_NONE, archive['tile_type'],
+    min(zooms), max(zooms),
+    to_e7(west), to_e7(south), to_e7(east), to_e7(north),
+    min(zooms), to_e7((west + east) / 2), to_e7((south + north) / 2)
+  )
+  head = header + root + metadata_bytes + leaves
+
+  if archive['first_chunk'] is None:
+    return head + bytes(archive['buffer']), None
+
+  return head + archive['first_chunk'], bytes(archive['buffer']) or None
+
+def to_e7(degrees):
+  return int(round(degrees * 10_000_000))
+
+def compress(data):
+  return gzip.compress(data, mtime=0)
+
+def build_archive_directories(entries):
+  root = compress(serialize_directory(entries))
+  if len(root) <= ROOT_DIRECTORY_MAX_LENGTH:
+    return root, b''
+
+  leaf_size = LEAF_DIRECTORY_SIZE
+  while True:
+    leaves = bytearray()
+    root_entries = []
+
+    for start in range(0, len(entries), leaf_size):
+      leaf = compress(serialize_directory(entries[start:start + leaf_size]))
+      root_entries.append((entries[start][0], len(leaves), len(leaf), 0))
+      leaves += leaf
+
+    root = compress(serialize_directory(root_entries))
+    if len(root) <= ROOT_DIRECTORY_MAX_LENGTH:
+      return root, bytes(leaves)
+
+    leaf_size *= 2
+
+def serialize_directory(entries):
+  buffer = bytearray()
+  write_varint(buffer, len(entries))
+
+  last_id = 0
+  for tile_id, _, _, _ in entries:
+    write_varint(buffer, tile_id - last_id)
+    last_id = tile_id
+
+  for _, _, _, run_length in entries:
+    write_varint(buffer, run_length)
+
+  for _, _, length, _ in entries:
+    write_varint(buffer, length)
+
+  for i, (_, offset, _, _) in enumerate(entries):
+    previous = entries[i - 1] if i else None
+    if previous and offset == previous[1] + previous[2]:
+      write_varint(buffer, 0)
+    else:
+      write_varint(buffer, offset + 1)
+
+  return bytes(buffer)
+
+def deserialize_directory(data):
+  position = 0
+
+  def read():
+    nonlocal position
+    value, position = read_varint(data, position)
+    return value
+
+  count = read()
+  tile_ids = []
+  last_id = 0
+  for _ in range(count):
+    last_id += read()
+    tile_ids.append(last_id)
+
+  run_lengths = [read() for _ in range(count)]
+  lengths = [read() for _ in range(count)]
+
+  entries = []
+  for i in range(count):
+    value = read()
+    if value == 0 and i > 0:
+      offset = entries[i - 1][1] + entries[i - 1][2]
+    else:
+      offset = value - 1
+    entries.append((tile_ids[i], offset, lengths[i], run_lengths[i]))
+
+  return entries
+
+def write_varint(buffer, value):
+  while value >= 0x80:
+    buffer.append((value & 0x7f) | 0x80)
+    value >>= 7
+  buffer.append(value)
+
+def read_varint(data, position):
+  value = 0
+  shift = 0
+
+  while True:
+    byte = data[position]
+    position += 1
+    value |= (byte & 0x7f) << shift
+    if byte < 0x80:
+      return value, position
+    shift += 7
+
+def read_archive_header(read_range):
+  """read_range(offset, length) returns bytes: a local file, or an S3 range GET"""
+  fields = struct.unpack(HEADER_FORMAT, read_range(0, HEADER_LENGTH))
+
+  if fields[0] != b'PMTiles' or fields[1] != 3:
+    raise ValueError('Not a PMTiles v3 archive')
+
+  names = [
+    'root_offset', 'root_length', 'metadata_offset', 'metadata_length',
+    'leaves_offset', 'leaves_length', 'data_offset', 'data_length',
+    'addressed_tiles', 'tile_entries', 'tile_contents', 'clustered',
+    'internal_compression', 'tile_compression', 'tile_type', 'min_zoom', 'max_zoom'
+  ]
+  header = dict(zip(names, fields[2:]))
+
+  if header['internal_compression'] not in (COMPRESSION_NONE, COMPRESSION_GZIP):
+    raise ValueError(f"Unsupported directory compression {header['internal_compression']}")
+
+  return header
+
+def read_archive_section(read_range, header, offset, length):
+  data = read_range(offset, length)
+
+  if header['internal_compression'] == COMPRESSION_GZIP:
+    return gzip.decompress(data)
+  return data
+
+def read_archive_tile(read_range, header, zoom, x, y):
+  """The tile's bytes, or None when the archive does not address it"""
+  tile_id = zxy_to_tile_id(zoom, x, y)
+  offset, length = header['root_offset'], header['root_length']
+
+  for _ in range(MAX_DIRECTORY_DEPTH + 1):
+    entries = deserialize_directory(read_archive_section(read_range, header, offset, length))
+    entry = find_directory_entry(entries, tile_id)
+
+    if entry is None:
+      return None
+
+    _, entry_offset, entry_length, run_length = entry
+    if run_length:
+      return read_range(header['data_offset'] + entry_offset, entry_length)
+
+    offset, length = header['leaves_offset'] + entry_offset, entry_length
+
+  raise ValueError(f"Directory depth exceeded looking up {zoom}/{x}/{y}")
+
+def find_directory_entry(entries, tile_id):
+  i = bisect_right(entries, (tile_id, float('inf'))) - 1
+  if i < 0:
+    return None
+
+  entry = entries[i]
+  if entry[3] == 0 or tile_id < entry[0] + entry[3]:
+    return entry
+
+  return None
+
+def iterate_archive_entries(read_range, header, offset=None, length=None, depth=0):
+  if offset is None:
+    offset, length = header['root_offset'], header['root_length']
+
+  for entry in deserialize_directory(read_archive_section(read_range, header, offset, length)):
+    if entry[3]:
+      yield entry
+    elif depth < MAX_DIRECTORY_DEPTH:
+      yield from iterate_archive_entries(
+        read_range, header, header['leaves_offset'] + entry[1], entry[2], depth + 1
+      )
+
+def open_archive_file(path):
+  archive_file = open(path, 'rb')
+
+  def read_range(offset, length):
+    archive_file.seek(offset)
+    return archive_file.read(length)
+
+  return archive_file, read_range
+
+def extract_archive(path, output_dir):
+  archive_file, read_range = open_archive_file(path)
+
+  with archive_file:
+    header = read_archive_header(read_range)
+    extension = TILE_EXTENSIONS.get(header['tile_type'], 'bin')
+    extracted = 0
+
+    for tile_id, offset, length, run_length in iterate_archive_entries(read_range, header):
+      data = read_range(header['data_offset'] + offset, length)
+
+      for run_tile_id in range(tile_id, tile_id + run_length):
+        zoom, x, y = tile_id_to_zxy(run_tile_id)
+        tile_dir = os.path.join(output_dir, str(zoom), str(x))
+        os.makedirs(tile_dir, exist_ok=True)
+
+        with open(os.path.join(tile_dir, f"{y}.{extension}"), 'wb') as f:
+          f.write(data)
+        extracted += 1
+
+  logger.info(f"Extracted {extracted} tiles from {path} to {output_dir}")
+  return extracted
+
+def main():
+  parser = argparse.ArgumentParser(description='Read tiles from a PMTiles archive')
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  get_parser = subparsers.add_parser('get', help='Write one z/x/y tile to stdout')
+  get_parser.add_argument('archive')
+  get_parser.add_argument('tile', help='zoom/x/y')
+
+  extract_parser = subparsers.add_parser('extract', help='Write every tile to OUTPUT_DIR/z/x/y.ext')
+  extract_parser.add_argument('archive')
+  extract_parser.add_argument('output_dir')
+
+  info_parser = subparsers.add_parser('info', help='Print the header and metadata')
+  info_parser.add_argument('archive')
+
+  args = parser.parse_args()
+
+  if args.command == 'extract':
+    extract_archive(args.archive, args.output_dir)
+    return
+
+  archive_file, read_range = open_archive_file(args.archive)
+  with archive_file:
+    header = read_archive_header(read_range)
+
+    if args.command == 'info':
+      metadata = json.loads(read_archive_section(
+        read_range, header, header['metadata_offset'], header['metadata_length']
+      ))
+      print(json.dumps({'header': header, 'metadata': metadata}, indent=2))
+      return
+
+    zoom, x, y = (int(part) for part in args.tile.split('/'))
+    data = read_archive_tile(read_range, header, zoom, x, y)
+
+    if data is None:
+      sys.exit(f"Tile {args.tile} is not in {args.archive}")
+    sys.stdout.buffer.write(data)
+
+if __name__ == '__main__':
+  logging.basicConfig()
+  main()
@@ -0,0 +1,13 @@
+"""Tile settings shared by the generator and the shard planner.
+
+Kept free of imports beyond os so that planning shards doesn't load the
+rendering stack.
+"""
+import os
+
+TARGET_ZOOM_LEVELS = [6, 8, 10]
+TILE_BUILD_MODE = os.getenv('TILE_BUILD_MODE', 'zoom')
+
+# objects: one S3 object per tile
+# archive: one PMTiles archive per variable, streamed up as a multipart upload
+TILE_OUTPUT = os.getenv('TILE_OUTPUT', 'objects')
@@ -1,120 +1,874 @@
 import asyncio
+import json
 import time
 import logging
 import os
 import gc
-import boto3
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from generate_tiles import generate_tile
-from utils import get_tile_ranges_for_zoom
+from tile_config import TARGET_ZOOM_LEVELS, TILE_BUILD_MODE, TILE_OUTPUT
+from generate_tiles import (
+  prepare_tile_source, prepare_stacked_tile_source, get_tile_encoding, get_tile_format,
+  encode_uniform_tile, UNIFORM_TILE_MODE, INCREMENTAL_MODE, FORECAST_STACK_MODE,
+  VALUE_TILE_MODE
+)
+from tile_manifest import (
+  new_manifest, load_manifest, save_manifest, record_tile, record_tile_hash,
+  content_digest
+)
+from pyramid import get_pyramid_blocks, get_max_pyramid_depth, split_pyramid_zooms
+from tile_archive import new_tile_archive, add_archive_tile, finish_tile_archive, zxy_to_tile_id
+from tile_index import TILE_SIZE, clip_occupancy, get_occupied_tiles, get_occupied_bounds
+from value_tiles import build_colormap_document
+from metrics import timed, observe, count, mark_memory, merge_metrics
+from checkpoints import (
+  create_checkpointer, track_job, seal_job, fail_job, finish_job_upload,
+  flush_checkpoint, write_progress
+)
+from render_pool import (
+  create_render_pool, close_render_pool, replace_render_source, load_render_band,
+  render_tile_job, render_pyramid_job, RENDER_WORKERS
+)
+from source_bands import prepare_banded_source, get_source_variables, plan_bands, SOURCE_LOADING
+from s3_and_database_access import get_s3_client, get_single_attempt_s3_client
+from concurrency import (
+  get_limiter, limited, record_success, record_failure, is_retryable_error,
+  MAX_CONCURRENT_UPLOADS, UPLOAD_CONCURRENCY_LIMIT
+)
+from utils import (
+  build_tile_s3_key, build_tile_manifest_s3_key, build_shared_tile_s3_key,
+  build_previous_file_stamp, build_sortable_timestamp, build_tile_archive_s3_key,
+  build_tile_stack_s3_key, build_tile_stack_index_s3_key, build_value_tile_s3_key,
+  build_colormap_s3_key, TILE_KEY_LAYOUT
+)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-s3_client = boto3.client('s3', region_name=os.getenv('AWS_REGION', 'us-east-1'))
+UPLOAD_MAX_ATTEMPTS = int(os.getenv('UPLOAD_MAX_ATTEMPTS', '4'))
+UPLOAD_BACKOFF_BASE = float(os.getenv('UPLOAD_BACKOFF_BASE', '0.2'))
+UPLOAD_BACKOFF_CAP = float(os.getenv('UPLOAD_BACKOFF_CAP', '5'))
+MAX_REPORTED_FAILED_KEYS = 100
 
-TARGET_ZOOM_LEVELS = [6, 8, 10]
+# Every S3 write goes through this limiter; there is a worker and a thread for each slot it can open
+upload_limiter = get_limiter('upload', MAX_CONCURRENT_UPLOADS, UPLOAD_CONCURRENCY_LIMIT)
+upload_executor = ThreadPoolExecutor(max_workers=upload_limiter['ceiling'], thread_name_prefix='upload')
+
+RENDER_QUEUE_SIZE = int(os.getenv('RENDER_QUEUE_SIZE', str(RENDER_WORKERS * 4)))
+UPLOAD_QUEUE_SIZE = int(os.getenv('UPLOAD_QUEUE_SIZE', '200'))
+
+MIN_ARCHIVE_PART_SIZE = 5 * 1024 * 1024
+ARCHIVE_PART_SIZE = max(int(os.getenv('ARCHIVE_PART_SIZE', str(8 * 1024 * 1024))), MIN_ARCHIVE_PART_SIZE)
 
 async def generate_all_tiles_for_variable(dataset, timestamp, forecast_hour, variable, progress, context):
+  return await generate_all_tiles_for_variables(
+    dataset, timestamp, forecast_hour, [variable], progress, context
+  )
+
+async def generate_all_tiles_for_variables(dataset, timestamp, forecast_hour, variables, progress, context):
+  source = prepare_source({forecast_hour: dataset}, variables, TARGET_ZOOM_LEVELS)
+
+  return await generate_tiles_from_source(source, timestamp, variables, progress, context)
+
+async def generate_forecast_hour_tiles(datasets, timestamp, variables, progress, context):
+  """Render several forecast hours in one pass, resampling each tile once for all of them.
+
+  datasets maps forecast hour to its dataset. FORECAST_STACK_MODE picks
+  per-hour tiles, one stacked tile per z/x/y, or both.
+  """
+  source = prepare_source(datasets, variables, TARGET_ZOOM_LEVELS, stacked=True)
+
+  return await generate_tiles_from_source(source, timestamp, variables, progress, context, stacked=True)
+
+async def generate_shard_tiles(dataset, timestamp, shard, progress, context):
+  """Render one shard from shard_planner: its zooms, limited to its stripe of tile columns"""
+  source = prepare_source({shard['forecast_hour']: dataset}, shard['variables'], shard['zooms'])
+
+  if shard.get('x_range'):
+    source['occupancy'] = clip_occupancy(source['occupancy'], min(shard['zooms']), shard['x_range'])
+
+  return await generate_tiles_from_source(
+    source, timestamp, shard['variables'], progress, context, shard=shard['id']
+  )
+
+def prepare_source(datasets, variables, zooms, stacked=False):
+  """The render source for datasets by forecast hour.
+
+  With NETCDF_SAMPLING=zoom each group of zooms sharing a stride gets its own
+  source from a view thinned for it, under 'zoom_sources'; see
+  get_zoom_source. A pyramid reduces every zoom from the top zoom's mosaic,
+  so it reads at the top zoom's stride.
+  """
+  from read_net_cdf import NETCDF_SAMPLING, group_zooms_by_stride, thin_dataset
+
+  if NETCDF_SAMPLING != 'zoom':
+    return prepare_grid_source(datasets, variables, zooms, stacked)
+
+  first = next(iter(datasets.values()))
+  pyramid = TILE_BUILD_MODE == 'pyramid'
+  zoom_sources = {}
+
+  for stride, stride_zooms in group_zooms_by_stride(first, [max(zooms)] if pyramid else zooms):
+    stride_zooms = zooms if pyramid else stride_zooms
+    logger.info(f"Reading every {stride[0]} latitudes and {stride[1]} longitudes for zooms {stride_zooms}")
+
+    view_source = prepare_grid_source(
+      {forecast_hour: thin_dataset(dataset, stride) for forecast_hour, dataset in datasets.items()},
+      variables, stride_zooms, stacked
+    )
+    zoom_sources.update(dict.fromkeys(stride_zooms, view_source))
+
+  views = list({id(view_source): view_source for view_source in zoom_sources.values()}.values())
+  source = {
+    **zoom_sources[max(zooms)],
+    'occupancy': {zoom: zoom_sources[zoom]['occupancy'][zoom] for zoom in sorted(zooms)}
+  }
+
+  if len(views) > 1:
+    source['zoom_sources'] = zoom_sources
+
+    # Zooms render one after another, so banded views can take turns with one set of buffers
+    shared_buffers = {}
+    for view_source in views:
+      if 'bands' in view_source:
+        view_source['bands']['buffers'] = shared_buffers
+
+  return source
+
+def get_zoom_source(source, zoom):
+  """The source zoom renders from: its own view's values and index, with the run's occupancy"""
+  if 'zoom_sources' not in source:
+    return source
+
+  return {
+    **source['zoom_sources'][zoom],
+    'occupancy': source['occupancy'],
+    'previous_hashes': source['previous_hashes']
+  }
+
+def prepare_grid_source(datasets, variables, zooms, stacked=False):
+  """The render source for one grid, loaded whole or, with SOURCE_LOADING=bands, band by band"""
+  if SOURCE_LOADING == 'bands':
+    return prepare_banded_source(datasets, variables, zooms, stacked)
+
+  if stacked:
+    return prepare_stacked_tile_source(datasets, variables, zooms)
+
+  (forecast_hour, dataset), = datasets.items()
+  source = prepare_tile_source(dataset, variables, zooms)
+  source['forecast_hours'] = [forecast_hour]
+
+  return source
+
+async def generate_tiles_from_source(source, timestamp, variables, progress, context, stacked=False, shard=None):
+  """Render every occupied tile of the source's zooms, resuming from progress"""
   tiles_generated = 0
-  max_concurrent_uploads = int(os.getenv('MAX_CONCURRENT_UPLOADS', '10'))
-  upload_semaphore = asyncio.Semaphore(max_concurrent_uploads)
-  
-  logger.info(f"Processing variable: {variable}")
+  zooms = sorted(source['occupancy'])
+  output = create_tile_output(timestamp, source['forecast_hours'], variables, stacked, shard)
+
+  variable_label = ', '.join(variables)
+  logger.info(f"Processing variables: {variable_label} for forecast hours {source['forecast_hours']}")
   variable_start = time.time()
-  
-  for zoom in TARGET_ZOOM_LEVELS:
-    if zoom in progress.get('completed_zooms', []):
-      logger.info(f"Zoom {zoom} already completed for {variable}")
-      continue
-    
-    tiles_generated += await process_zoom_level(
-      dataset, timestamp, forecast_hour, variable, zoom, upload_semaphore, progress, context
+
+  if TILE_OUTPUT == 'archive':
+    # A multipart upload cannot carry over between invocations, so archives
+    # always start from the first tile
+    progress['completed_zooms'] = []
+    for key in ('current_zoom', 'last_x', 'last_y', 'last_block'):
+      progress.pop(key, None)
+
+  source['previous_hashes'] = {
+    (forecast_hour, variable): manifest.get('hashes', {})
+    for forecast_hour, hour_output in output['hours'].items()
+    for variable, manifest in hour_output['previous_manifests'].items()
+  }
+  render_pool = create_render_pool(source)
+
+  try:
+    if TILE_BUILD_MODE == 'pyramid':
+      tiles_generated = await process_pyramid(
+        render_pool, output, variables, zooms, source, progress, context
+      )
+
+    else:
+      for zoom in zooms:
+        if zoom in progress.get('completed_zooms', []):
+          logger.info(f"Zoom {zoom} already completed for {variable_label}")
+          continue
+
+        zoom_source = get_zoom_source(source, zoom)
+        if zoom_source is not source:
+          replace_render_source(render_pool, zoom_source)
+
+        zoom_tiles, zoom_complete = await process_zoom_level(
+          render_pool, output, variables, zoom, zoom_source, progress, context
+        )
+        tiles_generated += zoom_tiles
+
+        if not zoom_complete:
+          break
+
+        progress['completed_zooms'].append(zoom)
+        await write_progress(progress)
+
+        gc.collect()
+
+        if context.get_remaining_time_in_millis() < 60000:
+          logger.warning(f"Low time remaining, stopping at zoom {zoom}")
+          break
+
+  finally:
+    close_render_pool(render_pool)
+    completed = all(zoom in progress['completed_zooms'] for zoom in zooms)
+
+    save_tile_manifests(output)
+    await finish_tile_archives(output, completed, source['occupancy'])
+
+    if output['stacked'] and completed:
+      save_tile_stack_index(output, get_source_variables(source))
+
+    if VALUE_TILE_MODE != 'off':
+      save_colormap_document(output)
+
+  variable_time = time.time() - variable_start
+  logger.info(f"{'Completed' if completed else 'Stopped'} {variable_label} in {variable_time:.1f}s")
+
+  return build_generation_result(tiles_generated, output, completed)
+
+def create_tile_output(timestamp, forecast_hours, variables, stacked=False, shard=None):
+  """Where rendered tiles go for this run, and what happened to them.
+
+  Each forecast hour written as its own tiles gets its own manifests and
+  archives under 'hours'; the upload stats and shared uniform tiles are
+  common to all of them. A shard keeps its manifests as parts for
+  merge_shard_manifests.
+  """
+  stats = {'uploaded': 0, 'failed': 0, 'failed_keys': [], 'uniform': 0, 'unchanged': 0}
+  shared_keys = {}
+  hour_tiles = not stacked or FORECAST_STACK_MODE != 'stack'
+
+  return {
+    'timestamp': timestamp,
+    'forecast_hours': forecast_hours,
+    'stacked': stacked and FORECAST_STACK_MODE != 'hours',
+    'stats': stats,
+    'shard': shard,
+    'hours': {
+      forecast_hour: create_hour_output(timestamp, forecast_hour, variables, stats, shared_keys, shard)
+      for forecast_hour in (forecast_hours if hour_tiles else [])
+    }
+  }
+
+def create_hour_output(timestamp, forecast_hour, variables, stats, shared_keys, shard=None):
+  manifests = {}
+  previous_manifests = {}
+  archives = {}
+
+  if TILE_OUTPUT == 'archive':
+    for variable in variables:
+      archives[variable] = create_archive_upload(timestamp, forecast_hour, variable)
+
+  elif UNIFORM_TILE_MODE != 'upload' or INCREMENTAL_MODE != 'off':
+    for variable in variables:
+      manifests[variable] = load_manifest(
+        get_s3_client(), build_tile_manifest_s3_key(timestamp, forecast_hour, variable, shard)
+      )
+
+  if INCREMENTAL_MODE != 'off' and TILE_OUTPUT == 'objects':
+    previous_timestamp = build_previous_file_stamp(timestamp)
+
+    for variable in variables:
+      try:
+        previous_manifests[variable] = load_manifest(
+          get_s3_client(), build_tile_manifest_s3_key(previous_timestamp, forecast_hour, variable)
+        )
+      except Exception as e:
+        logger.warning(f"No previous manifest for {variable}, regenerating every tile: {e}")
+
+  return {
+    'timestamp': timestamp,
+    'forecast_hour': forecast_hour,
+    'run': build_sortable_timestamp(timestamp),
+    'stats': stats,
+    'manifests': manifests,
+    'previous_manifests': previous_manifests,
+    'archives': archives,
+    'shared_keys': shared_keys
+  }
+
+def create_archive_upload(timestamp, forecast_hour, variable):
+  s3_key = build_tile_archive_s3_key(timestamp, forecast_hour, variable)
+  response = get_s3_client().create_multipart_upload(
+    Bucket=os.getenv('S3_TILES_BUCKET', 'custom-tiles'),
+    Key=s3_key,
+    ContentType='application/vnd.pmtiles',
+    CacheControl='max-age=3600, public'
+  )
+
+  return {
+    'key': s3_key,
+    'upload_id': response['UploadId'],
+    'archive': new_tile_archive(get_tile_encoding(variable)['extension'], ARCHIVE_PART_SIZE),
+    'etags': {},
+    # Part 1 is held back for the header and directories
+    'next_part': 1,
+    'failed': False
+  }
+
+def save_tile_manifests(output):
+  for hour_output in output['hours'].values():
+    for variable, manifest in hour_output['manifests'].items():
+      try:
+        save_manifest(
+          get_s3_client(),
+          build_tile_manifest_s3_key(output['timestamp'], hour_output['forecast_hour'], variable, output['shard']),
+          manifest
+        )
+      except Exception as e:
+        logger.error(f"Failed to save manifest for {variable}: {e}")
+
+def merge_shard_manifests(timestamp, shards):
+  """Combine the manifest parts the shards wrote into each variable's manifest"""
+  if TILE_OUTPUT == 'archive' or (UNIFORM_TILE_MODE == 'upload' and INCREMENTAL_MODE == 'off'):
+    return
+
+  parts = {}
+  for shard in shards:
+    for variable in shard['variables']:
+      parts.setdefault((shard['forecast_hour'], variable), []).append(shard['id'])
+
+  for (forecast_hour, variable), shard_ids in parts.items():
+    try:
+      manifest = new_manifest()
+
+      for shard_id in shard_ids:
+        part = load_manifest(get_s3_client(), build_tile_manifest_s3_key(timestamp, forecast_hour, variable, shard_id))
+        manifest['tiles'].update(part['tiles'])
+        manifest['hashes'].update(part.get('hashes', {}))
+
+      save_manifest(get_s3_client(), build_tile_manifest_s3_key(timestamp, forecast_hour, variable), manifest)
+
+    except Exception as e:
+      logger.error(f"Failed to merge shard manifests for {variable} forecast hour {forecast_hour}: {e}")
+
+def save_tile_stack_index(output, variables):
+  """Describe the stacked tiles: frame i of every image is forecast_hours[i]"""
+  s3_key = build_tile_stack_index_s3_key(output['timestamp'], output['forecast_hours'])
+
+  try:
+    get_s3_client().put_object(
+      Bucket=os.getenv('S3_TILES_BUCKET', 'custom-tiles'),
+      Key=s3_key,
+      Body=json.dumps({
+        'timestamp': output['timestamp'],
+        'forecast_hours': output['forecast_hours'],
+        'frame_size': TILE_SIZE,
+        'key_layout': TILE_KEY_LAYOUT,
+        'variables': {variable: get_tile_encoding(variable)['extension'] for variable in variables}
+      }).encode(),
+      ContentType='application/json',
+      CacheControl='max-age=300, public'
     )
-    
-    progress['completed_zooms'].append(zoom)
-    
-    gc.collect()
-    
-    if context.get_remaining_time_in_millis() < 60000:
-      logger.warning(f"Low time remaining, stopping at zoom {zoom}")
+  except Exception as e:
+    logger.error(f"Failed to save tile stack index {s3_key}: {e}")
+
+def save_colormap_document(output):
+  """Publish the colormaps and value encodings the run's value tiles are read with.
+
+  Every variable is included, so concurrent per-variable runs write the same document.
+  """
+  s3_key = build_colormap_s3_key(output['timestamp'])
+
+  try:
+    get_s3_client().put_object(
+      Bucket=os.getenv('S3_TILES_BUCKET', 'custom-tiles'),
+      Key=s3_key,
+      Body=json.dumps(build_colormap_document()).encode(),
+      ContentType='application/json',
+      CacheControl='max-age=300, public'
+    )
+  except Exception as e:
+    logger.error(f"Failed to save colormaps {s3_key}: {e}")
+
+def build_generation_result(tiles_generated, output, completed):
+  upload_stats = output['stats']
+
+  if upload_stats['failed']:
+    logger.error(f"{upload_stats['failed']} tile uploads failed, first keys: {upload_stats['failed_keys'][:10]}")
+
+  return {
+    'complete': completed,
+    'tiles_generated': tiles_generated,
+    'tiles_uploaded': upload_stats['uploaded'],
+    'uniform_tiles': upload_stats['uniform'],
+    'unchanged_tiles': upload_stats['unchanged'],
+    'failed_uploads': upload_stats['failed'],
+    'failed_keys': upload_stats['failed_keys']
+  }
+
+async def process_zoom_level(render_pool, output, variables, zoom, source, progress, context):
+  batch_start = time.time()
+  zoom_occupancy = source['occupancy'][zoom]
+  occupied_tiles = get_occupied_tiles(zoom_occupancy)
+  count('tiles_skipped', (zoom_occupancy['tiles'].size - len(occupied_tiles)) * len(variables), zoom=zoom)
+  mark_memory('prepare')
+
+  variable_label = ', '.join(variables)
+  logger.info(f"Generating {len(occupied_tiles)} occupied tiles for {variable_label} zoom {zoom}")
+
+  # The checkpoint is the last tile whose uploads were confirmed
+  resume_after = (progress.get('last_x'), progress.get('last_y')) if progress.get('current_zoom') == zoom else None
+  banded = 'bands' in source
+
+  def tile_order(tile):
+    # Bands are runs of tile rows, so a banded zoom goes row by row
+    x, y = tile
+    return (y, x) if banded else (x, y)
+
+  def tiles():
+    for tile in sorted(occupied_tiles, key=tile_order):
+      if resume_after is None or tile_order(tile) > tile_order(resume_after):
+        yield tile
+
+  def jobs():
+    ordered = list(tiles())
+    band_of, bands = plan_bands(source, zoom, sorted({y for _, y in ordered})) if banded else ({}, [])
+
+    if TILE_OUTPUT == 'archive':
+      # Hilbert order keeps the archive's tile data clustered
+      ordered = sorted(ordered, key=lambda tile: (band_of.get(tile[1], 0), zxy_to_tile_id(zoom, *tile)))
+
+    if bands:
+      logger.info(f"Rendering zoom {zoom} in {len(bands)} bands")
+
+    band = None
+    for x, y in ordered:
+      if banded and band_of[y] != band:
+        band = band_of[y]
+        yield load_band_source, (render_pool, source, zoom, bands[band]), None
+
+      checkpoint = {'last_x': x, 'last_y': y, 'current_zoom': zoom}
+      yield render_tile_job, (x, y, zoom, variables), checkpoint
+
+  tiles_generated, completed = await run_render_pipeline(
+    render_pool, jobs(), output, progress, context
+  )
+
+  batch_time = time.time() - batch_start
+  observe('zoom', batch_time * 1000, zoom=zoom)
+  mark_memory(zoom)
+  logger.info(f"Completed {variable_label} zoom {zoom}: {batch_time:.1f}s, {tiles_generated} tiles")
+
+  return tiles_generated, completed
+
+async def process_pyramid(render_pool, output, variables, zooms, source, progress, context):
+  zooms = [zoom for zoom in zooms if zoom not in progress.get('completed_zooms', [])]
+
+  if not zooms:
+    logger.info(f"All zooms already completed for {', '.join(variables)}")
+    return 0
+
+  # Every worker holds a block's mosaic at once; deeper pyramids than fit are split
+  max_depth = get_max_pyramid_depth(RENDER_WORKERS, len(source['forecast_hours']))
+  pyramids = split_pyramid_zooms(zooms, max_depth)
+  if len(pyramids) > 1:
+    logger.info(f"Rendering zooms {zooms} as pyramids {pyramids} to fit PYRAMID_MEMORY_MB")
+
+  tiles_generated = 0
+
+  for pyramid_zooms in pyramids:
+    pyramid_tiles, completed = await process_pyramid_zooms(
+      render_pool, output, variables, pyramid_zooms, source, progress, context
+    )
+    tiles_generated += pyramid_tiles
+
+    if not completed:
       break
-  
-  variable_time = time.time() - variable_start
-  logger.info(f"Completed {variable} in {variable_time:.1f}s")
-  
+
   return tiles_generated
 
-async def process_zoom_level(dataset, timestamp, forecast_hour, variable, zoom, semaphore, progress, context):
-  batch_start = time.time()
-  tile_ranges = get_tile_ranges_for_zoom(zoom)
-  
-  batch_size = 25 if zoom >= 10 else 50 if zoom >= 8 else 100
-  upload_tasks = []
+async def process_pyramid_zooms(render_pool, output, variables, zooms, source, progress, context):
+  """Render one pyramid, reducing each block of its lowest zoom from a mosaic at its highest"""
+  pyramid_start = time.time()
+  mark_memory('prepare')
+  occupancy = source['occupancy']
+  blocks = get_pyramid_blocks(zooms, occupancy)
+  banded = 'bands' in source
+
+  if banded:
+    # Bands are runs of block rows, so banded blocks go row by row
+    blocks.sort(key=lambda block: (block[1], block[0]))
+    band_of, bands = plan_bands(source, max(zooms), sorted({y for _, y in blocks}), span=2 ** (max(zooms) - min(zooms)))
+    logger.info(f"Rendering pyramid in {len(bands)} bands")
+
+  for zoom in zooms:
+    tiles = occupancy[zoom]['tiles']
+    count('tiles_skipped', (tiles.size - int(tiles.sum())) * len(variables), zoom=zoom)
+
+  logger.info(f"Generating {len(blocks)} zoom {min(zooms)} pyramid blocks for zooms {zooms}")
+
+  def jobs():
+    band = None
+
+    for block_number, (base_x, base_y) in enumerate(blocks):
+      if block_number <= progress.get('last_block', -1):
+        continue
+
+      if banded and band_of[base_y] != band:
+        band = band_of[base_y]
+        yield load_band_source, (render_pool, source, max(zooms), bands[band]), None
+
+      yield render_pyramid_job, (base_x, base_y, zooms, variables), {'last_block': block_number}
+
+  tiles_generated, completed = await run_render_pipeline(
+    render_pool, jobs(), output, progress, context
+  )
+
+  if completed:
+    progress['completed_zooms'].extend(zooms)
+    progress.pop('last_block', None)
+    await write_progress(progress)
+
+  pyramid_time = time.time() - pyramid_start
+  observe('pyramid', pyramid_time * 1000, zoom=min(zooms))
+  mark_memory('pyramid')
+  logger.info(f"Completed pyramid for zooms {zooms}: {pyramid_time:.1f}s, {tiles_generated} tiles")
+
+  return tiles_generated, completed
+
+async def run_render_pipeline(render_pool, jobs, output, progress, context):
+  """Render on the worker pool while persistent upload workers drain finished tiles.
+
+  Up to RENDER_QUEUE_SIZE jobs are in flight on the pool; results are taken in
+  submission order, and each job's checkpoint is applied and saved only once
+  its uploads are confirmed. The bounded upload queue pushes back on
+  rendering when S3 falls behind, and upload_limiter decides how many of
+  the workers' requests are in flight. A load_band_source entry waits for
+  the jobs before it to render, while their uploads carry on. Not complete
+  if any upload failed, so that work is redone.
+  """
+  loop = asyncio.get_running_loop()
+  upload_queue = asyncio.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+  checkpointer = create_checkpointer(progress)
+  upload_workers = [
+    asyncio.create_task(upload_worker(upload_queue, output['stats'], checkpointer))
+    for _ in range(upload_limiter['ceiling'])
+  ]
+  pending = deque()
   tiles_generated = 0
-  
-  total_tiles = (tile_ranges['x_max'] - tile_ranges['x_min'] + 1) * \
-                (tile_ranges['y_max'] - tile_ranges['y_min'] + 1)
-  
-  logger.info(f"Generating {total_tiles} tiles for {variable} zoom {zoom}")
-  
-  start_x = progress.get('last_x', tile_ranges['x_min']) if progress.get('current_zoom') == zoom else tile_ranges['x_min']
-  start_y = progress.get('last_y', tile_ranges['y_min']) if progress.get('current_zoom') == zoom else tile_ranges['y_min']
-  
-  for x in range(start_x, tile_ranges['x_max'] + 1):
-    y_start = start_y if x == start_x else tile_ranges['y_min']
-    
-    for y in range(y_start, tile_ranges['y_max'] + 1):
+  completed = True
+
+  try:
+    for job, args, checkpoint in jobs:
+      if job is load_band_source:
+        # The band replaces the source that earlier jobs are still reading
+        while pending:
+          tiles_generated += await collect_render_result(
+            pending.popleft(), upload_queue, output, checkpointer
+          )
+
+        await loop.run_in_executor(None, job, *args)
+        continue
+
+      if context.get_remaining_time_in_millis() < 30000:
+        logger.warning(f"Low time remaining, stopping before {checkpoint}")
+        completed = False
+        break
+
+      pending.append((loop.run_in_executor(render_pool['executor'], job, *args), checkpoint))
+
+      if len(pending) >= RENDER_QUEUE_SIZE:
+        tiles_generated += await collect_render_result(
+          pending.popleft(), upload_queue, output, checkpointer
+        )
+
+    while pending:
+      tiles_generated += await collect_render_result(
+        pending.popleft(), upload_queue, output, checkpointer
+      )
+
+  finally:
+    for future, _ in pending:
+      future.cancel()
+
+    for _ in upload_workers:
+      await upload_queue.put(None)
+    await asyncio.gather(*upload_workers)
+    await flush_checkpoint(checkpointer)
+    logger.info(f"Upload concurrency limit now {upload_limiter['limit']:.1f}")
+
+  return tiles_generated, completed and not checkpointer['failed']
+
+def load_band_source(render_pool, source, zoom, rows):
+  """Load grid rows [start, stop) of a banded source as the pool's source"""
+  load_render_band(render_pool, source, zoom, rows)
+
+async def collect_render_result(pending_job, upload_queue, output, checkpointer):
+  future, checkpoint = pending_job
+  job = track_job(checkpointer, checkpoint)
+
+  try:
+    rendered = await future
+  except Exception as e:
+    logger.warning(f"Failed to render tiles at {checkpoint}: {type(e).__name__}: {e}")
+    count('render_errors', zoom=checkpoint.get('current_zoom'))
+    fail_job(checkpointer, job)
+    rendered = []
+
+  if rendered and 'metrics' in rendered[-1]:
+    merge_metrics(rendered.pop()['metrics'])
+
+  for tile in rendered:
+    variable, zoom, x, y = tile['variable'], tile['zoom'], tile['x'], tile['y']
+    encoding = get_tile_encoding(variable)
+
+    if tile.get('stacked'):
+      s3_key = build_tile_stack_s3_key(
+        output['timestamp'], output['forecast_hours'], variable, zoom, x, y, encoding['extension']
+      )
+      await queue_upload(upload_queue, job, {'key': s3_key, 'data': tile['data'], 'content_type': encoding['content_type']})
+      continue
+
+    hour_output = output['hours'][tile['forecast_hour']]
+
+    if 'values' in tile:
+      # Value tiles are plain objects in every output mode
+      s3_key = build_value_tile_s3_key(output['timestamp'], hour_output['forecast_hour'], variable, zoom, x, y)
+      await queue_upload(upload_queue, job, {'key': s3_key, 'data': tile['values'], 'content_type': 'image/png'})
+      continue
+
+    if TILE_OUTPUT == 'archive':
+      await add_tile_to_archive(upload_queue, hour_output, tile)
+      continue
+
+    if 'color' in tile:
+      await record_uniform_tile(upload_queue, job, hour_output, variable, zoom, x, y, tile['color'])
+      continue
+
+    s3_key = build_tile_s3_key(
+      output['timestamp'], hour_output['forecast_hour'], variable, zoom, x, y, encoding['extension']
+    )
+
+    if tile.get('unchanged'):
+      await record_unchanged_tile(upload_queue, job, hour_output, tile, s3_key)
+      continue
+
+    if 'hash' in tile:
+      record_tile_hash(hour_output['manifests'][variable], zoom, x, y, tile['hash'], hour_output['run'])
+
+    await queue_upload(upload_queue, job, {'key': s3_key, 'data': tile['data'], 'content_type': encoding['content_type']})
+
+  seal_job(checkpointer, job)
+
+  return len(rendered)
+
+async def queue_upload(upload_queue, job, item):
+  """Queue an upload that the job's checkpoint waits on"""
+  job['uploads'] += 1
+
+  # Time spent here is rendering held back by a full upload queue
+  with timed('upload_backpressure'):
+    await upload_queue.put({**item, 'job': job, 'queued_at': time.perf_counter()})
+
+async def record_uniform_tile(upload_queue, job, output, variable, zoom, x, y, color):
+  entry = {'color': list(color)}
+  output['stats']['uniform'] += 1
+
+  if UNIFORM_TILE_MODE == 'shared':
+    tile_format = get_tile_format(variable)
+    s3_key = output['shared_keys'].get((color, tile_format))
+
+    if s3_key is None:
+      encoding = get_tile_encoding(variable)
+      tile_data = encode_uniform_tile(color, tile_format)
+      s3_key = build_shared_tile_s3_key(content_digest(tile_data), encoding['extension'])
+      output['shared_keys'][(color, tile_format)] = s3_key
+      await queue_upload(upload_queue, job, {'key': s3_key, 'data': tile_data, 'content_type': encoding['content_type']})
+
+    entry['key'] = s3_key
+
+  record_tile(output['manifests'][variable], zoom, x, y, entry)
+
+async def add_tile_to_archive(upload_queue, output, tile):
+  variable = tile['variable']
+  upload = output['archives'][variable]
+  tile_data = tile.get('data')
+
+  if tile_data is None:
+    # The archive stores identical tiles once, so uniform tiles cost an entry
+    tile_data = encode_uniform_tile(tile['color'], get_tile_format(variable))
+    output['stats']['uniform'] += 1
+
+  chunk = add_archive_tile(upload['archive'], tile['zoom'], tile['x'], tile['y'], tile_data)
+
+  if chunk:
+    upload['next_part'] += 1
+    await upload_queue.put({
+      'key': upload['key'], 'data': chunk, 'upload': upload, 'part_number': upload['next_part'],
+      'queued_at': time.perf_counter()
+    })
+
+async def finish_tile_archives(output, completed, occupancy):
+  max_zoom = max(occupancy)
+  bounds = get_occupied_bounds(occupancy[max_zoom], max_zoom) or (-180.0, -85.0511, 180.0, 85.0511)
+
+  for hour_output in output['hours'].values():
+    for variable, upload in hour_output['archives'].items():
       try:
-        tile_data = generate_tile(x, y, zoom, variable, dataset)
-        
-        if tile_data:
-          year, month, day, hour = timestamp.split('/')
-          sortable_timestamp = f"{year}{month}{day}{hour}"
-          s3_key = f"hrrr/{sortable_timestamp}/{forecast_hour}/{variable}/{zoom}/{zoom}_{x}_{y}.png"
-          
-          upload_tasks.append(upload_tile_to_s3(tile_data, s3_key, semaphore))
-          tiles_generated += 1
-          
-          if len(upload_tasks) >= batch_size:
-            await asyncio.gather(*upload_tasks, return_exceptions=True)
-            upload_tasks.clear()
-        
-        progress['last_x'] = x
-        progress['last_y'] = y
-        progress['current_zoom'] = zoom
-        
-        if context.get_remaining_time_in_millis() < 30000:
-          logger.warning(f"Low time remaining, stopping at tile {x},{y}")
-          if upload_tasks:
-            await asyncio.gather(*upload_tasks, return_exceptions=True)
-          return tiles_generated
-            
+        if completed and not upload['failed']:
+          await complete_archive_upload(hour_output, variable, upload, bounds)
+          continue
+
+        logger.warning(f"Archive for {variable} is incomplete, aborting upload of {upload['key']}")
       except Exception as e:
-        logger.warning(f"Failed to generate tile {zoom}/{x}/{y}: {e}")
-  
-  if upload_tasks:
-    await asyncio.gather(*upload_tasks, return_exceptions=True)
-  
-  batch_time = time.time() - batch_start
-  logger.info(f"Completed {variable} zoom {zoom}: {batch_time:.1f}s, {tiles_generated} tiles")
-  
-  return tiles_generated
+        logger.error(f"Failed to complete archive {upload['key']}: {e}")
+
+      try:
+        get_s3_client().abort_multipart_upload(
+          Bucket=os.getenv('S3_TILES_BUCKET', 'custom-tiles'), Key=upload['key'], UploadId=upload['upload_id']
+        )
+      except Exception as e:
+        logger.error(f"Failed to abort upload of {upload['key']}: {e}")
+
+async def complete_archive_upload(output, variable, upload, bounds):
+  metadata = {
+    'name': f"hrrr {variable}",
+    'variable': variable,
+    'timestamp': output['timestamp'],
+    'forecast_hour': output['forecast_hour'],
+    'format': get_tile_encoding(variable)['extension']
+  }
+  first_part, last_part = finish_tile_archive(upload['archive'], metadata, bounds)
+
+  upload['etags'][1] = await upload_archive_part(upload, 1, first_part)
+  if last_part:
+    upload['etags'][upload['next_part'] + 1] = await upload_archive_part(upload, upload['next_part'] + 1, last_part)
+
+  parts = [{'ETag': etag, 'PartNumber': part_number} for part_number, etag in sorted(upload['etags'].items())]
+  s3_client = get_single_attempt_s3_client()
+  await retry_s3_request(upload['key'], lambda: s3_client.complete_multipart_upload(
+    Bucket=os.getenv('S3_TILES_BUCKET', 'custom-tiles'),
+    Key=upload['key'],
+    UploadId=upload['upload_id'],
+    MultipartUpload={'Parts': parts}
+  ))
+
+  archive = upload['archive']
+  logger.info(
+    f"Uploaded {upload['key']}: {archive['addressed_tiles']} tiles, "
+    f"{len(archive['contents'])} unique, {len(parts)} parts"
+  )
+
+async def upload_archive_part(upload, part_number, data):
+  s3_client = get_single_attempt_s3_client()
+  response = await retry_s3_request(upload['key'], lambda: s3_client.upload_part(
+    Bucket=os.getenv('S3_TILES_BUCKET', 'custom-tiles'),
+    Key=upload['key'],
+    UploadId=upload['upload_id'],
+    PartNumber=part_number,
+    Body=data
+  ))
+
+  return response['ETag']
+
+async def record_unchanged_tile(upload_queue, job, output, tile, s3_key):
+  """Keep the previous run's copy of a tile whose content hash did not change.
+
+  In pointer mode the manifest entry keeps naming the run that holds the
+  object; in copy mode S3 copies it to this run's key without re-sending it.
+  """
+  variable, zoom, x, y = tile['variable'], tile['zoom'], tile['x'], tile['y']
+  _, source_run = output['previous_manifests'][variable]['hashes'][f"{zoom}/{x}/{y}"]
+  output['stats']['unchanged'] += 1
+
+  if INCREMENTAL_MODE == 'copy':
+    source_timestamp = f"{source_run[:4]}/{source_run[4:6]}/{source_run[6:8]}/{source_run[8:10]}"
+    source_key = build_tile_s3_key(
+      source_timestamp, output['forecast_hour'], variable, zoom, x, y, get_tile_encoding(variable)['extension']
+    )
+    await queue_upload(upload_queue, job, {'key': s3_key, 'copy_source': source_key})
+    source_run = output['run']
+
+  record_tile_hash(output['manifests'][variable], zoom, x, y, tile['hash'], source_run)
+
+async def upload_worker(upload_queue, upload_stats, checkpointer):
+  while True:
+    item = await upload_queue.get()
+
+    if item is None:
+      return
+
+    observe('upload_wait', (time.perf_counter() - item['queued_at']) * 1000)
 
-async def upload_tile_to_s3(tile_data, s3_key, semaphore):
-  async with semaphore:
     try:
-      loop = asyncio.get_event_loop()
-      await loop.run_in_executor(
-        None,
-        lambda: s3_client.put_object(
-            Bucket=os.getenv('S3_TILES_BUCKET', 'custom-tiles'),
-            Key=s3_key,
-            Body=tile_data,
-            ContentType='image/png',
-            CacheControl='max-age=3600, public, immutable'
+      if 'part_number' in item:
+        item['upload']['etags'][item['part_number']] = await upload_archive_part(
+          item['upload'], item['part_number'], item['data']
         )
-      )
+      elif 'copy_source' in item:
+        await copy_tile_in_s3(item['copy_source'], item['key'])
+      else:
+        await upload_tile_to_s3(item['data'], item['key'], item['content_type'])
+      upload_stats['uploaded'] += 1
+      succeeded = True
+    except Exception:
+      if 'upload' in item:
+        item['upload']['failed'] = True
+      upload_stats['failed'] += 1
+      count('uploads_failed')
+      if len(upload_stats['failed_keys']) < MAX_REPORTED_FAILED_KEYS:
+        upload_stats['failed_keys'].append(item['key'])
+      succeeded = False
+
+    # Archive parts are not checkpointed: archives always restart from the first tile
+    if 'job' in item:
+      finish_job_upload(checkpointer, item['job'], succeeded)
+
+async def upload_tile_to_s3(tile_data, s3_key, content_type='image/png'):
+  await retry_s3_request(s3_key, lambda: get_single_attempt_s3_client().put_object(
+    Bucket=os.getenv('S3_TILES_BUCKET', 'custom-tiles'),
+    Key=s3_key,
+    Body=tile_data,
+    ContentType=content_type,
+    CacheControl='max-age=3600, public, immutable'
+  ))
+
+async def copy_tile_in_s3(source_key, s3_key):
+  bucket = os.getenv('S3_TILES_BUCKET', 'custom-tiles')
+
+  await retry_s3_request(s3_key, lambda: get_single_attempt_s3_client().copy_object(
+    Bucket=bucket,
+    Key=s3_key,
+    CopySource={'Bucket': bucket, 'Key': source_key}
+  ))
+
+async def retry_s3_request(s3_key, request):
+  loop = asyncio.get_running_loop()
+
+  for attempt in range(1, UPLOAD_MAX_ATTEMPTS + 1):
+    try:
+      async with limited(upload_limiter) as slot:
+        result = await loop.run_in_executor(upload_executor, timed_request, request)
+        record_success(upload_limiter, slot)
+
+      return result
+
     except Exception as e:
-      logger.error(f"Failed to upload tile {s3_key}: {e}")
-      raise
\ No newline at end of file
+      retry_after = record_failure(upload_limiter, e)
+
+      if attempt == UPLOAD_MAX_ATTEMPTS or not is_retryable_error(e):
+        logger.error(f"Failed to write {s3_key} after {attempt} attempts: {e}")
+        raise
+
+      # Full jitter keeps retrying workers from hitting S3 in lockstep
+      delay = retry_after or random.uniform(0, min(UPLOAD_BACKOFF_CAP, UPLOAD_BACKOFF_BASE * 2 ** attempt))
+      logger.warning(f"Retrying write of {s3_key} in {delay:.2f}s: {e}")
+      count('upload_retries')
+      await asyncio.sleep(delay)
+
+def timed_request(request):
+  """Run an S3 request on an upload thread, timing only the request itself"""
+  with timed('put'):
+    return request()
@@ -0,0 +1,350 @@
+import hashlib
+import logging
+import math
+import os
+import numpy as np
+import mercantile
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+TILE_SIZE = 256
+TILE_INDEX_VERSION = 2
+TILE_INDEX_DIR = os.getenv('TILE_INDEX_DIR', '/tmp/tile_index')
+
+# cubic: 4x4 cubic convolution (a = -0.5, as GDAL's cubic resampling)
+# bilinear: 2x2 linear interpolation
+TILE_RESAMPLING = os.getenv('TILE_RESAMPLING', 'cubic')
+RESAMPLING_TAPS = {'bilinear': (0, 1), 'cubic': (-1, 0, 1, 2)}
+
+# The HRRR grid is a regular lat/lon grid, so every output row of a tile maps
+# to one source latitude and every output column to one source longitude.
+# Each zoom therefore only needs a row index for the tile rows and a column
+# index for the tile columns covering the grid, not one per tile pixel.
+# Row targets are the Web Mercator latitudes of each pixel center, so tiles
+# line up with every other EPSG:3857 layer without a warp per tile.
+_tile_indexes = {}
+
+# Which tiles of each zoom read at least one valid grid cell, keyed by grid
+# and valid-data mask. The model domain's mask is the same every run, so
+# this is built once per grid like the index itself.
+_tile_occupancy = {}
+
+def grid_hash(lats, lons):
+  digest = hashlib.sha1(f"v{TILE_INDEX_VERSION}".encode())
+
+  for coords in (lats, lons):
+    coords = np.ascontiguousarray(coords, dtype=np.float64)
+    digest.update(str(coords.shape).encode())
+    digest.update(coords.tobytes())
+
+  return digest.hexdigest()[:16]
+
+def get_tile_index(lats, lons, zooms):
+  lats = np.asarray(lats, dtype=np.float64)
+  lons = np.asarray(lons, dtype=np.float64)
+  index_hash = grid_hash(lats, lons)
+
+  tile_index = _tile_indexes.get(index_hash)
+  if tile_index is None:
+    tile_index = load_tile_index(index_hash) or {'hash': index_hash, 'zooms': {}}
+    _tile_indexes[index_hash] = tile_index
+
+  missing_zooms = [zoom for zoom in zooms if zoom not in tile_index['zooms']]
+
+  if missing_zooms:
+    for zoom in missing_zooms:
+      tile_index['zooms'][zoom] = build_zoom_index(lats, lons, zoom)
+    save_tile_index(tile_index)
+
+  return tile_index
+
+def build_zoom_index(lats, lons, zoom):
+  lat_limit = 85.0511
+  west, east = float(lons.min()), float(lons.max())
+  south = max(float(lats.min()), -lat_limit)
+  north = min(float(lats.max()), lat_limit)
+
+  top_left = mercantile.tile(west, north, zoom)
+  bottom_right = mercantile.tile(east, south, zoom)
+
+  x_tiles = np.arange(top_left.x, bottom_right.x + 1)
+  y_tiles = np.arange(top_left.y, bottom_right.y + 1)
+
+  pixel_offsets = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+
+  world_columns = (x_tiles[:, None] + pixel_offsets[None, :]).ravel()
+  target_lons = world_columns / (2 ** zoom) * 360.0 - 180.0
+
+  world_rows = (y_tiles[:, None] + pixel_offsets[None, :]).ravel()
+  target_lats = mercator_latitudes(world_rows, zoom)
+
+  col_index, col_frac = build_axis_index(lons, target_lons)
+  row_index, row_frac = build_axis_index(lats, target_lats)
+
+  logger.info(f"Built tile index for zoom {zoom}: {len(x_tiles)}x{len(y_tiles)} tiles")
+
+  return {
+    'x0': int(top_left.x),
+    'y0': int(top_left.y),
+    'col_index': col_index,
+    'col_frac': col_frac,
+    'row_index': row_index,
+    'row_frac': row_frac
+  }
+
+def mercator_latitudes(world_rows, zoom):
+  """Latitude of each (fractional) Web Mercator tile row"""
+  n = math.pi * (1 - 2 * np.asarray(world_rows, dtype=np.float64) / (2 ** zoom))
+  return np.degrees(np.arctan(np.sinh(n)))
+
+def build_axis_index(source_coords, target_coords):
+  """Fractional source positions for each target coordinate, -1 when outside the grid"""
+  positions = np.arange(len(source_coords), dtype=np.float64)
+
+  if source_coords[0] > source_coords[-1]:
+    source_coords = source_coords[::-1]
+    positions = positions[::-1]
+
+  fractional = np.interp(target_coords, source_coords, positions)
+  outside = (target_coords < source_coords[0]) | (target_coords > source_coords[-1])
+
+  index = np.floor(fractional).astype(np.int32)
+  index = np.clip(index, 0, max(len(source_coords) - 2, 0))
+  frac = (fractional - index).astype(np.float32)
+  index[outside] = -1
+
+  return index, frac
+
+def get_tile_resampling(tile_index, zoom, x, y, span=1):
+  """Resampling for the span x span block of tiles whose top-left tile is x, y"""
+  zoom_index = tile_index['zooms'][zoom]
+  length = span * TILE_SIZE
+
+  row_index, row_frac = slice_axis_index(
+    zoom_index['row_index'], zoom_index['row_frac'], (y - zoom_index['y0']) * TILE_SIZE, length
+  )
+  col_index, col_frac = slice_axis_index(
+    zoom_index['col_index'], zoom_index['col_frac'], (x - zoom_index['x0']) * TILE_SIZE, length
+  )
+
+  if (row_index < 0).all() or (col_index < 0).all():
+    return None
+
+  return row_index, row_frac, col_index, col_frac
+
+def slice_axis_index(index, frac, start, length):
+  stop = start + length
+
+  if start >= 0 and stop <= len(index):
+    return index[start:stop], frac[start:stop]
+
+  sliced_index = np.full(length, -1, dtype=np.int32)
+  sliced_frac = np.zeros(length, dtype=np.float32)
+
+  source_start, source_stop = max(start, 0), min(stop, len(index))
+  if source_start < source_stop:
+    sliced_index[source_start - start:source_stop - start] = index[source_start:source_stop]
+    sliced_frac[source_start - start:source_stop - start] = frac[source_start:source_stop]
+
+  return sliced_index, sliced_frac
+
+def resample_tile(values, resampling):
+  """Separable resample of a (..., lat, lon) array to the tile's rows and columns.
+
+  Only the source rows the tile reads are gathered: the column pass
+  interpolates those rows to the tile's columns, and the row pass combines
+  them into tile rows. Leading axes, such as a stack of forecast hours, share
+  the tile's indices and weights and come back as (..., rows, cols).
+  """
+  row_index, row_frac, col_index, col_frac = resampling
+  n_rows, n_cols = values.shape[-2:]
+
+  row_taps, row_weights = get_axis_taps(row_index, row_frac, n_rows)
+  col_taps, col_weights = get_axis_taps(col_index, col_frac, n_cols)
+  source_rows, row_positions = np.unique(row_taps, return_inverse=True)
+  row_positions = row_positions.reshape(row_taps.shape)
+
+  flat_values = values.reshape(values.shape[:-2] + (n_rows * n_cols,))
+  columns = None
+  for taps, weights in zip(col_taps, col_weights):
+    term = np.take(flat_values, source_rows[:, None] * n_cols + taps[None, :], axis=-1) * weights
+    columns = term if columns is None else columns + term
+
+  tile = None
+  for positions, weights in zip(row_positions, row_weights):
+    term = np.take(columns, positions, axis=-2) * weights[:, None]
+    tile = term if tile is None else tile + term
+
+  tile[..., row_index < 0, :] = np.nan
+  tile[..., col_index < 0] = np.nan
+
+  return tile
+
+def get_axis_taps(index, frac, n_cells):
+  """(taps, length) source cells and weights along one axis for TILE_RESAMPLING"""
+  base = np.where(index < 0, 0, index)
+  offsets = np.asarray(RESAMPLING_TAPS[TILE_RESAMPLING])
+  taps = np.clip(base[None, :] + offsets[:, None], 0, n_cells - 1)
+
+  if TILE_RESAMPLING == 'cubic':
+    weights = np.stack([
+      ((-0.5 * frac + 1) * frac - 0.5) * frac,
+      (1.5 * frac - 2.5) * frac * frac + 1,
+      ((-1.5 * frac + 2) * frac + 0.5) * frac,
+      (0.5 * frac - 0.5) * frac * frac
+    ])
+  else:
+    weights = np.stack([1 - frac, frac])
+
+  return taps, weights.astype(np.float32)
+
+def get_tile_occupancy(tile_index, valid_mask, zooms):
+  """Per-zoom {'x0', 'y0', 'tiles'} bitmaps of the tiles with any valid data nearby.
+
+  A tile counts as occupied when any grid cell its resampling reads
+  is valid, so it is never skipped when it could have data; some occupied
+  edge tiles still render empty.
+  """
+  mask_digest = hashlib.sha1(str(valid_mask.shape).encode())
+  mask_digest.update(np.packbits(valid_mask).tobytes())
+  key = f"{tile_index['hash']}_{TILE_RESAMPLING}_{mask_digest.hexdigest()[:16]}"
+
+  occupancy = _tile_occupancy.get(key)
+  if occupancy is None:
+    occupancy = load_zoom_arrays(tile_occupancy_path(key)) or {}
+    _tile_occupancy[key] = occupancy
+
+  missing_zooms = [zoom for zoom in zooms if zoom not in occupancy]
+
+  if missing_zooms:
+    # Valid cells in [0, row) x [0, col), so any rectangle's count is four lookups
+    counts = np.zeros((valid_mask.shape[0] + 1, valid_mask.shape[1] + 1), dtype=np.int64)
+    counts[1:, 1:] = valid_mask.cumsum(axis=0).cumsum(axis=1)
+
+    for zoom in missing_zooms:
+      occupancy[zoom] = build_zoom_occupancy(tile_index['zooms'][zoom], counts)
+    save_zoom_arrays(tile_occupancy_path(key), occupancy)
+
+  return {zoom: occupancy[zoom] for zoom in zooms}
+
+def build_zoom_occupancy(zoom_index, counts):
+  row_start, row_stop = tile_read_spans(zoom_index['row_index'], counts.shape[0] - 1)
+  col_start, col_stop = tile_read_spans(zoom_index['col_index'], counts.shape[1] - 1)
+
+  valid_cells = (
+    counts[row_stop[:, None], col_stop[None, :]] - counts[row_start[:, None], col_stop[None, :]]
+    - counts[row_stop[:, None], col_start[None, :]] + counts[row_start[:, None], col_start[None, :]]
+  )
+  tiles = valid_cells > 0
+
+  logger.info(f"Tile occupancy: {int(tiles.sum())} of {tiles.size} tiles have data")
+
+  return {'x0': zoom_index['x0'], 'y0': zoom_index['y0'], 'tiles': tiles}
+
+def tile_read_spans(index, n_cells):
+  """The [start, stop) range of grid cells each tile's rows (or columns) read"""
+  tile_index = index.reshape(-1, TILE_SIZE)
+  inside = tile_index >= 0
+
+  offsets = RESAMPLING_TAPS[TILE_RESAMPLING]
+
+  start = np.maximum(np.where(inside, tile_index, n_cells).min(axis=1) + offsets[0], 0)
+  stop = np.minimum(np.where(inside, tile_index, -n_cells).max(axis=1) + offsets[-1] + 1, n_cells)
+
+  empty = ~inside.any(axis=1)
+  start[empty] = stop[empty] = 0
+
+  return start, stop
+
+def get_occupied_tiles(zoom_occupancy):
+  """Occupied (x, y) tiles in x-major order"""
+  cols, rows = np.nonzero(zoom_occupancy['tiles'].T)
+
+  return [(int(col) + zoom_occupancy['x0'], int(row) + zoom_occupancy['y0']) for col, row in zip(cols, rows)]
+
+def is_tile_occupied(zoom_occupancy, x, y):
+  row, col = y - zoom_occupancy['y0'], x - zoom_occupancy['x0']
+  rows, cols = zoom_occupancy['tiles'].shape
+
+  return 0 <= row < rows and 0 <= col < cols and bool(zoom_occupancy['tiles'][row, col])
+
+def clip_occupancy(occupancy, base_zoom, x_range):
+  """Copy of the occupancy keeping only the tiles under columns x_range of base_zoom"""
+  clipped = {}
+
+  for zoom, zoom_occupancy in occupancy.items():
+    shift = zoom - base_zoom
+    x_min, x_max = x_range[0] << shift, ((x_range[1] + 1) << shift) - 1
+
+    tiles = zoom_occupancy['tiles'].copy()
+    cols = np.arange(tiles.shape[1]) + zoom_occupancy['x0']
+    tiles[:, (cols < x_min) | (cols > x_max)] = False
+
+    clipped[zoom] = {**zoom_occupancy, 'tiles': tiles}
+
+  return clipped
+
+def get_occupied_bounds(zoom_occupancy, zoom):
+  """(west, south, east, north) of the occupied tiles, or None if there are none"""
+  rows, cols = np.nonzero(zoom_occupancy['tiles'])
+
+  if not len(rows):
+    return None
+
+  north_west = mercantile.bounds(int(cols.min()) + zoom_occupancy['x0'], int(rows.min()) + zoom_occupancy['y0'], zoom)
+  south_east = mercantile.bounds(int(cols.max()) + zoom_occupancy['x0'], int(rows.max()) + zoom_occupancy['y0'], zoom)
+
+  return north_west.west, south_east.south, south_east.east, north_west.north
+
+def tile_index_path(index_hash):
+  return os.path.join(TILE_INDEX_DIR, f"tile_index_{index_hash}.npz")
+
+def tile_occupancy_path(key):
+  return os.path.join(TILE_INDEX_DIR, f"tile_occupancy_{key}.npz")
+
+def load_tile_index(index_hash):
+  zooms = load_zoom_arrays(tile_index_path(index_hash))
+
+  if zooms is None:
+    return None
+
+  return {'hash': index_hash, 'zooms': zooms}
+
+def save_tile_index(tile_index):
+  save_zoom_arrays(tile_index_path(tile_index['hash']), tile_index['zooms'])
+
+def load_zoom_arrays(path):
+  """{zoom: {field: value}} as saved by save_zoom_arrays, or None"""
+  if not os.path.exists(path):
+    return None
+
+  try:
+    zooms = {}
+    with np.load(path) as stored:
+      for key in stored.files:
+        zoom, field = key.split('_', 1)
+        value = stored[key]
+        zooms.setdefault(int(zoom), {})[field] = int(value) if value.ndim == 0 else value
+
+    logger.info(f"Loaded {path} for zooms {sorted(zooms)}")
+    return zooms
+
+  except Exception as e:
+    logger.warning(f"Could not load {path}: {e}")
+    return None
+
+def save_zoom_arrays(path, zooms):
+  try:
+    os.makedirs(TILE_INDEX_DIR, exist_ok=True)
+    arrays = {
+      f"{zoom}_{field}": np.asarray(value)
+      for zoom, zoom_fields in zooms.items()
+      for field, value in zoom_fields.items()
+    }
+    tmp_path = f"{path}.tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+  except Exception as e:
+    logger.warning(f"Could not save {path}: {e}")
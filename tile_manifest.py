@@ -0,0 +1,63 @@
+import hashlib
+import json
+import logging
+import os
+from botocore.exceptions import ClientError
+
+from utils import TILE_KEY_LAYOUT
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MANIFEST_VERSION = 1
+
+# A per-variable manifest keyed "zoom/x/y".
+# 'tiles' is sparse: tiles that were not written as their own object, with
+# the tile's single RGBA color and, when the tile was uploaded once as a
+# shared object, the key of that object.
+# 'hashes' holds [content hash, run] for every encoded tile, where run is
+# the sortable timestamp of the model run whose key holds the tile.
+# 'key_layout' is present when tile keys carry a hash prefix (see apply_key_layout).
+
+def new_manifest():
+  manifest = {'version': MANIFEST_VERSION, 'tiles': {}, 'hashes': {}}
+
+  if TILE_KEY_LAYOUT != 'plain':
+    manifest['key_layout'] = TILE_KEY_LAYOUT
+
+  return manifest
+
+def record_tile(manifest, zoom, x, y, entry):
+  manifest['tiles'][f"{zoom}/{x}/{y}"] = entry
+
+def record_tile_hash(manifest, zoom, x, y, content_hash, run):
+  manifest.setdefault('hashes', {})[f"{zoom}/{x}/{y}"] = [content_hash, run]
+
+def content_digest(data):
+  return hashlib.sha256(data).hexdigest()[:32]
+
+def load_manifest(s3_client, s3_key):
+  try:
+    response = s3_client.get_object(
+      Bucket=os.getenv('S3_TILES_BUCKET', 'custom-tiles'),
+      Key=s3_key
+    )
+    manifest = json.loads(response['Body'].read())
+    logger.info(f"Loaded manifest {s3_key} with {len(manifest.get('tiles', {}))} tiles")
+    return manifest
+
+  except ClientError as e:
+    error_code = e.response.get('Error', {}).get('Code')
+    if error_code in ('NoSuchKey', '404'):
+      return new_manifest()
+    raise
+
+def save_manifest(s3_client, s3_key, manifest):
+  s3_client.put_object(
+    Bucket=os.getenv('S3_TILES_BUCKET', 'custom-tiles'),
+    Key=s3_key,
+    Body=json.dumps(manifest, separators=(',', ':')).encode(),
+    ContentType='application/json',
+    CacheControl='max-age=300, public'
+  )
+  logger.info(f"Saved manifest {s3_key} with {len(manifest['tiles'])} tiles")
@@ -5,82 +5,437 @@ import os
 import gc
 from datetime import datetime, timezone
 
-from read_net_cdf import read_weather
-from s3_and_database_access import download_multiple_netcdf_files, db
-from tile_generator import generate_all_tiles_for_variable
-from utils import build_most_recent_file_stamp, build_s3_filename, create_local_netcdf_path
+import numpy as np
+
+from read_net_cdf import read_weather, read_store_weather
+from s3_and_database_access import (
+  download_multiple_netcdf_files, build_netcdf_range_url, open_run_store, get_db
+)
+from tile_generator import (
+  generate_all_tiles_for_variable, generate_all_tiles_for_variables,
+  generate_forecast_hour_tiles, generate_shard_tiles, merge_shard_manifests
+)
+from tile_store import (
+  read_json, write_store_group, write_store_variable, STORE_ZOOM, STORE_OVERVIEW_LEVELS
+)
+from metrics import timed
+from utils import (
+  build_most_recent_file_stamp, build_s3_filename, create_local_netcdf_path,
+  get_lambda_tmp_space, cleanup_tmp_directory
+)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 TARGET_ZOOM_LEVELS = [6, 8, 10]
 
+# download: copy the whole NetCDF file to /tmp before reading
+# range: read only the requested variables over HTTP range requests
+# store: read the run's tile store written by ingest_model_run
+# Both fall back to a download if the remote open fails
+NETCDF_ACCESS = os.getenv('NETCDF_ACCESS', 'download')
+
+# A warm container keeps /tmp between invocations, including downloads an
+# earlier invocation failed to remove; below this much free space they go
+MIN_TMP_SPACE_MB = int(os.getenv('MIN_TMP_SPACE_MB', '256'))
+
+# NetCDF files this invocation is downloading or has open. Forecast hours load
+# concurrently, so one hour's cleanup must leave the others' files alone
+_netcdf_in_use = set()
+
 async def process_single_variable(variable, forecast_hour, context, override=None):
   try:
     current_timestamp = build_most_recent_file_stamp(override=override)
 
-    s3_netcdf_file = build_s3_filename(current_timestamp, forecast_hour)
-    filename = s3_netcdf_file.split('/')[-1]
-    local_netcdf_path = create_local_netcdf_path(filename)
-    
-    downloaded_files = await download_multiple_netcdf_files([(s3_netcdf_file, local_netcdf_path, forecast_hour)])
+    weather_data, local_path = await load_weather_data(current_timestamp, forecast_hour, [variable])
     
-    if not downloaded_files:
-      logger.error("Failed to download NetCDF file")
+    if weather_data is None:
       return {'status': 'error', 'reason': 'download_failed'}
     
-    local_path, _ = downloaded_files[0]
-    weather_data = await read_weather(local_path)
+    progress = get_variable_progress(current_timestamp, variable, forecast_hour)
+    
+    generation = await generate_all_tiles_for_variable(
+      weather_data, current_timestamp, forecast_hour, variable, progress, context
+    )
+    tiles_generated = generation['tiles_generated']
+    
+    if generation['complete']:
+      mark_variable_complete(current_timestamp, variable, forecast_hour)
+    
+    close_weather_data(weather_data, local_path)
+    
+    logger.info(f"Generated {tiles_generated} tiles for {variable}, complete: {generation['complete']}")
+    return {
+      'status': 'success' if generation['complete'] else 'partial',
+      'tiles_generated': tiles_generated,
+      'uniform_tiles': generation['uniform_tiles'],
+      'unchanged_tiles': generation['unchanged_tiles'],
+      'failed_uploads': generation['failed_uploads'],
+      'failed_keys': generation['failed_keys']
+    }
+    
+  except Exception as error:
+    logger.error(f"Error processing variable {variable}: {error}")
+    raise
+
+async def process_all_variables(variables, forecast_hour, context, override=None):
+  """Render every variable from a single download and open of the NetCDF file"""
+  try:
+    current_timestamp = build_most_recent_file_stamp(override=override)
+    
+    pending_variables = [
+      variable for variable in variables
+      if not is_variable_complete(current_timestamp, variable, forecast_hour)
+    ]
+    
+    if not pending_variables:
+      logger.info(f"All variables already complete for {current_timestamp}")
+      return {'status': 'success', 'tiles_generated': 0, 'variables': []}
+
+    weather_data, local_path = await load_weather_data(current_timestamp, forecast_hour, pending_variables)
     
     if weather_data is None:
-      logger.warning(f"No weather data for variable {variable}")
-      return {'status': 'error', 'reason': 'no_data'}
+      return {'status': 'error', 'reason': 'download_failed'}
     
-    progress = get_variable_progress(current_timestamp, variable)
+    variable_set = get_variable_set_key(pending_variables)
+    progress = get_variable_progress(current_timestamp, variable_set, forecast_hour)
     
-    tiles_generated = await generate_all_tiles_for_variable(
-      weather_data, current_timestamp, forecast_hour, variable, progress, context
+    generation = await generate_all_tiles_for_variables(
+      weather_data, current_timestamp, forecast_hour, pending_variables, progress, context
     )
+    tiles_generated = generation['tiles_generated']
+    
+    if generation['complete']:
+      for variable in pending_variables:
+        mark_variable_complete(current_timestamp, variable, forecast_hour)
+      mark_variable_complete(current_timestamp, variable_set, forecast_hour)
+    
+    close_weather_data(weather_data, local_path)
+    
+    logger.info(f"Generated {tiles_generated} tiles for {len(pending_variables)} variables, complete: {generation['complete']}")
+    return {
+      'status': 'success' if generation['complete'] else 'partial',
+      'tiles_generated': tiles_generated,
+      'uniform_tiles': generation['uniform_tiles'],
+      'unchanged_tiles': generation['unchanged_tiles'],
+      'failed_uploads': generation['failed_uploads'],
+      'failed_keys': generation['failed_keys'],
+      'variables': pending_variables
+    }
+    
+  except Exception as error:
+    logger.error(f"Error processing variables {variables}: {error}")
+    raise
+
+async def process_forecast_hours(variables, forecast_hours, context, override=None):
+  """Render several forecast hours together from concurrently loaded NetCDF files"""
+  loaded = {}
+  
+  try:
+    current_timestamp = build_most_recent_file_stamp(override=override)
+    hour_range = '-'.join(forecast_hours)
+    variable_set = get_variable_set_key(variables)
+    
+    if is_variable_complete(current_timestamp, variable_set, hour_range):
+      logger.info(f"Forecast hours {forecast_hours} already complete for {current_timestamp}")
+      return {'status': 'success', 'tiles_generated': 0, 'forecast_hours': []}
+    
+    loaded = await load_forecast_hours(current_timestamp, forecast_hours, variables)
+    
+    if len(loaded) < len(forecast_hours):
+      missing = [forecast_hour for forecast_hour in forecast_hours if forecast_hour not in loaded]
+      logger.error(f"Failed to load forecast hours {missing}")
+      return {'status': 'error', 'reason': 'download_failed', 'forecast_hours': missing}
+    
+    progress = get_variable_progress(current_timestamp, variable_set, hour_range)
+    
+    generation = await generate_forecast_hour_tiles(
+      {forecast_hour: weather_data for forecast_hour, (weather_data, _) in loaded.items()},
+      current_timestamp, variables, progress, context
+    )
+    tiles_generated = generation['tiles_generated']
+    
+    if generation['complete']:
+      mark_variable_complete(current_timestamp, variable_set, hour_range)
+    
+    logger.info(f"Generated {tiles_generated} tiles for forecast hours {forecast_hours}, complete: {generation['complete']}")
+    return {
+      'status': 'success' if generation['complete'] else 'partial',
+      'tiles_generated': tiles_generated,
+      'uniform_tiles': generation['uniform_tiles'],
+      'unchanged_tiles': generation['unchanged_tiles'],
+      'failed_uploads': generation['failed_uploads'],
+      'failed_keys': generation['failed_keys'],
+      'forecast_hours': forecast_hours
+    }
+  
+  except Exception as error:
+    logger.error(f"Error processing forecast hours {forecast_hours}: {error}")
+    raise
+  
+  finally:
+    for weather_data, local_path in loaded.values():
+      close_weather_data(weather_data, local_path)
+
+async def process_shard(shard, context, override=None):
+  """Render one shard from shard_planner, resuming under the shard's own progress"""
+  try:
+    current_timestamp = build_most_recent_file_stamp(override=override)
+    forecast_hour = shard['forecast_hour']
+    
+    if is_variable_complete(current_timestamp, shard['id'], forecast_hour):
+      logger.info(f"Shard {shard['id']} already complete for {current_timestamp}")
+      return {'status': 'success', 'tiles_generated': 0}
+    
+    weather_data, local_path = await load_weather_data(current_timestamp, forecast_hour, shard['variables'])
+    
+    if weather_data is None:
+      return {'status': 'error', 'reason': 'download_failed', 'tiles_generated': 0}
     
-    mark_variable_complete(current_timestamp, variable)
+    progress = get_variable_progress(current_timestamp, shard['id'], forecast_hour)
     
-    weather_data.close()
     try:
-      os.remove(local_path)
-    except Exception as e:
-      logger.warning(f"Could not remove {local_path}: {e}")
+      generation = await generate_shard_tiles(weather_data, current_timestamp, shard, progress, context)
+    finally:
+      close_weather_data(weather_data, local_path)
     
-    logger.info(f"Successfully generated {tiles_generated} tiles for {variable}")
-    return {'status': 'success', 'tiles_generated': tiles_generated}
+    if generation['complete']:
+      mark_variable_complete(current_timestamp, shard['id'], forecast_hour)
     
+    logger.info(f"Generated {generation['tiles_generated']} tiles for shard {shard['id']}, complete: {generation['complete']}")
+    return {
+      'status': 'success' if generation['complete'] else 'partial',
+      'tiles_generated': generation['tiles_generated'],
+      'uniform_tiles': generation['uniform_tiles'],
+      'unchanged_tiles': generation['unchanged_tiles'],
+      'failed_uploads': generation['failed_uploads'],
+      'failed_keys': generation['failed_keys']
+    }
+  
   except Exception as error:
-    logger.error(f"Error processing variable {variable}: {error}")
+    logger.error(f"Error processing shard {shard.get('id')}: {error}")
+    raise
+
+def finish_shards(shards, results, override=None):
+  """Merge the shards' manifests and total the Map state's results, which are in shard order"""
+  current_timestamp = build_most_recent_file_stamp(override=override)
+  merge_shard_manifests(current_timestamp, shards)
+  
+  incomplete = [shard['id'] for shard, result in zip(shards, results) if result.get('status') != 'success']
+  if incomplete:
+    logger.warning(f"{len(incomplete)} of {len(shards)} shards incomplete: {incomplete[:10]}")
+  
+  return {
+    'total_tiles_generated': sum(result.get('tiles_generated', 0) for result in results),
+    'incomplete_shards': incomplete
+  }
+
+async def ingest_model_run(forecast_hours, variables, context, override=None):
+  """Convert each forecast hour's NetCDF file into the run's chunked tile store"""
+  try:
+    current_timestamp = build_most_recent_file_stamp(override=override)
+    store = open_run_store(current_timestamp)
+    ingested = []
+    
+    for forecast_hour in forecast_hours:
+      if read_json(store, f"{forecast_hour}/.zattrs"):
+        logger.info(f"Forecast hour {forecast_hour} already ingested for {current_timestamp}")
+        ingested.append(forecast_hour)
+        continue
+      
+      if context.get_remaining_time_in_millis() < 120000:
+        logger.warning(f"Low time remaining, stopping before forecast hour {forecast_hour}")
+        break
+      
+      weather_data, local_path = await load_weather_data(
+        current_timestamp, forecast_hour, variables, sampling=1, allow_store=False
+      )
+      
+      if weather_data is None:
+        return {'status': 'error', 'reason': 'download_failed', 'forecast_hours': ingested}
+      
+      lats = weather_data['lat'].values
+      lons = weather_data['lon'].values
+      written = []
+      
+      for variable in variables:
+        if variable not in weather_data.data_vars:
+          logger.warning(f"Variable {variable} not found in dataset")
+          continue
+        
+        values = weather_data[variable].transpose('lat', 'lon').values.astype(np.float32, copy=False)
+        write_store_variable(store, forecast_hour, variable, values, lats, lons)
+        written.append(variable)
+      
+      # The forecast hour's attributes are written last and mark it complete
+      write_store_group(store, forecast_hour, {
+        'variables': written,
+        'ingested_at': datetime.now(timezone.utc).isoformat()
+      })
+      ingested.append(forecast_hour)
+      
+      close_weather_data(weather_data, local_path)
+      gc.collect()
+    
+    write_store_group(store, '', {
+      'timestamp': current_timestamp,
+      'forecast_hours': ingested,
+      'variables': variables,
+      'store_zoom': STORE_ZOOM,
+      'overview_levels': STORE_OVERVIEW_LEVELS
+    })
+    
+    logger.info(f"Ingested forecast hours {ingested} into {store['location']}")
+    return {
+      'status': 'success' if len(ingested) == len(forecast_hours) else 'partial',
+      'forecast_hours': ingested
+    }
+  
+  except Exception as error:
+    logger.error(f"Error ingesting model run: {error}")
     raise
 
-def get_variable_progress(timestamp, variable):
-  """Get progress for a specific variable"""
-  progress = db.tile_progress.find_one({
+async def load_weather_data(current_timestamp, forecast_hour, variables, sampling=None, allow_store=True):
+  """Open the forecast hour from the tile store, by range reads or from a download.
+
+  Returns (weather_data, local_path), where local_path is the downloaded file
+  to remove afterwards, or (None, None) if the download failed.
+  """
+  s3_netcdf_file = build_s3_filename(current_timestamp, forecast_hour)
+  
+  if NETCDF_ACCESS == 'store' and allow_store:
+    try:
+      with timed('open'):
+        return await read_store_weather(open_run_store(current_timestamp), forecast_hour, variables), None
+    except Exception as e:
+      logger.warning(f"Tile store read for {current_timestamp} failed, downloading instead: {e}")
+  
+  if NETCDF_ACCESS == 'range':
+    try:
+      with timed('open'):
+        return await read_weather(build_netcdf_range_url(s3_netcdf_file), variables, sampling), None
+    except Exception as e:
+      logger.warning(f"Range read of {s3_netcdf_file} failed, downloading instead: {e}")
+  
+  filename = s3_netcdf_file.split('/')[-1]
+  local_netcdf_path = create_local_netcdf_path(filename)
+  _netcdf_in_use.add(local_netcdf_path)
+  free_tmp_space()
+  
+  downloaded_files = await download_multiple_netcdf_files([(s3_netcdf_file, local_netcdf_path, forecast_hour)])
+  
+  if not downloaded_files:
+    _netcdf_in_use.discard(local_netcdf_path)
+    logger.error("Failed to download NetCDF file")
+    return None, None
+  
+  local_path, _ = downloaded_files[0]
+  with timed('open'):
+    weather_data = await read_weather(local_path, sampling=sampling)
+  
+  if weather_data is None:
+    _netcdf_in_use.discard(local_path)
+  return weather_data, local_path
+
+async def load_forecast_hours(current_timestamp, forecast_hours, variables):
+  """Open several forecast hours at once, with any downloads sharing one concurrency limit.
+
+  Returns {forecast_hour: (weather_data, local_path)} in forecast hour order
+  for the hours that opened.
+  """
+  if NETCDF_ACCESS != 'download':
+    opened = await asyncio.gather(*(
+      load_weather_data(current_timestamp, forecast_hour, variables) for forecast_hour in forecast_hours
+    ))
+    return {
+      forecast_hour: result for forecast_hour, result in zip(forecast_hours, opened) if result[0] is not None
+    }
+  
+  download_tasks = []
+  for forecast_hour in forecast_hours:
+    s3_netcdf_file = build_s3_filename(current_timestamp, forecast_hour)
+    download_tasks.append((s3_netcdf_file, create_local_netcdf_path(s3_netcdf_file.split('/')[-1]), forecast_hour))
+  
+  _netcdf_in_use.update(local_path for _, local_path, _ in download_tasks)
+  free_tmp_space()
+  
+  downloaded_files = await download_multiple_netcdf_files(download_tasks)
+  local_paths = {forecast_hour: local_path for local_path, forecast_hour in downloaded_files}
+  opened = {}
+  
+  for _, local_path, forecast_hour in download_tasks:
+    if forecast_hour in local_paths:
+      with timed('open'):
+        weather_data = await read_weather(local_path, variables)
+      if weather_data is not None:
+        opened[forecast_hour] = (weather_data, local_path)
+        continue
+    _netcdf_in_use.discard(local_path)
+  
+  return opened
+
+def free_tmp_space():
+  available = get_lambda_tmp_space()
+  
+  if available < MIN_TMP_SPACE_MB:
+    logger.warning(f"Only {available:.0f} MB free in /tmp, removing NetCDF files left by earlier invocations")
+    cleanup_tmp_directory(suffix='.nc', keep=_netcdf_in_use)
+
+def close_weather_data(weather_data, local_path):
+  weather_data.close()
+  
+  if local_path:
+    _netcdf_in_use.discard(local_path)
+    try:
+      os.remove(local_path)
+    except Exception as e:
+      logger.warning(f"Could not remove {local_path}: {e}")
+
+def get_variable_set_key(variables):
+  """The progress key for rendering variables together.
+
+  Progress records which tiles are done for every variable in the set, so a
+  different set (another request, or fewer pending variables) starts afresh.
+  """
+  return 'all:' + ','.join(sorted(variables))
+
+def get_variable_progress(timestamp, variable, forecast_hour=None):
+  """Get progress for a specific variable, resuming where a previous invocation stopped"""
+  progress = get_db().tile_progress.find_one({
     'timestamp': timestamp,
-    'variable': variable
+    'variable': variable,
+    'forecast_hour': forecast_hour
   })
   
   if not progress:
     progress = {
       'timestamp': timestamp,
       'variable': variable,
+      'forecast_hour': forecast_hour,
       'completed_zooms': [],
-      'current_zoom': TARGET_ZOOM_LEVELS[0],
-      'last_x': 0,
-      'last_y': 0,
       'status': 'in_progress'
     }
-    db.tile_progress.insert_one(progress)
+    get_db().tile_progress.insert_one(dict(progress))
+  
+  elif progress.get('completed_zooms') or 'last_x' in progress or 'last_block' in progress:
+    logger.info(f"Resuming {variable} for {timestamp} after zooms {progress.get('completed_zooms', [])}")
   
   return progress
 
-def mark_variable_complete(timestamp, variable):
+def is_variable_complete(timestamp, variable, forecast_hour=None):
+  """Check whether a variable has already been fully processed"""
+  progress = get_db().tile_progress.find_one({
+    'timestamp': timestamp,
+    'variable': variable,
+    'forecast_hour': forecast_hour,
+    'status': 'complete'
+  })
+  
+  return progress is not None
+
+def mark_variable_complete(timestamp, variable, forecast_hour=None):
   """Mark variable as completely processed"""
-  db.tile_progress.update_one(
-    {'timestamp': timestamp, 'variable': variable},
+  get_db().tile_progress.update_one(
+    {'timestamp': timestamp, 'variable': variable, 'forecast_hour': forecast_hour},
     {'$set': {'status': 'complete', 'completed_at': datetime.now(timezone.utc)}}
-  )
\ No newline at end of file
+  )
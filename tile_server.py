@@ -0,0 +1,286 @@
+"""On-demand tile endpoint for zooms that are not pre-rendered.
+
+Run from the repository root:
+
+  python tile_server.py [--port 8080] [--timestamp YYYY/MM/DD/HH]
+
+and request /{variable}/{forecast_hour}/{zoom}/{x}/{y}.{png|webp}. Each
+forecast hour is opened once and kept hot; encoded tiles are kept in a
+byte-bounded in-memory LRU, optionally backed by TILE_CACHE_DIR on disk, and
+concurrent requests for the same tile share one render.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from generate_tiles import prepare_tile_source, render_tiles, generate_store_tile, get_tile_encoding
+from s3_and_database_access import open_run_store
+from tile_index import get_tile_index
+from tile_processor import load_weather_data, NETCDF_ACCESS
+from utils import build_most_recent_file_stamp, build_sortable_timestamp
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+TILE_SERVER_PORT = int(os.getenv('TILE_SERVER_PORT', '8080'))
+TILE_CACHE_BYTES = int(os.getenv('TILE_CACHE_BYTES', str(256 * 1024 * 1024)))
+TILE_CACHE_DIR = os.getenv('TILE_CACHE_DIR')
+MAX_SERVER_ZOOM = int(os.getenv('MAX_SERVER_ZOOM', '13'))
+
+# Charged per cached tile on top of its bytes, so empty tiles still count
+CACHE_ENTRY_OVERHEAD = 256
+
+TILE_PATH = re.compile(r'^/(?P<variable>\w+)/(?P<forecast_hour>\d+)/(?P<zoom>\d+)/(?P<x>\d+)/(?P<y>\d+)\.(?P<extension>\w+)$')
+
+def new_tile_cache(max_bytes):
+  return {'tiles': OrderedDict(), 'bytes': 0, 'max_bytes': max_bytes, 'lock': threading.Lock()}
+
+def cache_get(cache, key):
+  with cache['lock']:
+    data = cache['tiles'].get(key)
+    if data is not None:
+      cache['tiles'].move_to_end(key)
+    return data
+
+def cache_put(cache, key, data):
+  with cache['lock']:
+    previous = cache['tiles'].pop(key, None)
+    if previous is not None:
+      cache['bytes'] -= len(previous) + CACHE_ENTRY_OVERHEAD
+
+    cache['tiles'][key] = data
+    cache['bytes'] += len(data) + CACHE_ENTRY_OVERHEAD
+
+    while cache['bytes'] > cache['max_bytes'] and len(cache['tiles']) > 1:
+      _, evicted = cache['tiles'].popitem(last=False)
+      cache['bytes'] -= len(evicted) + CACHE_ENTRY_OVERHEAD
+
+def create_tile_service(timestamp, cache_bytes=TILE_CACHE_BYTES, cache_dir=TILE_CACHE_DIR):
+  return {
+    'timestamp': timestamp,
+    'cache': new_tile_cache(cache_bytes),
+    'cache_dir': cache_dir,
+    'sources': {},
+    'source_lock': threading.Lock(),
+    'index_lock': threading.Lock(),
+    'inflight': {},
+    'inflight_lock': threading.Lock(),
+    'stats': {'memory_hits': 0, 'disk_hits': 0, 'renders': 0, 'coalesced': 0},
+    'stats_lock': threading.Lock()
+  }
+
+def count_stat(service, name):
+  with service['stats_lock']:
+    service['stats'][name] += 1
+
+def get_tile(service, variable, forecast_hour, zoom, x, y):
+  """Encoded tile bytes, or b'' for a tile with no data"""
+  key = (variable, forecast_hour, zoom, x, y)
+
+  data = cache_get(service['cache'], key)
+  if data is not None:
+    count_stat(service, 'memory_hits')
+    return data
+
+  with service['inflight_lock']:
+    future = service['inflight'].get(key)
+    owner = future is None
+    if owner:
+      future = Future()
+      service['inflight'][key] = future
+
+  if not owner:
+    count_stat(service, 'coalesced')
+    return future.result()
+
+  try:
+    data = read_disk_tile(service, key)
+
+    if data is None:
+      data = render_service_tile(service, variable, forecast_hour, zoom, x, y)
+      write_disk_tile(service, key, data)
+    else:
+      count_stat(service, 'disk_hits')
+
+    cache_put(service['cache'], key, data)
+    future.set_result(data)
+    return data
+
+  except Exception as e:
+    future.set_exception(e)
+    raise
+
+  finally:
+    with service['inflight_lock']:
+      service['inflight'].pop(key, None)
+
+def render_service_tile(service, variable, forecast_hour, zoom, x, y):
+  count_stat(service, 'renders')
+
+  if NETCDF_ACCESS == 'store':
+    store = get_forecast_source(service, forecast_hour)
+    return generate_store_tile(x, y, zoom, variable, store, forecast_hour) or b''
+
+  source = get_variable_source(service, forecast_hour, variable, zoom)
+  if source is None:
+    return b''
+
+  return render_tiles(source, x, y, zoom, [variable]).get(variable, b'')
+
+def load_source(service, key, load):
+  """service['sources'][key], loaded once by the first request for it while later ones wait.
+
+  source_lock only guards the dict, so a slow load holds up nothing but the
+  requests that need its result. A failed load is dropped for the next
+  request to retry.
+  """
+  with service['source_lock']:
+    future = service['sources'].get(key)
+    owner = future is None
+    if owner:
+      future = service['sources'][key] = Future()
+
+  if owner:
+    try:
+      future.set_result(load())
+    except Exception as e:
+      with service['source_lock']:
+        service['sources'].pop(key, None)
+      future.set_exception(e)
+
+  return future.result()
+
+def get_forecast_source(service, forecast_hour):
+  """The forecast hour's dataset (or tile store), opened once and kept hot"""
+  return load_source(service, forecast_hour, lambda: open_forecast_source(service, forecast_hour))
+
+def open_forecast_source(service, forecast_hour):
+  if NETCDF_ACCESS == 'store':
+    return open_run_store(service['timestamp'])
+
+  weather_data, _ = asyncio.run(load_weather_data(
+    service['timestamp'], forecast_hour, None, sampling=1, allow_store=False
+  ))
+  if weather_data is None:
+    raise RuntimeError(f"Could not open forecast hour {forecast_hour} for {service['timestamp']}")
+
+  return {'dataset': weather_data}
+
+def get_variable_source(service, forecast_hour, variable, zoom):
+  """The variable's prepared grid, with the resampling index extended to zoom"""
+  dataset = get_forecast_source(service, forecast_hour)['dataset']
+
+  source = load_source(
+    service, (forecast_hour, variable),
+    lambda: prepare_tile_source(dataset, [variable], [zoom]) if variable in dataset.data_vars else None
+  )
+
+  if source is not None and zoom not in source['index']['zooms']:
+    # The index is shared by every variable on the grid
+    with service['index_lock']:
+      get_tile_index(dataset['lat'].values, dataset['lon'].values, [zoom])
+
+  return source
+
+def disk_tile_path(service, key):
+  variable, forecast_hour, zoom, x, y = key
+  extension = get_tile_encoding(variable)['extension']
+
+  return os.path.join(
+    service['cache_dir'], build_sortable_timestamp(service['timestamp']),
+    forecast_hour, variable, str(zoom), str(x), f"{y}.{extension}"
+  )
+
+def read_disk_tile(service, key):
+  if not service['cache_dir']:
+    return None
+
+  try:
+    with open(disk_tile_path(service, key), 'rb') as f:
+      return f.read()
+  except FileNotFoundError:
+    return None
+
+def write_disk_tile(service, key, data):
+  if not service['cache_dir']:
+    return
+
+  path = disk_tile_path(service, key)
+  temporary_path = f"{path}.{threading.get_ident()}.tmp"
+
+  try:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(temporary_path, 'wb') as f:
+      f.write(data)
+    os.replace(temporary_path, path)
+  except OSError as e:
+    logger.warning(f"Could not write {path} to the disk cache: {e}")
+
+def make_request_handler(service):
+  class TileRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      if self.path == '/stats':
+        cache = service['cache']
+        with service['stats_lock']:
+          stats = dict(service['stats'])
+        body = json.dumps({**stats, 'cached_tiles': len(cache['tiles']), 'cached_bytes': cache['bytes']})
+        return self.respond(200, 'application/json', body.encode())
+
+      match = TILE_PATH.match(self.path.split('?')[0])
+      if not match:
+        return self.respond(404)
+
+      variable = match['variable']
+      zoom, x, y = int(match['zoom']), int(match['x']), int(match['y'])
+      encoding = get_tile_encoding(variable)
+
+      if match['extension'] != encoding['extension'] or zoom > MAX_SERVER_ZOOM or max(x, y) >= 2 ** zoom:
+        return self.respond(404)
+
+      try:
+        data = get_tile(service, variable, match['forecast_hour'], zoom, x, y)
+      except Exception as e:
+        logger.error(f"Failed to render {self.path}: {e}")
+        return self.respond(500)
+
+      if not data:
+        return self.respond(204)
+
+      self.respond(200, encoding['content_type'], data)
+
+    def respond(self, status, content_type=None, body=b''):
+      self.send_response(status)
+      if content_type:
+        self.send_header('Content-Type', content_type)
+        self.send_header('Cache-Control', 'max-age=3600, public')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      logger.debug(format % args)
+
+  return TileRequestHandler
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--port', type=int, default=TILE_SERVER_PORT)
+  parser.add_argument('--timestamp', help='Model run as YYYY/MM/DD/HH, the most recent run by default')
+  args = parser.parse_args()
+
+  service = create_tile_service(build_most_recent_file_stamp(override=args.timestamp))
+  server = ThreadingHTTPServer(('', args.port), make_request_handler(service))
+
+  logger.info(f"Serving {service['timestamp']} tiles on port {args.port}")
+  server.serve_forever()
+
+if __name__ == '__main__':
+  logging.basicConfig()
+  main()
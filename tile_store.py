@@ -0,0 +1,249 @@
+import json
+import logging
+import math
+import os
+import zlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+from pyramid import reduce_by_two
+from tile_index import (
+  TILE_SIZE, TILE_RESAMPLING, RESAMPLING_TAPS, get_tile_index, get_tile_resampling,
+  resample_tile, build_axis_index
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# A Zarr v2 store per model run, laid out as {forecast_hour}/{variable}/{level}.
+# Level 0 is the Web Mercator mosaic of the grid at STORE_ZOOM, so each
+# TILE_SIZE chunk is exactly one STORE_ZOOM tile and every higher zoom tile
+# sits inside one chunk. Level n halves level n - 1, making its chunks the
+# tiles of zoom STORE_ZOOM - n. Chunks with no data are not written and
+# read back as NaN, Zarr's fill value.
+STORE_ZOOM = int(os.getenv('STORE_ZOOM', '6'))
+STORE_OVERVIEW_LEVELS = int(os.getenv('STORE_OVERVIEW_LEVELS', '3'))
+STORE_COMPRESSION_LEVEL = int(os.getenv('STORE_COMPRESSION_LEVEL', '5'))
+STORE_WRITE_WORKERS = int(os.getenv('STORE_WRITE_WORKERS', '8'))
+
+def open_local_store(path):
+  def read(key):
+    try:
+      with open(os.path.join(path, key), 'rb') as f:
+        return f.read()
+    except FileNotFoundError:
+      return None
+
+  def write(key, data):
+    file_path = os.path.join(path, key)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb') as f:
+      f.write(data)
+
+  return {'location': path, 'read': read, 'write': write, 'metadata': {}}
+
+def open_s3_store(s3_client, bucket, prefix):
+  def read(key):
+    try:
+      return s3_client.get_object(Bucket=bucket, Key=f"{prefix}/{key}")['Body'].read()
+    except ClientError as e:
+      if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+        return None
+      raise
+
+  def write(key, data):
+    s3_client.put_object(Bucket=bucket, Key=f"{prefix}/{key}", Body=data)
+
+  return {'location': f"s3://{bucket}/{prefix}", 'read': read, 'write': write, 'metadata': {}}
+
+def write_json(store, key, value):
+  store['write'](key, json.dumps(value).encode())
+
+def read_json(store, key):
+  if key not in store['metadata']:
+    data = store['read'](key)
+    store['metadata'][key] = json.loads(data) if data is not None else None
+
+  return store['metadata'][key]
+
+def write_store_group(store, path, attributes=None):
+  write_json(store, f"{path}/.zgroup" if path else '.zgroup', {'zarr_format': 2})
+
+  if attributes is not None:
+    write_json(store, f"{path}/.zattrs" if path else '.zattrs', attributes)
+
+def write_store_variable(store, forecast_hour, variable, values, lats, lons):
+  """Mosaic one variable's (lat, lon) grid into the store with its overviews"""
+  alignment = 2 ** STORE_OVERVIEW_LEVELS
+  zoom_index = get_tile_index(lats, lons, [STORE_ZOOM])['zooms'][STORE_ZOOM]
+  tile_count_x = len(zoom_index['col_index']) // TILE_SIZE
+  tile_count_y = len(zoom_index['row_index']) // TILE_SIZE
+
+  # Align the level 0 origin and size so every overview halves cleanly
+  x0 = zoom_index['x0'] // alignment * alignment
+  y0 = zoom_index['y0'] // alignment * alignment
+  width = math.ceil((zoom_index['x0'] + tile_count_x - x0) / alignment) * alignment
+  height = math.ceil((zoom_index['y0'] + tile_count_y - y0) / alignment) * alignment
+
+  source = {'values': values, 'index': {'zooms': {STORE_ZOOM: zoom_index}}}
+  mosaic = np.full((height * TILE_SIZE, width * TILE_SIZE), np.nan, dtype=np.float32)
+
+  for row in range(height):
+    for col in range(width):
+      resampling = get_tile_resampling(source['index'], STORE_ZOOM, x0 + col, y0 + row)
+      if resampling is not None:
+        mosaic[row * TILE_SIZE:(row + 1) * TILE_SIZE, col * TILE_SIZE:(col + 1) * TILE_SIZE] = \
+          resample_tile(values, resampling)
+
+  variable_path = f"{forecast_hour}/{variable}"
+  write_store_group(store, variable_path)
+
+  for level in range(STORE_OVERVIEW_LEVELS + 1):
+    if level:
+      mosaic = reduce_by_two(mosaic).astype(np.float32)
+
+    write_store_array(store, f"{variable_path}/{level}", mosaic, {
+      'zoom': STORE_ZOOM - level,
+      'x0': x0 >> level,
+      'y0': y0 >> level
+    })
+
+def write_store_array(store, path, values, attributes):
+  rows, cols = values.shape[0] // TILE_SIZE, values.shape[1] // TILE_SIZE
+
+  write_json(store, f"{path}/.zarray", {
+    'zarr_format': 2,
+    'shape': list(values.shape),
+    'chunks': [TILE_SIZE, TILE_SIZE],
+    'dtype': '<f4',
+    'compressor': {'id': 'zlib', 'level': STORE_COMPRESSION_LEVEL},
+    'fill_value': 'NaN',
+    'order': 'C',
+    'filters': None,
+    'dimension_separator': '.'
+  })
+  write_json(store, f"{path}/.zattrs", attributes)
+
+  def write_chunk(chunk_key):
+    row, col = chunk_key
+    chunk = values[row * TILE_SIZE:(row + 1) * TILE_SIZE, col * TILE_SIZE:(col + 1) * TILE_SIZE]
+
+    if np.isnan(chunk).all():
+      return 0
+
+    store['write'](f"{path}/{row}.{col}", zlib.compress(
+      np.ascontiguousarray(chunk, dtype='<f4').tobytes(), STORE_COMPRESSION_LEVEL
+    ))
+    return 1
+
+  with ThreadPoolExecutor(max_workers=STORE_WRITE_WORKERS) as executor:
+    written = sum(executor.map(write_chunk, [(row, col) for row in range(rows) for col in range(cols)]))
+
+  logger.info(f"Wrote {path}: {written} of {rows * cols} chunks at zoom {attributes['zoom']}")
+
+def read_store_array_metadata(store, path):
+  array = read_json(store, f"{path}/.zarray")
+  if array is None:
+    return None
+
+  return {**array, **read_json(store, f"{path}/.zattrs")}
+
+def read_store_chunk(store, path, row, col):
+  data = store['read'](f"{path}/{row}.{col}")
+
+  if data is None:
+    return np.full((TILE_SIZE, TILE_SIZE), np.nan, dtype=np.float32)
+
+  return np.frombuffer(zlib.decompress(data), dtype='<f4').reshape(TILE_SIZE, TILE_SIZE)
+
+def read_store_window(store, path, metadata, row_start, row_stop, col_start, col_stop):
+  """Pixels [row_start, row_stop) x [col_start, col_stop) of a level, NaN outside it"""
+  height, width = metadata['shape']
+  window = np.full((row_stop - row_start, col_stop - col_start), np.nan, dtype=np.float32)
+
+  for row in range(max(row_start, 0) // TILE_SIZE, (min(row_stop, height) - 1) // TILE_SIZE + 1):
+    for col in range(max(col_start, 0) // TILE_SIZE, (min(col_stop, width) - 1) // TILE_SIZE + 1):
+      chunk = read_store_chunk(store, path, row, col)
+
+      top, left = row * TILE_SIZE, col * TILE_SIZE
+      r0, r1 = max(row_start, top), min(row_stop, top + TILE_SIZE)
+      c0, c1 = max(col_start, left), min(col_stop, left + TILE_SIZE)
+
+      if r0 < r1 and c0 < c1:
+        window[r0 - row_start:r1 - row_start, c0 - col_start:c1 - col_start] = \
+          chunk[r0 - top:r1 - top, c0 - left:c1 - left]
+
+  return window
+
+def read_store_tile(store, forecast_hour, variable, zoom, x, y):
+  """One tile's values, read only from the chunks it overlaps.
+
+  Zooms that match a level are a single chunk as stored; higher zooms are
+  resampled from level 0. Returns None if the variable is not in
+  the store.
+  """
+  level = min(max(STORE_ZOOM - zoom, 0), STORE_OVERVIEW_LEVELS)
+  path = f"{forecast_hour}/{variable}/{level}"
+  metadata = read_store_array_metadata(store, path)
+
+  if metadata is None:
+    return None
+
+  if zoom < metadata['zoom']:
+    raise ValueError(f"Zoom {zoom} is below the store's lowest overview zoom {metadata['zoom']}")
+
+  scale = 2 ** (zoom - metadata['zoom'])
+  size = TILE_SIZE / scale
+  first_col = x * size - metadata['x0'] * TILE_SIZE
+  first_row = y * size - metadata['y0'] * TILE_SIZE
+
+  if scale == 1:
+    return read_store_window(
+      store, path, metadata, int(first_row), int(first_row) + TILE_SIZE, int(first_col), int(first_col) + TILE_SIZE
+    )
+
+  # Output pixel centers in level pixel coordinates, where pixel i's center is i
+  offsets = (np.arange(TILE_SIZE) + 0.5) / scale - 0.5
+  target_cols = first_col + offsets
+  target_rows = first_row + offsets
+
+  # Pad the window by the resampling's reach so every tap lands inside it
+  offsets = RESAMPLING_TAPS[TILE_RESAMPLING]
+  col_start, col_stop = math.floor(target_cols[0]) + offsets[0], math.floor(target_cols[-1]) + offsets[-1] + 1
+  row_start, row_stop = math.floor(target_rows[0]) + offsets[0], math.floor(target_rows[-1]) + offsets[-1] + 1
+  window = read_store_window(store, path, metadata, row_start, row_stop, col_start, col_stop)
+
+  row_index, row_frac = build_axis_index(np.arange(row_start, row_stop, dtype=np.float64), target_rows)
+  col_index, col_frac = build_axis_index(np.arange(col_start, col_stop, dtype=np.float64), target_cols)
+
+  return resample_tile(window, (row_index, row_frac, col_index, col_frac))
+
+def read_store_level(store, forecast_hour, variables, level=0):
+  """Whole-level arrays and their pixel-center lat/lon coordinates"""
+  values = {}
+  metadata = None
+
+  for variable in variables:
+    path = f"{forecast_hour}/{variable}/{level}"
+    variable_metadata = read_store_array_metadata(store, path)
+
+    if variable_metadata is None:
+      logger.warning(f"Variable {variable} not found in store {store['location']}")
+      continue
+
+    metadata = variable_metadata
+    height, width = metadata['shape']
+    values[variable] = read_store_window(store, path, metadata, 0, height, 0, width)
+
+  if metadata is None:
+    raise ValueError(f"None of {variables} are in store {store['location']} for forecast hour {forecast_hour}")
+
+  height, width = metadata['shape']
+  world_size = TILE_SIZE * 2 ** metadata['zoom']
+
+  lons = (metadata['x0'] * TILE_SIZE + np.arange(width) + 0.5) / world_size * 360.0 - 180.0
+  mercator_y = math.pi * (1 - 2 * (metadata['y0'] * TILE_SIZE + np.arange(height) + 0.5) / world_size)
+  lats = np.degrees(np.arctan(np.sinh(mercator_y)))
+
+  return values, lats, lons
@@ -1,4 +1,5 @@
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
+import hashlib
 import math
 import os
 import logging
@@ -6,6 +7,12 @@ import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# plain: tile objects under hrrr/{run}/...
+# hashed: the same keys behind a short hash of themselves, as in 3f/hrrr/{run}/..., so a
+#   run's tile writes spread over many S3 prefixes instead of all landing on one
+TILE_KEY_LAYOUT = os.getenv('TILE_KEY_LAYOUT', 'plain')
+TILE_KEY_HASH_CHARS = int(os.getenv('TILE_KEY_HASH_CHARS', '2'))
+
 def build_most_recent_file_stamp(override=None):
 
   if override:
@@ -26,11 +33,88 @@ def create_local_netcdf_path(filename):
 	return f"/tmp/{filename}"
 
 
+def build_previous_file_stamp(current_timestamp):
+	year, month, day, hour = current_timestamp.split('/')
+	previous_time = datetime(int(year), int(month), int(day), int(hour), tzinfo=timezone.utc) - timedelta(hours=12)
+
+	return f"{previous_time.year}/{str(previous_time.month).zfill(2)}/{str(previous_time.day).zfill(2)}/{str(previous_time.hour).zfill(2)}"
+
+
+def build_sortable_timestamp(timestamp):
+	year, month, day, hour = timestamp.split('/')
+	return f"{year}{month}{day}{hour}"
+
+
 def build_s3_filename(current_timestamp, forecast_hour='03'):
 	splits = current_timestamp.split('/')
 	year, month, day, hour = splits
 	
 	return f"hrrr/{current_timestamp}/log_{year}_{month}_{day}_{hour}_{forecast_hour}.nc"
+
+
+def build_tile_s3_key(timestamp, forecast_hour, variable, zoom, x, y, extension='png'):
+	sortable_timestamp = build_sortable_timestamp(timestamp)
+
+	return apply_key_layout(f"hrrr/{sortable_timestamp}/{forecast_hour}/{variable}/{zoom}/{zoom}_{x}_{y}.{extension}")
+
+
+def build_tile_manifest_s3_key(timestamp, forecast_hour, variable, shard=None):
+	sortable_timestamp = build_sortable_timestamp(timestamp)
+
+	if shard:
+		# A shard's part, merged into manifest.json once every shard is done
+		return f"hrrr/{sortable_timestamp}/{forecast_hour}/{variable}/manifests/{shard}.json"
+
+	return f"hrrr/{sortable_timestamp}/{forecast_hour}/{variable}/manifest.json"
+
+
+def build_tile_archive_s3_key(timestamp, forecast_hour, variable):
+	sortable_timestamp = build_sortable_timestamp(timestamp)
+
+	return f"hrrr/{sortable_timestamp}/{forecast_hour}/{variable}/tiles.pmtiles"
+
+
+def build_value_tile_s3_key(timestamp, forecast_hour, variable, zoom, x, y):
+	sortable_timestamp = build_sortable_timestamp(timestamp)
+
+	return apply_key_layout(f"hrrr/{sortable_timestamp}/{forecast_hour}/{variable}/values/{zoom}/{zoom}_{x}_{y}.png")
+
+
+def build_colormap_s3_key(timestamp):
+	sortable_timestamp = build_sortable_timestamp(timestamp)
+
+	return f"hrrr/{sortable_timestamp}/colormaps.json"
+
+
+def build_tile_stack_s3_key(timestamp, forecast_hours, variable, zoom, x, y, extension='png'):
+	sortable_timestamp = build_sortable_timestamp(timestamp)
+
+	return apply_key_layout(f"hrrr/{sortable_timestamp}/stack_{forecast_hours[0]}-{forecast_hours[-1]}/{variable}/{zoom}/{zoom}_{x}_{y}.{extension}")
+
+
+def build_tile_stack_index_s3_key(timestamp, forecast_hours):
+	sortable_timestamp = build_sortable_timestamp(timestamp)
+
+	return f"hrrr/{sortable_timestamp}/stack_{forecast_hours[0]}-{forecast_hours[-1]}/stack.json"
+
+
+def build_tile_store_prefix(timestamp):
+	sortable_timestamp = build_sortable_timestamp(timestamp)
+
+	return f"hrrr/{sortable_timestamp}/store.zarr"
+
+
+def build_shared_tile_s3_key(digest, extension='png'):
+	return apply_key_layout(f"hrrr/shared/{digest}.{extension}")
+
+
+def apply_key_layout(key):
+	"""key as TILE_KEY_LAYOUT places it. Readers of a hashed layout apply the same hash
+	(the first TILE_KEY_HASH_CHARS hex digits of the key's MD5) to find a tile."""
+	if TILE_KEY_LAYOUT != 'hashed':
+		return key
+
+	return f"{hashlib.md5(key.encode()).hexdigest()[:TILE_KEY_HASH_CHARS]}/{key}"
  
 
 def get_resolution_for_zoom(zoom):
@@ -95,11 +179,13 @@ def get_lambda_tmp_space():
 		return 512  # Default assumption
 
 
-def cleanup_tmp_directory():
+def cleanup_tmp_directory(suffix='', keep=()):
 	tmp_dir = "/tmp"
 	if os.path.exists(tmp_dir):
 		for file in os.listdir(tmp_dir):
 			file_path = os.path.join(tmp_dir, file)
+			if not file.endswith(suffix) or file_path in keep:
+				continue
 			try:
 				if os.path.isfile(file_path):
 					os.remove(file_path)
@@ -0,0 +1,112 @@
+"""Tiles of quantized values for clients that apply the colormaps themselves.
+
+Each pixel holds a 16-bit code split over the red (high byte) and green (low
+byte) channels of an RGB PNG. Code 0 is no data; any other code decodes to
+
+  value = offset + code * scale
+
+with the variable's offset and scale from get_value_encoding. RGB rather than
+a 16-bit or grey/alpha PNG keeps the bytes intact through browser image
+decoding and premultiplied alpha.
+
+  python value_tiles.py > colormaps.json
+
+prints the document build_colormap_document publishes with each run.
+"""
+import io
+import json
+import logging
+import numpy as np
+from PIL import Image
+
+from color_maps import COLOR_SCALES, DEFAULT_SCALE
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+VALUE_CODES = 65535
+
+# (minimum, maximum) stored per variable; values outside are clamped
+VALUE_RANGES = {
+  'wspd': (0, 100),
+  'tmp': (-100, 150),
+  'rh': (0, 100),
+  'MC1': (0, 100),
+  'MC10': (0, 100),
+  'MC100': (0, 100),
+  'MC1000': (0, 100),
+  'MCWOOD': (0, 300),
+  'MCHERB': (0, 300),
+  'KBDI': (0, 800),
+  'IC': (0, 100),
+  'ERC': (0, 200),
+  'BI': (0, 400),
+  'SC': (0, 200),
+  'GSI': (0, 10)
+}
+
+DEFAULT_VALUE_RANGE = (-1000, 1000)
+
+def get_value_encoding(variable):
+  minimum, maximum = VALUE_RANGES.get(variable, DEFAULT_VALUE_RANGE)
+  scale = (maximum - minimum) / (VALUE_CODES - 1)
+
+  # Code 1 is the minimum and code VALUE_CODES the maximum
+  return {'offset': minimum - scale, 'scale': scale, 'nodata': 0}
+
+def quantize_values(arr, variable):
+  encoding = get_value_encoding(variable)
+  codes = np.rint((arr - encoding['offset']) / encoding['scale'])
+  np.clip(codes, 1, VALUE_CODES, out=codes)
+
+  return np.where(np.isnan(arr), encoding['nodata'], codes).astype(np.uint16)
+
+def encode_value_tile(arr, variable, tile_label):
+  """PNG of the tile's quantized values, or None for a tile with no data"""
+  if np.isnan(arr).all():
+    logger.debug(f"All NaN values in value tile {tile_label} for {variable}")
+    return None
+
+  codes = quantize_values(arr, variable)
+  rgb = np.zeros(codes.shape + (3,), dtype=np.uint8)
+  rgb[..., 0] = codes >> 8
+  rgb[..., 1] = codes & 0xFF
+
+  buffer = io.BytesIO()
+  Image.fromarray(rgb, mode='RGB').save(buffer, format="PNG", optimize=True, compress_level=1)
+
+  return buffer.getvalue()
+
+def decode_value_tile(data, variable):
+  """The float32 values of a value tile, NaN where there is no data"""
+  rgb = np.asarray(Image.open(io.BytesIO(data)).convert('RGB'))
+  codes = rgb[..., 0].astype(np.uint16) << 8 | rgb[..., 1]
+  encoding = get_value_encoding(variable)
+
+  values = (encoding['offset'] + codes * encoding['scale']).astype(np.float32)
+  values[codes == encoding['nodata']] = np.nan
+
+  return values
+
+def build_colormap_document(variables=None):
+  """Every variable's color scale and value encoding, as published for clients"""
+  variables = variables or list(COLOR_SCALES)
+
+  return {
+    'value_encoding': {
+      'channels': 'code = red * 256 + green',
+      'value': 'offset + code * scale',
+      'nodata': 0
+    },
+    'missing_values_drawn_as': 0,
+    'variables': {
+      variable: {
+        'scale': COLOR_SCALES.get(variable, DEFAULT_SCALE),
+        'encoding': get_value_encoding(variable)
+      }
+      for variable in variables
+    }
+  }
+
+if __name__ == '__main__':
+  print(json.dumps(build_colormap_document(), indent=2))